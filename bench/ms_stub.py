@@ -0,0 +1,585 @@
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from src.moysklad import MS_EXPAND_PAGE_LIMIT, MS_MAX_PAGE_LIMIT, id_from_href
+
+API_PREFIX = "/api/remap/1.2"
+QR_ATTR_ID = "687d964c-5a22-11ee-0a80-032800443111"
+QR_ATTR_NAME = "ШККОД128"
+ATTR_CIS_REQUIRED = "ЧЗ"
+BUNDLE_MARK_FLAG = "Комплект_маркируемый"
+PACKING_STATE_ID = "9f2c0b8e-0000-4000-8000-00000000a001"
+OTHER_STATE_ID = "9f2c0b8e-0000-4000-8000-00000000a002"
+# вложенные коллекции (positions при expand) МС отдаёт не длиннее 100 строк
+NESTED_LIMIT = 100
+
+
+def _uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _ms_dt(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M:%S.000")
+
+
+def _ean13(rng: random.Random) -> str:
+    body = "46" + "".join(str(rng.randint(0, 9)) for _ in range(10))
+    s = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(body))
+    return body + str((10 - s % 10) % 10)
+
+
+def _split_filter(flt: str) -> List[Tuple[str, str, str]]:
+    """filter МС → [(поле, оператор, значение)]; ';' внутри значения экранирован '\\;'."""
+    parts: List[str] = []
+    buf: List[str] = []
+    i = 0
+    while i < len(flt):
+        ch = flt[i]
+        if ch == "\\" and i + 1 < len(flt):
+            buf.append(flt[i + 1])
+            i += 2
+            continue
+        if ch == ";":
+            parts.append("".join(buf))
+            buf = []
+        else:
+            buf.append(ch)
+        i += 1
+    parts.append("".join(buf))
+
+    out: List[Tuple[str, str, str]] = []
+    for p in parts:
+        if not p:
+            continue
+        for op in (">=", "<=", "!=", ">", "<", "="):
+            k, sep, v = p.partition(op)
+            if sep and "=" not in k and ">" not in k and "<" not in k:
+                out.append((k.strip(), op, v))
+                break
+    return out
+
+
+def _cmp(left: str, op: str, right: str) -> bool:
+    if op == ">=":
+        return left >= right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    if op == "<":
+        return left < right
+    if op == "!=":
+        return left != right
+    return left == right
+
+
+class StubError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class StubData:
+    """
+    Синтетический аккаунт МС: товары (часть — с модификациями), комплекты, заказы в статусе «упаковка».
+    Генерация детерминирована (seed): одни и те же параметры — одни и те же данные между версиями кода.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        orders: int = 2000,
+        products: int = 500,
+        bundles: int = 100,
+        seed: int = 1,
+        max_lines: int = 6,
+        bundle_share: float = 0.3,
+        variant_share: float = 0.2,
+        cis_share: float = 0.6,
+        marked_bundle_share: float = 0.2,
+        done_share: float = 0.05,
+        no_barcode_share: float = 0.03,
+        other_state_share: float = 0.1,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.lock = threading.Lock()
+        rng = random.Random(seed)
+        self.attr_ids = {name: _uuid(rng) for name in (ATTR_CIS_REQUIRED, BUNDLE_MARK_FLAG)}
+        self.packing_state_href = self.href("customerorder/metadata/states", PACKING_STATE_ID)
+        self.other_state_href = self.href("customerorder/metadata/states", OTHER_STATE_ID)
+
+        now = datetime.now().replace(microsecond=0)
+        catalog_updated = _ms_dt(now - timedelta(days=30))
+
+        self.entities: Dict[str, Dict[str, Dict[str, Any]]] = {"product": {}, "variant": {}, "bundle": {}, "customerorder": {}}
+        self.positions: Dict[str, List[Dict[str, Any]]] = {}
+        self.components: Dict[str, List[Tuple[str, str, float]]] = {}
+
+        items: List[Tuple[str, str]] = []
+        for i in range(products):
+            pid = _uuid(rng)
+            self.entities["product"][pid] = {
+                **self._ref("product", pid),
+                "id": pid,
+                "code": f"P{i:06d}",
+                "name": f"Товар {i}",
+                "barcodes": [{"ean13": _ean13(rng)}],
+                "attributes": [self._attr(ATTR_CIS_REQUIRED, "boolean", rng.random() < cis_share)],
+                "updated": catalog_updated,
+            }
+            if rng.random() < variant_share:
+                for v in range(rng.randint(2, 4)):
+                    vid = _uuid(rng)
+                    self.entities["variant"][vid] = {
+                        **self._ref("variant", vid),
+                        "id": vid,
+                        "code": f"P{i:06d}-{v}",
+                        "name": f"Товар {i} / размер {v}",
+                        "barcodes": [{"ean13": _ean13(rng)}],
+                        "product": self._ref("product", pid),
+                        "updated": catalog_updated,
+                    }
+                    items.append(("variant", vid))
+            else:
+                items.append(("product", pid))
+
+        for i in range(bundles):
+            bid = _uuid(rng)
+            self.entities["bundle"][bid] = {
+                **self._ref("bundle", bid),
+                "id": bid,
+                "code": f"B{i:05d}",
+                "name": f"Комплект {i}",
+                "attributes": [self._attr(BUNDLE_MARK_FLAG, "boolean", rng.random() < marked_bundle_share)],
+                "updated": catalog_updated,
+            }
+            self.components[bid] = [(t, x, float(rng.randint(1, 3))) for t, x in rng.sample(items, k=min(len(items), rng.randint(2, 5)))]
+
+        bundle_ids = list(self.entities["bundle"])
+        self.order_ids: List[str] = []
+        for i in range(orders):
+            oid = _uuid(rng)
+            moment = now - timedelta(minutes=3 * i + 5)
+            attrs = []
+            if rng.random() >= no_barcode_share:
+                attrs.append(self._attr(QR_ATTR_NAME, "string", f"{1000000000 + i}"))
+            done = rng.random() < done_share
+            self.entities["customerorder"][oid] = {
+                **self._ref("customerorder", oid),
+                "id": oid,
+                "name": f"{i:05d}",
+                "moment": _ms_dt(moment),
+                "updated": _ms_dt(moment + timedelta(minutes=rng.randint(0, 3))),
+                "description": "[CIS]\n0104600000000000215abc\n[/CIS]" if done else "",
+                "state": {"meta": {"href": self.other_state_href if rng.random() < other_state_share else self.packing_state_href, "type": "state"}},
+                "attributes": attrs,
+            }
+            lines = []
+            for _ in range(rng.randint(1, max_lines)):
+                if bundle_ids and rng.random() < bundle_share:
+                    ref = ("bundle", rng.choice(bundle_ids))
+                else:
+                    ref = rng.choice(items)
+                lines.append({"id": _uuid(rng), "quantity": float(rng.randint(1, 3)), "price": 10000.0, "_ref": ref})
+            self.positions[oid] = lines
+            self.order_ids.append(oid)
+        # список заказов МС отдаёт в порядке moment,desc — держим его заранее отсортированным
+        self.order_ids.sort(key=lambda x: self.entities["customerorder"][x]["moment"], reverse=True)
+
+    # ---------------- построение сущностей ----------------
+
+    def href(self, path: str, entity_id: str) -> str:
+        return f"{self.base_url}/entity/{path}/{entity_id}"
+
+    def _ref(self, entity: str, entity_id: str) -> Dict[str, Any]:
+        return {"meta": {"href": self.href(entity, entity_id), "type": entity}}
+
+    def _attr(self, name: str, a_type: str, value: Any) -> Dict[str, Any]:
+        if name == QR_ATTR_NAME:
+            owner, attr_id = "customerorder", QR_ATTR_ID
+        else:
+            owner, attr_id = ("bundle" if name == BUNDLE_MARK_FLAG else "product"), self.attr_ids[name]
+        return {
+            "meta": {"href": f"{self.base_url}/entity/{owner}/metadata/attributes/{attr_id}", "type": "attributemetadata"},
+            "id": attr_id,
+            "name": name,
+            "type": a_type,
+            "value": value,
+        }
+
+    def barcodes(self) -> List[str]:
+        """ШККОД128 заказов в статусе «упаковка», ещё не обработанных — то, что сканирует упаковщик."""
+        out = []
+        for oid in self.order_ids:
+            o = self.entities["customerorder"][oid]
+            if o["state"]["meta"]["href"] != self.packing_state_href or "[CIS]" in o["description"]:
+                continue
+            out.extend(str(a["value"]) for a in o["attributes"] if a["id"] == QR_ATTR_ID)
+        return out
+
+    def cis_flags(self) -> Dict[str, bool]:
+        """Как resolve_cis_flags: id товара/модификации → нужен ли КМ (модификация — по товару)."""
+        products = {pid: bool(p["attributes"][0]["value"]) for pid, p in self.entities["product"].items()}
+        out = dict(products)
+        for vid, v in self.entities["variant"].items():
+            out[vid] = products.get(id_from_href(v["product"]["meta"]["href"]), False)
+        return out
+
+    def assortment(self, ref: Tuple[str, str], expand: bool) -> Dict[str, Any]:
+        ent = self.entities[ref[0]][ref[1]]
+        return dict(ent) if expand else {"meta": ent["meta"]}
+
+    def bundle(self, bundle_id: str, expand: str = "") -> Dict[str, Any]:
+        b = dict(self.entities["bundle"][bundle_id])
+        comps = self.components[bundle_id]
+        if "components" in expand:
+            full = "components.assortment" in expand
+            b["components"] = {
+                "meta": {"size": len(comps)},
+                "rows": [{"quantity": q, "assortment": self.assortment((t, x), full)} for t, x, q in comps],
+            }
+        else:
+            b["components"] = {"meta": {"href": b["meta"]["href"] + "/components", "size": len(comps)}}
+        return b
+
+    def order_positions(self, order_id: str, expand_assortment: bool) -> List[Dict[str, Any]]:
+        return [
+            {"id": p["id"], "quantity": p["quantity"], "price": p["price"], "assortment": self.assortment(p["_ref"], expand_assortment)}
+            for p in self.positions[order_id]
+        ]
+
+    def order(self, order_id: str, expand: str = "") -> Dict[str, Any]:
+        o = dict(self.entities["customerorder"][order_id])
+        lines = self.positions[order_id]
+        if "positions" in expand:
+            rows = self.order_positions(order_id, "positions.assortment" in expand)[:NESTED_LIMIT]
+            o["positions"] = {"meta": {"size": len(lines)}, "rows": rows}
+        else:
+            o["positions"] = {"meta": {"href": o["meta"]["href"] + "/positions", "size": len(lines)}}
+        return o
+
+    def render(self, entity: str, entity_id: str, expand: str = "") -> Dict[str, Any]:
+        if entity == "customerorder":
+            return self.order(entity_id, expand)
+        if entity == "bundle":
+            return self.bundle(entity_id, expand)
+        return dict(self.entities[entity][entity_id])
+
+    # ---------------- фильтры ----------------
+
+    def _match(self, entity: str, ent: Dict[str, Any], conds: Dict[str, List[Tuple[str, str]]]) -> bool:
+        for key, alts in conds.items():
+            # несколько условий на одно поле МС объединяет через ИЛИ
+            if not any(self._match_one(entity, ent, key, op, v) for op, v in alts):
+                return False
+        return True
+
+    def _match_one(self, entity: str, ent: Dict[str, Any], key: str, op: str, value: str) -> bool:
+        if key == "id":
+            return _cmp(ent["id"], op, value)
+        if key in ("moment", "updated"):
+            return _cmp(str(ent.get(key) or "")[:19], op, value[:19])
+        if key == "archived":
+            return _cmp("true" if ent.get("archived") else "false", op, value)
+        if key == "state" and entity == "customerorder":
+            return _cmp(id_from_href(ent["state"]["meta"]["href"]), op, id_from_href(value))
+        if "/metadata/attributes/" in key:
+            attr_id = id_from_href(key)
+            return any(a["id"] == attr_id and _cmp(str(a.get("value", "")), op, value) for a in ent.get("attributes") or [])
+        raise StubError(412, f"фильтр по полю {key!r} не поддерживается заглушкой")
+
+    def list_rows(self, entity: str, params: Dict[str, str]) -> Dict[str, Any]:
+        expand = params.get("expand", "")
+        cap = MS_EXPAND_PAGE_LIMIT if expand else MS_MAX_PAGE_LIMIT
+        limit = max(1, min(int(params.get("limit") or MS_MAX_PAGE_LIMIT), cap))
+        offset = max(0, int(params.get("offset") or 0))
+        conds: Dict[str, List[Tuple[str, str]]] = {}
+        for key, op, v in _split_filter(params.get("filter", "")):
+            conds.setdefault(key, []).append((op, v))
+
+        with self.lock:
+            ids = self.order_ids if entity == "customerorder" else list(self.entities[entity])
+            if "id" in conds and all(op == "=" for op, _ in conds["id"]):
+                wanted = {v for _, v in conds["id"]}
+                ids = [i for i in ids if i in wanted]
+            matched = [i for i in ids if self._match(entity, self.entities[entity][i], conds)]
+            rows = [self.render(entity, i, expand) for i in matched[offset : offset + limit]]
+        return {"meta": {"size": len(matched), "limit": limit, "offset": offset}, "rows": rows}
+
+    # ---------------- запись ----------------
+
+    def update_order(self, order_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            o = self.entities["customerorder"].get(order_id)
+            if o is None:
+                raise StubError(404, f"заказ {order_id} не найден")
+            if "description" in fields:
+                o["description"] = str(fields["description"] or "")
+            o["updated"] = _ms_dt(datetime.now())
+            return self.order(order_id)
+
+
+class _Bucket:
+    """Лимит МС на аккаунт: rate запросов за window_s (token bucket)."""
+
+    def __init__(self, rate: int, window_s: float):
+        self.capacity = float(max(1, rate))
+        self.refill_per_s = self.capacity / max(0.001, window_s)
+        self.window_s = window_s
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> Tuple[bool, float, float]:
+        """(разрешён, осталось токенов, через сколько мс появится следующий)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.refill_per_s)
+            self._ts = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True, self._tokens, 0.0
+            return False, 0.0, (1.0 - self._tokens) / self.refill_per_s * 1000
+
+
+class MsStub:
+    """
+    Заглушка API МС для бенчмарков: список/чтение заказов и позиций, комплекты с компонентами,
+    товары/модификации, метаданные доп. полей, массовое обновление заказов.
+    Задержка ответа и лимиты (429 с X-Lognex-Retry-After, параллельные запросы) — как у МС, настраиваются.
+    """
+
+    def __init__(
+        self,
+        data: Optional[StubData] = None,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        rate_limit: int = 45,
+        rate_window_s: float = 3.0,
+        max_parallel: int = 5,
+    ):
+        self.data = data
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.max_parallel = int(max_parallel)
+        self.bucket = _Bucket(rate_limit, rate_window_s) if rate_limit > 0 else None
+        self.counters: Dict[str, int] = {}
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def reset_counters(self) -> Dict[str, int]:
+        with self._lock:
+            out, self.counters = self.counters, {}
+        return out
+
+    def handle(self, method: str, path: str, params: Dict[str, str], body: Any) -> Tuple[int, Dict[str, str], Any]:
+        with self._lock:
+            self._inflight += 1
+            too_many = self.max_parallel > 0 and self._inflight > self.max_parallel
+        try:
+            headers: Dict[str, str] = {}
+            if too_many:
+                self._count("429_parallel")
+                return 429, {"X-Lognex-Retry-After": "100"}, {"errors": [{"error": "Превышено количество параллельных запросов", "code": 1049}]}
+            if self.bucket is not None:
+                ok, remaining, retry_ms = self.bucket.take()
+                headers["X-RateLimit-Limit"] = str(int(self.bucket.capacity))
+                headers["X-RateLimit-Remaining"] = str(int(remaining))
+                if not ok:
+                    self._count("429_rate")
+                    headers["X-Lognex-Retry-After"] = str(max(1, int(retry_ms)))
+                    headers["X-Lognex-Retry-TimeInterval"] = str(int(self.bucket.window_s * 1000))
+                    return 429, headers, {"errors": [{"error": "Превышен лимит запросов", "code": 1073}]}
+
+            delay = self.latency_ms + (random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+            if delay > 0:
+                time.sleep(delay / 1000.0)
+            self._count(f"{method} {_template(path)}")
+            try:
+                return 200, headers, self._route(method, path, params, body)
+            except StubError as e:
+                return e.status, headers, {"errors": [{"error": e.message}]}
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def _route(self, method: str, path: str, params: Dict[str, str], body: Any) -> Any:
+        data = self.data
+        if data is None:
+            raise StubError(503, "данные заглушки ещё не загружены")
+        parts = [p for p in path.split("/") if p]
+        if len(parts) < 2 or parts[0] != "entity" or parts[1] not in data.entities:
+            raise StubError(404, f"неизвестный путь {path}")
+        entity = parts[1]
+        expand = params.get("expand", "")
+
+        if method == "GET":
+            if parts[2:] == ["metadata", "attributes"]:
+                names = [QR_ATTR_NAME] if entity == "customerorder" else list(data.attr_ids)
+                return {"meta": {"size": len(names)}, "rows": [{k: v for k, v in data._attr(n, "string", None).items() if k != "value"} for n in names]}
+            if len(parts) == 2:
+                return data.list_rows(entity, params)
+            entity_id = parts[2]
+            if entity_id not in data.entities[entity]:
+                raise StubError(404, f"{entity} {entity_id} не найден")
+            if entity == "customerorder" and parts[3:] == ["positions"]:
+                rows = data.order_positions(entity_id, "assortment" in expand)
+                limit = max(1, min(int(params.get("limit") or MS_MAX_PAGE_LIMIT), MS_EXPAND_PAGE_LIMIT if expand else MS_MAX_PAGE_LIMIT))
+                offset = max(0, int(params.get("offset") or 0))
+                return {"meta": {"size": len(rows), "limit": limit, "offset": offset}, "rows": rows[offset : offset + limit]}
+            if entity == "bundle" and parts[3:] == ["components"]:
+                return data.bundle(entity_id, "components.assortment")["components"]
+            if len(parts) == 3:
+                return data.render(entity, entity_id, expand)
+            raise StubError(404, f"неизвестный путь {path}")
+
+        if entity != "customerorder":
+            raise StubError(405, f"{method} {path} заглушкой не поддерживается")
+        if method == "PUT" and len(parts) == 3:
+            return data.update_order(parts[2], body or {})
+        if method == "POST" and len(parts) == 2 and isinstance(body, list):
+            # массовое обновление: ответ — массив, ошибка по элементу — на его месте
+            out: List[Any] = []
+            for item in body:
+                try:
+                    out.append(data.update_order(id_from_href((item.get("meta") or {}).get("href") or ""), item))
+                except StubError as e:
+                    out.append({"errors": [{"error": e.message}]})
+            return out
+        raise StubError(405, f"{method} {path} заглушкой не поддерживается")
+
+
+def _template(path: str) -> str:
+    parts = [p for p in path.split("/") if p]
+    return "/" + "/".join("{id}" if len(p) == 36 and p.count("-") == 4 else p for p in parts)
+
+
+def make_server(stub: MsStub, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у МС
+        # заголовки и тело уходят разными write: без TCP_NODELAY — задержка delayed ACK (~40 мс) на каждом запросе
+        disable_nagle_algorithm = True
+
+        def _serve(self, method: str) -> None:
+            url = urlparse(self.path)
+            if not url.path.startswith(API_PREFIX):
+                self._reply(404, {}, {"errors": [{"error": "not found"}]})
+                return
+            params = {k: v[-1] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+            body = None
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                try:
+                    body = json.loads(self.rfile.read(length))
+                except Exception:
+                    self._reply(400, {}, {"errors": [{"error": "bad json"}]})
+                    return
+            status, headers, payload = stub.handle(method, url.path[len(API_PREFIX):], params, body)
+            self._reply(status, headers, payload)
+
+        def _reply(self, status: int, headers: Dict[str, str], body: Any) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            self._serve("GET")
+
+        def do_PUT(self) -> None:
+            self._serve("PUT")
+
+        def do_POST(self) -> None:
+            self._serve("POST")
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def base_url_of(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}{API_PREFIX}"
+
+
+def start_stub(stub: MsStub, host: str = "127.0.0.1", port: int = 0, **data_kwargs: Any) -> Tuple[ThreadingHTTPServer, str]:
+    """Поднять заглушку в фоновом потоке; данные генерируются под фактический адрес. Возвращает (server, base_url)."""
+    server = make_server(stub, host, port)
+    base_url = base_url_of(server)
+    stub.data = StubData(base_url, **data_kwargs)
+    threading.Thread(target=server.serve_forever, name="ms-stub", daemon=True).start()
+    return server, base_url
+
+
+def add_data_args(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument("--orders", type=int, default=2000)
+    ap.add_argument("--products", type=int, default=500)
+    ap.add_argument("--bundles", type=int, default=100)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--latency-ms", type=float, default=20.0, help="задержка ответа заглушки")
+    ap.add_argument("--jitter-ms", type=float, default=10.0)
+    ap.add_argument("--rate-limit", type=int, default=45, help="запросов за окно, 0 — без лимита")
+    ap.add_argument("--rate-window-s", type=float, default=3.0)
+    ap.add_argument("--max-parallel", type=int, default=5)
+
+
+def stub_from_args(args: argparse.Namespace) -> MsStub:
+    return MsStub(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        rate_window_s=args.rate_window_s,
+        max_parallel=args.max_parallel,
+    )
+
+
+def data_kwargs_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    return {"orders": args.orders, "products": args.products, "bundles": args.bundles, "seed": args.seed}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Локальная заглушка API МС с синтетическими заказами и комплектами")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8090)
+    add_data_args(ap)
+    args = ap.parse_args(argv)
+
+    stub = stub_from_args(args)
+    server, base_url = start_stub(stub, args.host, args.port, **data_kwargs_from_args(args))
+    print(f"[ms-stub] {base_url}", flush=True)
+    print(f"[ms-stub] MS_PACKING_STATE_HREF={stub.data.packing_state_href}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
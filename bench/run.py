@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bench.ms_stub import (
+    ATTR_CIS_REQUIRED,
+    BUNDLE_MARK_FLAG,
+    QR_ATTR_ID,
+    QR_ATTR_NAME,
+    MsStub,
+    StubData,
+    add_data_args,
+    data_kwargs_from_args,
+    start_stub,
+    stub_from_args,
+)
+from src.catalog import sync_catalog
+from src.index_db import HotOrderMap, IndexDB
+from src.indexer import explode_order_positions, order_record, run_indexing
+from src.moysklad import MoySkladClient
+
+BENCHES = ("indexing", "find", "db", "explode")
+
+
+def _summary(samples: List[float]) -> Dict[str, Any]:
+    """Задержки (сек) → n, mean/p50/p95/p99/max в мс."""
+    if not samples:
+        return {"n": 0}
+    s = sorted(samples)
+    n = len(s)
+
+    def q(p: float) -> float:
+        return round(s[min(n - 1, int(p * n))] * 1000, 4)
+
+    return {
+        "n": n,
+        "mean_ms": round(sum(s) / n * 1000, 4),
+        "p50_ms": q(0.5),
+        "p95_ms": q(0.95),
+        "p99_ms": q(0.99),
+        "max_ms": round(s[-1] * 1000, 4),
+    }
+
+
+def _timed(fn: Callable[[], Any]) -> Tuple[Any, float]:
+    t0 = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - t0
+
+
+def _client(base_url: str) -> MoySkladClient:
+    # свежий клиент на сценарий: метрики HTTP и пул не переносятся между замерами
+    return MoySkladClient(token="bench", base_url=base_url)
+
+
+def _git_rev() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return out.stdout.strip()
+    except Exception:
+        return ""
+
+
+# ---------------- сценарии ----------------
+
+def bench_indexing(base_url: str, stub: MsStub, tmp: str) -> Dict[str, Any]:
+    """Проход run_indexing по всем заказам «упаковки»: с зеркалом каталога и без, затем дельта по watermark."""
+    data = stub.data
+    out: Dict[str, Any] = {}
+
+    for mode in ("mirror", "remote"):
+        db = IndexDB(os.path.join(tmp, f"indexing-{mode}.sqlite"))
+        db.init()
+        ms = _client(base_url)
+        stub.reset_counters()
+        res: Dict[str, Any] = {}
+        try:
+            if mode == "mirror":
+                counts, secs = _timed(lambda: sync_catalog(ms, db, ATTR_CIS_REQUIRED, BUNDLE_MARK_FLAG, full=True))
+                res["catalog_sync_s"] = round(secs, 3)
+                res["catalog_rows"] = counts
+
+            def index() -> Dict[str, int]:
+                return run_indexing(
+                    ms,
+                    db,
+                    data.packing_state_href,
+                    qr_attr_id=QR_ATTR_ID,
+                    qr_attr_name=QR_ATTR_NAME,
+                    max_total=len(data.order_ids) + 1,
+                    use_catalog=mode == "mirror",
+                    attr_cis_required=ATTR_CIS_REQUIRED,
+                    bundle_mark_flag=BUNDLE_MARK_FLAG,
+                )
+
+            stats, secs = _timed(index)
+            res["cold"] = {
+                "seconds": round(secs, 3),
+                "orders_per_s": round(stats["listed"] / secs, 1) if secs else 0.0,
+                "stats": stats,
+                "stub_requests": stub.reset_counters(),
+            }
+            # второй проход: в МС ничего не менялось — только дельта по watermark
+            stats, secs = _timed(index)
+            res["delta"] = {"seconds": round(secs, 3), "stats": stats, "stub_requests": stub.reset_counters()}
+            res["http"] = ms.metrics.stats()
+        finally:
+            ms.close()
+            db.close()
+        out[mode] = res
+    return out
+
+
+def bench_find(base_url: str, stub: MsStub, samples: int, seed: int) -> Dict[str, Any]:
+    """find_customerorder_by_attr_value_recent: фильтр по доп. полю (по id и по имени) и промах."""
+    rng = random.Random(seed)
+    barcodes = stub.data.barcodes()
+    values = [rng.choice(barcodes) for _ in range(samples)] if barcodes else []
+    out: Dict[str, Any] = {}
+    ms = _client(base_url)
+    try:
+        for name, kwargs in (("by_attr_id", {"attr_id": QR_ATTR_ID}), ("by_attr_name", {"attr_name": QR_ATTR_NAME})):
+            lat: List[float] = []
+            found = 0
+            for v in values:
+                co, secs = _timed(lambda: ms.find_customerorder_by_attr_value_recent(v, **kwargs))
+                lat.append(secs)
+                found += int(co is not None)
+            out[name] = {**_summary(lat), "found": found}
+        lat = []
+        for i in range(max(1, samples // 4)):
+            _, secs = _timed(lambda: ms.find_customerorder_by_attr_value_recent(f"missing-{i}", attr_id=QR_ATTR_ID))
+            lat.append(secs)
+        out["miss"] = _summary(lat)
+        out["http"] = ms.metrics.stats()
+    finally:
+        ms.close()
+    return out
+
+
+def _records(data: StubData) -> List[Dict[str, Any]]:
+    """Записи для ingest_orders прямо из данных заглушки (раскрытие — локально, без HTTP)."""
+    bundles = {bid: data.bundle(bid, "components.assortment") for bid in data.entities["bundle"]}
+    flags = data.cis_flags()
+    barcodes = {}
+    for oid in data.order_ids:
+        for a in data.entities["customerorder"][oid]["attributes"]:
+            if a["id"] == QR_ATTR_ID:
+                barcodes[oid] = str(a["value"])
+    out = []
+    for oid, b128 in barcodes.items():
+        exploded = explode_order_positions(
+            None,  # type: ignore[arg-type] — все комплекты переданы, в МС не ходим
+            data.order_positions(oid, True),
+            bundles=bundles,
+            cis_flags=flags,
+            bundle_mark_flag=BUNDLE_MARK_FLAG,
+        )
+        out.append(order_record(data.entities["customerorder"][oid], b128, exploded))
+    return out
+
+
+def bench_db(data: StubData, tmp: str, batch: int, samples: int, seed: int) -> Dict[str, Any]:
+    """IndexDB: ingest пачками (новые заказы и повторная запись), lookup по ШККОД128, HotOrderMap."""
+    rng = random.Random(seed)
+    records = _records(data)
+    db = IndexDB(os.path.join(tmp, "db.sqlite"))
+    db.init()
+    out: Dict[str, Any] = {"orders": len(records), "batch": batch}
+    try:
+        for name in ("ingest_new", "ingest_update"):
+            lat: List[float] = []
+            for i in range(0, len(records), batch):
+                _, secs = _timed(lambda: db.ingest_orders(records[i : i + batch]))
+                lat.append(secs)
+            total = sum(lat)
+            out[name] = {
+                "seconds": round(total, 3),
+                "orders_per_s": round(len(records) / total, 1) if total else 0.0,
+                "batch": _summary(lat),
+            }
+
+        keys = [rng.choice(records)["barcode128"] for _ in range(samples)] if records else []
+        for name, fn in (("lookup_order", db.lookup_order), ("lookup_positions", db.lookup_positions)):
+            lat = []
+            for k in keys:
+                _, secs = _timed(lambda: fn(k))
+                lat.append(secs)
+            out[name] = _summary(lat)
+        out["lookup_miss"] = _summary([_timed(lambda: db.lookup_order(f"missing-{i}"))[1] for i in range(samples)])
+
+        hot = HotOrderMap(db, check_interval_s=3600)
+        n, secs = _timed(lambda: hot.refresh(force=True))
+        out["hot_refresh"] = {"orders": n, "seconds": round(secs, 4)}
+        lat = []
+        for k in keys:
+            _, secs = _timed(lambda: (hot.lookup(k), hot.lookup_positions(k)))
+            lat.append(secs)
+        out["hot_lookup"] = _summary(lat)
+    finally:
+        db.close()
+    return out
+
+
+def bench_explode(data: StubData) -> Dict[str, Any]:
+    """explode_order_positions на всех заказах: комплекты уже загружены, с правилами маркировки и без."""
+    bundles = {bid: data.bundle(bid, "components.assortment") for bid in data.entities["bundle"]}
+    flags = data.cis_flags()
+    positions = [data.order_positions(oid, True) for oid in data.order_ids]
+    out: Dict[str, Any] = {"orders": len(positions), "positions": sum(len(p) for p in positions)}
+    for name, cis_flags in (("plain", None), ("cis_rules", flags)):
+        lat: List[float] = []
+        lines = 0
+        for pos in positions:
+            rows, secs = _timed(
+                lambda: explode_order_positions(
+                    None,  # type: ignore[arg-type]
+                    pos,
+                    bundles=bundles,
+                    cis_flags=cis_flags,
+                    bundle_mark_flag=BUNDLE_MARK_FLAG,
+                )
+            )
+            lat.append(secs)
+            lines += len(rows)
+        total = sum(lat)
+        out[name] = {
+            **_summary(lat),
+            "lines": lines,
+            "orders_per_s": round(len(positions) / total, 1) if total else 0.0,
+        }
+    return out
+
+
+# ---------------- сравнение ----------------
+
+def _flatten(d: Any, prefix: str = "") -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    if isinstance(d, dict):
+        for k, v in d.items():
+            out.update(_flatten(v, f"{prefix}.{k}" if prefix else str(k)))
+    elif isinstance(d, (int, float)) and not isinstance(d, bool):
+        out[prefix] = float(d)
+    return out
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any], threshold: float = 0.1) -> List[Dict[str, Any]]:
+    """
+    Метрики, ухудшившиеся больше чем на threshold: *_per_s — чем больше, тем лучше; *_ms / seconds / *_s — наоборот.
+    HTTP-сводки (http.*) не сравниваются — это контекст, а не результат.
+    """
+    a = _flatten(old.get("results") or {})
+    b = _flatten(new.get("results") or {})
+    out = []
+    for key in sorted(set(a) & set(b)):
+        if ".http." in f".{key}.":
+            continue
+        last = key.rsplit(".", 1)[-1]
+        if last.endswith("_per_s"):
+            worse = a[key] > 0 and b[key] < a[key] * (1 - threshold)
+        elif last.endswith("_ms") or last.endswith("_s") or last == "seconds":
+            worse = a[key] > 0 and b[key] > a[key] * (1 + threshold)
+        else:
+            continue
+        if worse:
+            out.append({"metric": key, "old": a[key], "new": b[key], "ratio": round(b[key] / a[key], 3)})
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Бенчмарки индексатора и IndexDB против локальной заглушки МС")
+    ap.add_argument("--only", default=",".join(BENCHES), help=f"через запятую: {', '.join(BENCHES)}")
+    ap.add_argument("--samples", type=int, default=200, help="запросов/lookup-ов на замер задержки")
+    ap.add_argument("--batch", type=int, default=100, help="размер пачки ingest_orders")
+    ap.add_argument("--out", default="", help="JSON с результатами (по умолчанию bench/results/<время>-<rev>.json)")
+    ap.add_argument("--compare", default="", help="прошлый JSON: вывести ухудшения, код возврата 1 если они есть")
+    ap.add_argument("--threshold", type=float, default=0.1)
+    add_data_args(ap)
+    args = ap.parse_args(argv)
+
+    only = [b.strip() for b in args.only.split(",") if b.strip()]
+    unknown = sorted(set(only) - set(BENCHES))
+    if unknown:
+        ap.error(f"неизвестные бенчмарки: {', '.join(unknown)}")
+
+    stub = stub_from_args(args)
+    server, base_url = start_stub(stub, **data_kwargs_from_args(args))
+    results: Dict[str, Any] = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix="ms-bench-") as tmp:
+            for name in only:
+                print(f"[bench] {name} ...", flush=True)
+                if name == "indexing":
+                    results[name] = bench_indexing(base_url, stub, tmp)
+                elif name == "find":
+                    results[name] = bench_find(base_url, stub, args.samples, args.seed)
+                elif name == "db":
+                    results[name] = bench_db(stub.data, tmp, args.batch, args.samples, args.seed)
+                elif name == "explode":
+                    results[name] = bench_explode(stub.data)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    rev = _git_rev()
+    report = {
+        "rev": rev,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "threshold")},
+        "results": results,
+    }
+    path = args.out or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}{'-' + rev if rev else ''}.json",
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[bench] {path}", flush=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        if old.get("params") != report["params"]:
+            print("[bench] внимание: параметры прогонов различаются, сравнение условное", flush=True)
+        worse = compare(old, report, args.threshold)
+        for w in worse:
+            print(f"[bench] хуже: {w['metric']}: {w['old']} -> {w['new']} (x{w['ratio']})", flush=True)
+        if worse:
+            return 1
+        print("[bench] ухудшений нет", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# TTL (сек) по типу сущности; 0 — не кэшировать. Каталог меняется редко, заказы — постоянно.
+DEFAULT_TTLS: Dict[str, float] = {
+    "bundle": 3600,
+    "product": 3600,
+    "variant": 3600,
+    "service": 3600,
+    "metadata": 86400,
+    "customerorder": 0,
+}
+
+
+def entity_type_of(path: str) -> str:
+    """/entity/bundle/<id> -> bundle; /entity/customerorder/metadata/attributes -> metadata."""
+    parts = [p for p in (path or "").split("?", 1)[0].split("/") if p]
+    if "metadata" in parts:
+        return "metadata"
+    if len(parts) >= 2 and parts[0] == "entity":
+        return parts[1]
+    return parts[0] if parts else ""
+
+
+def cache_key(path: str, params: Optional[Dict[str, Any]]) -> str:
+    return path + "?" + json.dumps(params or {}, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class ResponseCache:
+    """
+    Кэш GET-ответов: TTL по типу сущности, LRU с ограничением по числу записей,
+    опционально — второй уровень в SQLite (переживает перезапуск, общий для процессов).
+    Одинаковые одновременные запросы склеиваются: в сеть уходит один (single-flight).
+    """
+
+    def __init__(
+        self,
+        ttls: Optional[Dict[str, float]] = None,
+        default_ttl: float = 0,
+        max_entries: int = 5000,
+        sqlite_path: str = "",
+    ):
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.default_ttl = float(default_ttl)
+        self.max_entries = max(1, int(max_entries))
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # key -> (expires_at, json)
+        self._inflight: Dict[str, "Future[str]"] = {}
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0,
+            "coalesced": 0,
+            "sqlite_hits": 0,
+            "bypass": 0,
+        }
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS http_cache (
+                    key TEXT PRIMARY KEY,
+                    expires_at REAL NOT NULL,
+                    body TEXT NOT NULL
+                )
+                """
+            )
+            self._db.commit()
+
+    def ttl_for(self, path: str) -> float:
+        return float(self.ttls.get(entity_type_of(path), self.default_ttl))
+
+    def _count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # ---------------- уровни ----------------
+
+    def _mem_get(self, key: str, now: float) -> Optional[str]:
+        item = self._mem.get(key)
+        if item is None:
+            return None
+        expires_at, body = item
+        if expires_at <= now:
+            del self._mem[key]
+            self._count("expired")
+            return None
+        self._mem.move_to_end(key)
+        return body
+
+    def _mem_put(self, key: str, expires_at: float, body: str) -> None:
+        self._mem[key] = (expires_at, body)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+            self._count("evictions")
+
+    def _db_get(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute("SELECT expires_at, body FROM http_cache WHERE key=?", (key,)).fetchone()
+        if not row or row[0] <= now:
+            return None
+        return float(row[0]), str(row[1])
+
+    def _db_put(self, key: str, expires_at: float, body: str) -> None:
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO http_cache(key, expires_at, body) VALUES (?,?,?)",
+                (key, expires_at, body),
+            )
+            self._db.commit()
+
+    # ---------------- API ----------------
+
+    def get_or_fetch(self, path: str, params: Optional[Dict[str, Any]], fetch: Callable[[], Any]) -> Any:
+        ttl = self.ttl_for(path)
+        if ttl <= 0:
+            with self._lock:
+                self._count("bypass")
+            return fetch()
+
+        key = cache_key(path, params)
+        now = time.time()
+        leader = False
+        with self._lock:
+            body = self._mem_get(key, now)
+            if body is not None:
+                self._count("hits")
+                return json.loads(body)
+            fut = self._inflight.get(key)
+            if fut is None:
+                fut = Future()
+                self._inflight[key] = fut
+                leader = True
+            else:
+                self._count("coalesced")
+
+        if not leader:
+            return json.loads(fut.result())
+
+        try:
+            hit = self._db_get(key, now)
+            if hit is not None:
+                expires_at, body = hit
+                with self._lock:
+                    self._count("sqlite_hits")
+                    self._mem_put(key, expires_at, body)
+            else:
+                value = fetch()
+                body = json.dumps(value, ensure_ascii=False)
+                expires_at = time.time() + ttl
+                with self._lock:
+                    self._count("misses")
+                    self._mem_put(key, expires_at, body)
+                self._db_put(key, expires_at, body)
+            fut.set_result(body)
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        # каждый вызывающий получает свою копию: кэш не портится мутациями
+        return json.loads(body)
+
+    def invalidate(self, path: str) -> int:
+        """Сбросить записи по пути (все параметры), напр. после PUT сущности."""
+        prefix = path + "?"
+        with self._lock:
+            keys = [k for k in self._mem if k.startswith(prefix)]
+            for k in keys:
+                del self._mem[k]
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM http_cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+                self._db.commit()
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM http_cache")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self.counters)
+            out["entries"] = len(self._mem)
+            out["inflight"] = len(self._inflight)
+        lookups = out["hits"] + out["sqlite_hits"] + out["misses"] + out["coalesced"]
+        out["hit_ratio"] = round((out["hits"] + out["sqlite_hits"] + out["coalesced"]) / lookups, 3) if lookups else 0.0
+        return out
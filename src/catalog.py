@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from src.cis_logic import _get_attr_bool
+from src.index_db import IndexDB
+from src.moysklad import MS_EXPAND_PAGE_LIMIT, MS_MAX_PAGE_LIMIT, MoySkladClient, id_from_href, watermark_after_crawl
+
+BUNDLE_EXPAND = "components.assortment"
+# полный список раз в сутки: удалённое в МС дельта по updated не видит
+CATALOG_RECONCILE_S = 24 * 3600
+
+
+def pick_ean13(assortment: Dict[str, Any]) -> str:
+    bcs = assortment.get("barcodes") or []
+    for bc in bcs:
+        if isinstance(bc, dict) and bc.get("ean13"):
+            return str(bc["ean13"])
+    return ""
+
+
+def get_bundle_components(ms: MoySkladClient, bundle_id: str, cache: bool = True) -> List[Dict[str, Any]]:
+    b = ms.get(f"/entity/bundle/{bundle_id}", params={"expand": BUNDLE_EXPAND}, cache=cache)
+    comps = (b.get("components") or {}).get("rows") or []
+    return comps
+
+
+def _ensure_components(ms: MoySkladClient, bundle: Dict[str, Any], cache: bool = True) -> None:
+    # в списке компоненты могут прийти обрезанными — дочитываем комплект целиком
+    comps = bundle.get("components") or {}
+    rows = comps.get("rows")
+    size = (comps.get("meta") or {}).get("size")
+    if not isinstance(rows, list) or (size is not None and len(rows) < int(size)):
+        bundle["components"] = {"rows": get_bundle_components(ms, str(bundle.get("id") or ""), cache=cache)}
+
+
+def fetch_bundles(ms: MoySkladClient, bundle_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Комплекты с компонентами — пачкой (get_many), обрезанные списки компонентов дочитываются поштучно."""
+    bundles = ms.get_many("bundle", bundle_ids, expand=BUNDLE_EXPAND)
+    for b in bundles.values():
+        _ensure_components(ms, b)
+    return bundles
+
+
+def _flag(entity: Dict[str, Any], attr_name: str) -> Optional[int]:
+    v = _get_attr_bool(entity, attr_name) if attr_name else None
+    return None if v is None else int(v)
+
+
+# ---------------- строки зеркала ----------------
+
+def item_row(ent: Dict[str, Any], attr_cis_required: str = "") -> Dict[str, Any]:
+    meta = ent.get("meta") or {}
+    a_type = meta.get("type") or ""
+    product_href = ((ent.get("product") or {}).get("meta") or {}).get("href") or ""
+    return {
+        "id": str(ent.get("id") or id_from_href(meta.get("href") or "")),
+        "type": a_type,
+        "href": meta.get("href"),
+        "product_id": id_from_href(product_href) if a_type == "variant" else None,
+        "code": ent.get("code"),
+        "name": ent.get("name"),
+        "ean13": pick_ean13(ent),
+        # у модификаций своих доп. полей нет — признак берётся от товара при чтении
+        "cis_required": _flag(ent, attr_cis_required) if a_type != "variant" else None,
+        "updated": ent.get("updated"),
+    }
+
+
+def bundle_row(b: Dict[str, Any], attr_cis_required: str = "", bundle_mark_flag: str = "") -> Dict[str, Any]:
+    comps = []
+    for c in (b.get("components") or {}).get("rows") or []:
+        ass = c.get("assortment") or {}
+        meta = ass.get("meta") or {}
+        comps.append(
+            {
+                "assortment_id": id_from_href(meta.get("href") or ""),
+                "assortment_type": meta.get("type"),
+                "assortment_href": meta.get("href"),
+                "code": ass.get("code"),
+                "name": ass.get("name"),
+                "ean13": pick_ean13(ass),
+                "cis_required": _flag(ass, attr_cis_required),
+                "quantity": float(c.get("quantity") or 0),
+            }
+        )
+    return {
+        "id": str(b.get("id") or ""),
+        "href": (b.get("meta") or {}).get("href"),
+        "code": b.get("code"),
+        "name": b.get("name"),
+        "marked": _flag(b, bundle_mark_flag),
+        "updated": b.get("updated"),
+        "components": comps,
+    }
+
+
+def as_bundle(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Строка зеркала → вид комплекта из МС (components.rows[].assortment), как его читает раскрытие заказа."""
+    rows = []
+    for c in row.get("components") or []:
+        rows.append(
+            {
+                "quantity": c.get("quantity"),
+                "cis_required": c.get("cis_required"),
+                "assortment": {
+                    "id": c.get("assortment_id"),
+                    "meta": {"href": c.get("assortment_href"), "type": c.get("assortment_type")},
+                    "code": c.get("code"),
+                    "name": c.get("name"),
+                    "barcodes": [{"ean13": c["ean13"]}] if c.get("ean13") else [],
+                },
+            }
+        )
+    return {"id": row.get("id"), "name": row.get("name"), "marked": row.get("marked"), "components": {"rows": rows}}
+
+
+def load_bundles(
+    ms: MoySkladClient,
+    db: IndexDB,
+    bundle_ids: List[str],
+    attr_cis_required: str = "",
+    bundle_mark_flag: str = "",
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Комплекты для раскрытия заказа из локального зеркала (без запросов в МС).
+    Которых в зеркале ещё нет — одной пачкой из МС, с записью в зеркало.
+    """
+    local = db.catalog_bundles(bundle_ids)
+    missing = [bid for bid in dict.fromkeys(bundle_ids) if bid and bid not in local]
+    if missing:
+        fetched = fetch_bundles(ms, missing)
+        db.catalog_upsert_bundles([bundle_row(b, attr_cis_required, bundle_mark_flag) for b in fetched.values()])
+        local.update(db.catalog_bundles(list(fetched)))
+    return {bid: as_bundle(row) for bid, row in local.items()}
+
+
+# ---------------- правила маркировки ----------------
+
+def assortment_id(ass: Dict[str, Any]) -> str:
+    return str(ass.get("id") or id_from_href((ass.get("meta") or {}).get("href") or ""))
+
+
+def bundle_marked(bundle: Dict[str, Any], bundle_mark_flag: str = "") -> bool:
+    """Комплект помечен маркируемым — тогда КМ нужен на каждый компонент."""
+    if "marked" in bundle:
+        return bool(bundle.get("marked") or False)
+    return bool(_get_attr_bool(bundle, bundle_mark_flag) or False) if bundle_mark_flag else False
+
+
+def resolve_cis_flags(
+    ms: MoySkladClient,
+    db: IndexDB,
+    assortments: List[Dict[str, Any]],
+    attr_cis_required: str,
+    use_catalog: bool = False,
+) -> Dict[str, bool]:
+    """
+    id товара/модификации → нужен ли КМ (доп. поле attr_cis_required; у модификации — от её товара).
+    Порядок: зеркало каталога → доп. поля из уже раскрытого assortment → товары модификаций пачкой из МС.
+    """
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for ass in assortments:
+        i = assortment_id(ass)
+        if i:
+            by_id.setdefault(i, ass)
+
+    out: Dict[str, bool] = {}
+    if use_catalog:
+        for i, row in db.catalog_items(list(by_id)).items():
+            if row.get("cis_required") is not None:
+                out[i] = bool(row["cis_required"])
+
+    variant_product: Dict[str, str] = {}
+    for i, ass in by_id.items():
+        if i in out:
+            continue
+        if (ass.get("meta") or {}).get("type") == "variant":
+            pid = id_from_href(((ass.get("product") or {}).get("meta") or {}).get("href") or "")
+            if pid:
+                variant_product[i] = pid
+            else:
+                out[i] = False
+        else:
+            out[i] = bool(_get_attr_bool(ass, attr_cis_required) or False)
+
+    if variant_product:
+        pids = list(dict.fromkeys(variant_product.values()))
+        products: Dict[str, bool] = {}
+        if use_catalog:
+            for pid, row in db.catalog_items(pids).items():
+                if row.get("cis_required") is not None:
+                    products[pid] = bool(row["cis_required"])
+        missing = [pid for pid in pids if pid not in products]
+        if missing:
+            fetched = ms.get_many("product", missing)
+            if use_catalog:
+                db.catalog_upsert_items([item_row(e, attr_cis_required) for e in fetched.values()])
+            for pid, e in fetched.items():
+                products[pid] = bool(_get_attr_bool(e, attr_cis_required) or False)
+        for vid, pid in variant_product.items():
+            out[vid] = products.get(pid, False)
+    return out
+
+
+# ---------------- синхронизация ----------------
+
+def catalog_source_key(entity: str, attr_cis_required: str = "", bundle_mark_flag: str = "") -> str:
+    # признаки зависят от настроек: сменили имя атрибута — новый источник, полная перезагрузка
+    return f"catalog:{entity}:{attr_cis_required}:{bundle_mark_flag}"
+
+
+def _sync_entity(
+    ms: MoySkladClient,
+    db: IndexDB,
+    entity: str,
+    source: str,
+    write: Callable[[List[Dict[str, Any]]], int],
+    expand: str = "",
+    full: bool = False,
+    reconcile_s: float = CATALOG_RECONCILE_S,
+) -> int:
+    """
+    Дельта по updated (с архивными — их убираем из зеркала) или, если пора сверку, полный список:
+    после него из зеркала удаляется всё, чего в МС больше нет. Полный список заодно подбирает строки,
+    пропущенные дельтой (offset-страницы сдвигаются, если сущность правят во время обхода).
+    """
+    reconciled_key = f"{source}:reconciled"
+    last_reconcile = float(db.get_watermark(reconciled_key) or 0)
+    reconcile = full or time.time() - last_reconcile >= float(reconcile_s)
+    watermark = "" if reconcile else db.get_watermark(source)
+    # стабильный порядок для offset-страниц: по updated, при равных — по id
+    params: Dict[str, Any] = {"order": "updated,asc;id"}
+    if expand:
+        params["expand"] = expand
+    if watermark:
+        params["filter"] = f"updated>={watermark[:19]};archived=true;archived=false"
+    t0 = time.monotonic()
+    newest = watermark
+    seen: List[str] = []
+    n = 0
+    page_size = MS_EXPAND_PAGE_LIMIT if expand else MS_MAX_PAGE_LIMIT
+    # мимо кэша ответов: при неподвижном watermark ключ тот же, и дельта часами отдавала бы старые страницы
+    for rows in ms.iter_pages(f"/entity/{entity}", params, page_size=page_size, cache=False):
+        archived = [str(r.get("id") or "") for r in rows if r.get("archived")]
+        if archived:
+            db.catalog_delete(entity, archived)
+        live = [r for r in rows if not r.get("archived")]
+        n += write(live)
+        seen.extend(str(r.get("id") or "") for r in live)
+        for r in rows:
+            u = str(r.get("updated") or "")
+            if u > newest:
+                newest = u
+    # watermark и сверка — только после полностью прочитанного списка
+    if reconcile:
+        db.catalog_retain(entity, seen)
+        db.set_watermark(reconciled_key, str(int(time.time())))
+    db.set_watermark(source, watermark_after_crawl(newest, watermark, time.monotonic() - t0))
+    return n
+
+
+def sync_catalog(
+    ms: MoySkladClient,
+    db: IndexDB,
+    attr_cis_required: str = "",
+    bundle_mark_flag: str = "",
+    full: bool = False,
+    reconcile_s: float = CATALOG_RECONCILE_S,
+) -> Dict[str, int]:
+    """
+    Зеркало каталога: товары, модификации и комплекты (компоненты уже раскрыты).
+    Первый проход — полная загрузка, дальше — только изменённые с прошлого раза (updated>=);
+    раз в reconcile_s — снова полный список со сверкой удалённых.
+    """
+
+    def write_items(rows: List[Dict[str, Any]]) -> int:
+        return db.catalog_upsert_items([item_row(r, attr_cis_required) for r in rows])
+
+    def write_bundles(rows: List[Dict[str, Any]]) -> int:
+        for b in rows:
+            # комплект изменился — его закэшированная копия устарела
+            _ensure_components(ms, b, cache=False)
+        return db.catalog_upsert_bundles([bundle_row(b, attr_cis_required, bundle_mark_flag) for b in rows])
+
+    stats: Dict[str, int] = {}
+    for entity in ("product", "variant"):
+        stats[entity] = _sync_entity(
+            ms,
+            db,
+            entity,
+            catalog_source_key(entity, attr_cis_required),
+            write_items,
+            full=full,
+            reconcile_s=reconcile_s,
+        )
+    stats["bundle"] = _sync_entity(
+        ms,
+        db,
+        "bundle",
+        catalog_source_key("bundle", attr_cis_required, bundle_mark_flag),
+        write_bundles,
+        expand=BUNDLE_EXPAND,
+        full=full,
+        reconcile_s=reconcile_s,
+    )
+    return stats
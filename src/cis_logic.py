@@ -1,5 +1,7 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 import re
 
 CIS_BLOCK_RE = re.compile(r"\[CIS\].*?\[/CIS\]", re.S)
@@ -32,10 +34,12 @@ def normalize_codes(raw_text: str) -> Tuple[List[str], List[str]]:
     uniq = []
     dups = []
     for ln in lines:
-        if ln in seen:
+        # один и тот же КМ может прийти с GS и без — сравниваем по GTIN+серийнику
+        key = parse_gs1(ln).key
+        if key in seen:
             dups.append(ln)
         else:
-            seen.add(ln)
+            seen.add(key)
             uniq.append(ln)
     return uniq, dups
 
@@ -49,3 +53,266 @@ def soft_validate_datamatrix(code: str) -> List[str]:
     if len(c) < 25:
         warnings.append("слишком короткий для типичного DataMatrix GS1")
     return warnings
+
+# ---------------- GS1 DataMatrix ----------------
+
+GS = "\x1d"
+# как сканеры/клавиатурные эмуляторы передают FNC1 внутри кода
+_GS_ALIASES = ("<GS>", "\\u001d", "\\x1d", "{GS}", "\u241d")
+# символьный идентификатор DataMatrix (]d2) и FNC1 в начале
+_SYMBOLOGY_PREFIXES = ("]d2", "]D2", "]C1", "]Q3")
+
+# AI -> (длина, фиксированная?)  — для переменных: максимальная длина
+GS1_AIS: Dict[str, Tuple[int, bool]] = {
+    "01": (14, True),    # GTIN
+    "02": (14, True),
+    "11": (6, True),
+    "17": (6, True),     # срок годности
+    "3103": (6, True),   # вес нетто (молочка, вода)
+    "7003": (10, True),
+    "8005": (6, True),   # МРЦ (табак)
+    "10": (20, False),   # партия
+    "21": (20, False),   # серийный номер
+    "240": (30, False),
+    "91": (90, False),   # ключ проверки (ЧЗ — 4 символа)
+    "92": (90, False),   # код проверки (ЧЗ — 44 или 88 символов)
+    "93": (90, False),   # код проверки (ЧЗ — 4 символа)
+}
+# типичные длины переменных полей Честного знака — для кодов, где GS потерян
+_CZ_VAR_LENGTHS: Dict[str, Tuple[int, ...]] = {
+    "21": (13, 6, 7, 8, 11, 12, 20),
+    "91": (4,),
+    "92": (44, 88),
+    "93": (4,),
+    "10": (),
+    "240": (),
+}
+
+def gtin_check_digit_ok(gtin: str) -> bool:
+    """Контрольная цифра GS1 (mod 10) для GTIN-8/12/13/14."""
+    if not gtin.isdigit() or len(gtin) not in (8, 12, 13, 14):
+        return False
+    digits = [int(c) for c in gtin]
+    body, check = digits[:-1], digits[-1]
+    total = sum(d * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(body)))
+    return (10 - total % 10) % 10 == check
+
+def gtin14(value: str) -> str:
+    """EAN-13 / GTIN-12/13 → GTIN-14 (как в AI 01)."""
+    v = (value or "").strip()
+    return v.zfill(14) if v.isdigit() and len(v) <= 14 else ""
+
+@dataclass
+class DataMatrixCode:
+    raw: str
+    ais: Dict[str, str] = field(default_factory=dict)
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def gtin(self) -> str:
+        return self.ais.get("01", "")
+
+    @property
+    def serial(self) -> str:
+        return self.ais.get("21", "")
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    @property
+    def key(self) -> str:
+        """Идентичность КМ — GTIN + серийный номер (крипто-хвост и разделители не важны)."""
+        if self.gtin and self.serial:
+            return f"01{self.gtin}21{self.serial}"
+        return self.raw.replace(GS, "")
+
+def _match_ai(s: str, pos: int) -> str:
+    for n in (2, 3, 4):
+        ai = s[pos : pos + n]
+        if ai in GS1_AIS:
+            return ai
+    return ""
+
+def _parse_elements(s: str, pos: int, out: Dict[str, str], depth: int = 0) -> bool:
+    """Разбор element string с позиции pos. Без GS переменные поля подбираются по типичным длинам ЧЗ."""
+    if pos >= len(s):
+        return True
+    if s[pos] == GS:
+        return _parse_elements(s, pos + 1, out, depth)
+    ai = _match_ai(s, pos)
+    if not ai or ai in out or depth > 12:
+        return False
+    size, fixed = GS1_AIS[ai]
+    start = pos + len(ai)
+
+    if fixed:
+        value = s[start : start + size]
+        if len(value) != size or GS in value:
+            return False
+        out[ai] = value
+        if _parse_elements(s, start + size, out, depth + 1):
+            return True
+        del out[ai]
+        return False
+
+    gs_at = s.find(GS, start)
+    if gs_at != -1:
+        value = s[start:gs_at]
+        if not value or len(value) > size:
+            return False
+        out[ai] = value
+        if _parse_elements(s, gs_at + 1, out, depth + 1):
+            return True
+        del out[ai]
+        return False
+
+    # GS нет: либо поле до конца строки, либо одна из типичных длин, за которой идёт следующий AI
+    rest = len(s) - start
+    candidates = [n for n in _CZ_VAR_LENGTHS.get(ai, ()) if n < rest]
+    for n in candidates:
+        out[ai] = s[start : start + n]
+        if _match_ai(s, start + n) and _parse_elements(s, start + n, out, depth + 1):
+            return True
+        del out[ai]
+    if 0 < rest <= size:
+        out[ai] = s[start:]
+        return True
+    return False
+
+def _clean_code(code: str) -> str:
+    c = (code or "").strip()
+    for alias in _GS_ALIASES:
+        c = c.replace(alias, GS)
+    for prefix in _SYMBOLOGY_PREFIXES:
+        if c.startswith(prefix):
+            c = c[len(prefix) :]
+            break
+    return c.lstrip(GS).rstrip(GS)
+
+def parse_gs1(code: str) -> DataMatrixCode:
+    """Разбор кода маркировки (GS1 DataMatrix): AI 01/21/91/92/93 и др., разделители FNC1/GS, контрольная цифра GTIN."""
+    c = _clean_code(code)
+    res = DataMatrixCode(raw=c)
+    if not c:
+        res.errors.append("пустой код")
+        return res
+    ais: Dict[str, str] = {}
+    if not _parse_elements(c, 0, ais):
+        res.errors.append("не удалось разобрать как GS1 (AI/разделители)")
+        # хотя бы GTIN — чтобы сопоставить со строкой заказа
+        if c.startswith("01") and c[2:16].isdigit() and len(c) >= 16:
+            ais = {"01": c[2:16]}
+    res.ais = ais
+    if not res.gtin:
+        res.errors.append("нет GTIN (AI 01)")
+    elif not gtin_check_digit_ok(res.gtin):
+        res.errors.append("неверная контрольная цифра GTIN")
+    if "21" not in ais and not res.errors:
+        res.errors.append("нет серийного номера (AI 21)")
+    return res
+
+def parse_gs1_many(codes: Iterable[str]) -> List[DataMatrixCode]:
+    return [parse_gs1(c) for c in codes]
+
+class LineMatcher:
+    """
+    Сопоставление КМ со строками раскрытого заказа по GTIN (из exploded_positions.ean13).
+    Индекс GTIN → строки строится один раз, каждый скан — O(1); считает прогресс по строкам.
+    Строки без EAN принимают коды, GTIN которых не нашёлся ни в одной строке (без проверки товара).
+    Строки, где КМ не нужен (cis_units=0), в сопоставлении не участвуют.
+    """
+
+    def __init__(self, positions: List[Dict[str, Any]]):
+        self.lines: Dict[int, Dict[str, Any]] = {}
+        self.by_gtin: Dict[str, List[int]] = {}
+        self.no_ean: List[int] = []
+        self.scanned: Dict[int, int] = {}
+        self.code_line: Dict[str, int] = {}
+        for i, p in enumerate(positions, start=1):
+            line_no = int(p.get("line_no") or i)
+            # cis_units — сколько КМ по строке (правила маркировки при индексации); строки без КМ не участвуют
+            units = p.get("cis_units")
+            need = int(round(float(p.get("quantity") or 0 if units is None else units)))
+            if need <= 0:
+                continue
+            self.lines[line_no] = {"line_no": line_no, "name": p.get("name"), "ean13": p.get("ean13") or "", "need": need}
+            self.scanned[line_no] = 0
+            g = gtin14(p.get("ean13") or "")
+            if g:
+                self.by_gtin.setdefault(g, []).append(line_no)
+            else:
+                self.no_ean.append(line_no)
+
+    def _free_line(self, candidates: List[int]) -> Optional[int]:
+        for ln in candidates:
+            if self.scanned[ln] < self.lines[ln]["need"]:
+                return ln
+        return None
+
+    def add(self, code: str, parsed: Optional[DataMatrixCode] = None) -> Tuple[Optional[int], str]:
+        """(line_no, "") — засчитан; (None, причина) — отклонён."""
+        parsed = parsed or parse_gs1(code)
+        if not parsed.gtin:
+            return None, "; ".join(parsed.errors) or "нет GTIN"
+        lines = self.by_gtin.get(parsed.gtin)
+        if lines:
+            ln = self._free_line(lines)
+            if ln is None:
+                return None, f"лишний КМ: по «{self.lines[lines[0]]['name']}» уже всё отсканировано"
+        else:
+            ln = self._free_line(self.no_ean)
+            if ln is None:
+                return None, f"товар с GTIN {parsed.gtin} не из этого заказа"
+        self.scanned[ln] += 1
+        self.code_line[code] = ln
+        return ln, ""
+
+    def add_many(self, codes: Iterable[str]) -> List[Tuple[str, Optional[int], str]]:
+        return [(c, *self.add(c)) for c in codes]
+
+    def remove(self, code: str) -> None:
+        ln = self.code_line.pop(code, None)
+        if ln is not None:
+            self.scanned[ln] -= 1
+
+    def progress(self) -> List[Dict[str, Any]]:
+        return [dict(line, scanned=self.scanned[ln]) for ln, line in self.lines.items()]
+
+class ScanSet:
+    """Коды сессии в порядке скана: ключ КМ -> код как отсканирован. Проверка, добавление и отмена — O(1)."""
+
+    def __init__(self) -> None:
+        self._items: Dict[str, str] = {}
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def add(self, key: str, code: str) -> bool:
+        if key in self._items:
+            return False
+        self._items[key] = code
+        return True
+
+    def pop(self) -> Optional[Tuple[str, str]]:
+        """Убрать последний скан: (ключ, код) или None."""
+        return self._items.popitem() if self._items else None
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def keys(self) -> List[str]:
+        return list(self._items)
+
+    def codes(self) -> List[str]:
+        return list(self._items.values())
+
+    def tail(self, n: int) -> List[str]:
+        """Последние n кодов (новые сверху) — без прохода по всему списку."""
+        return list(islice(reversed(self._items.values()), max(0, n)))
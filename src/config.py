@@ -1,5 +1,10 @@
+import os
+from typing import Optional
+
 from pydantic import BaseModel, Field
 
+from src.cache import ResponseCache
+
 class Settings(BaseModel):
     MS_BASE_URL: str = Field(default="https://api.moysklad.ru/api/remap/1.2")
     MS_TOKEN: str
@@ -7,7 +12,52 @@ class Settings(BaseModel):
     MS_BUNDLE_MARK_FLAG: str = Field(default="Комплект_маркируемый")
     MAX_COMPONENT_FETCH: int = Field(default=200)
     MS_ORDER_QR_ATTR_NAME: str = Field(default="ШККОД128")
+    MS_ORDER_QR_ATTR_ID: str = Field(default="687d964c-5a22-11ee-0a80-032800443111")
+    MS_PACKING_STATE_HREF: str = Field(default="")
+
+    # кэш GET-ответов МС (каталог: комплекты, товары, метаданные)
+    MS_CACHE: bool = Field(default=False)
+    MS_CACHE_MAX_ENTRIES: int = Field(default=5000)
+    MS_CACHE_SQLITE: str = Field(default="")  # напр. data/http_cache.sqlite — общий кэш между процессами
+
+    # фоновый индексатор (python -m src.indexer --loop)
+    INDEX_DB_PATH: str = Field(default="data/index.sqlite")
+    INDEX_INTERVAL_S: int = Field(default=600)
+    DATE_FROM: str = Field(default="")
+    MAX_TOTAL: int = Field(default=4000)
+    PAGE_LIMIT: int = Field(default=1000)  # максимум МС; с expand клиент сам ограничит до 100
+    # retention: обработанные заказы старше N дней удаляются (или уходят в orders_archive)
+    INDEX_RETENTION_DAYS: int = Field(default=14)
+    INDEX_ARCHIVE: bool = Field(default=False)
+    INDEX_PRUNE_EVERY: int = Field(default=6)  # очистка раз в N проходов индексатора, 0 — выключено
+    # локальное зеркало каталога (товары, модификации, комплекты) в INDEX_DB_PATH, обновляется дельтой по updated
+    CATALOG_MIRROR: bool = Field(default=True)
+    CATALOG_RECONCILE_S: int = Field(default=86400)  # полный список каталога со сверкой удалённых раз в N секунд
+    # lease: из нескольких реплик индексатора на одном index.sqlite индексирует одна
+    INDEX_LEASE_TTL_S: int = Field(default=60)
+
+    # метрики HTTP и стадий индексации в формате Prometheus (файл перезаписывается после каждого прохода)
+    METRICS_PATH: str = Field(default="")  # напр. data/metrics.prom
+
+    # профилирование проходов индексатора: pstats + collapsed stacks + сводка в PROFILE_DIR
+    PROFILE_DIR: str = Field(default="data/profiles")
+    PROFILE_INDEXING: int = Field(default=0)  # профилировать первые N проходов после старта
+
+    # приёмник вебхуков (python -m src.webhook serve)
+    WEBHOOK_HOST: str = Field(default="127.0.0.1")
+    WEBHOOK_PORT: int = Field(default=8085)
+    WEBHOOK_TOKEN: str = Field(default="")
+    WEBHOOK_QUEUE_SIZE: int = Field(default=1000)
 
     def ms_auth_header(self) -> str:
         t = self.MS_TOKEN.strip()
         return t if t.lower().startswith("bearer ") else f"Bearer {t}"
+
+    def make_cache(self) -> Optional[ResponseCache]:
+        if not self.MS_CACHE:
+            return None
+        return ResponseCache(max_entries=self.MS_CACHE_MAX_ENTRIES, sqlite_path=self.MS_CACHE_SQLITE)
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(**{k: os.environ[k] for k in cls.model_fields if k in os.environ})
@@ -1,5 +1,17 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Mapping, Optional, Tuple, Union
+
 import requests
-from typing import Any, Dict, Optional
+from requests.adapters import HTTPAdapter
+
+from src.metrics import HttpMetrics, endpoint_template
+
+Timeout = Union[float, Tuple[float, float]]
+
 
 class HttpError(RuntimeError):
     def __init__(self, status: int, payload: Any):
@@ -7,23 +19,238 @@ class HttpError(RuntimeError):
         self.status = status
         self.payload = payload
 
+
+def _should_retry_http(status: int) -> bool:
+    return status in (429, 500, 502, 503, 504)
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    v = headers.get(name)
+    if v is None:
+        return None
+    try:
+        return float(str(v).strip())
+    except ValueError:
+        return None
+
+
+def _wire_bytes(resp: requests.Response) -> int:
+    """
+    Принято байт по сети (до распаковки gzip): счётчик urllib3 → Content-Length → длина тела.
+    Chunked-ответ urllib3 читает мимо счётчика, а Content-Length у него нет — тогда остаётся длина тела.
+    """
+    try:
+        n = resp.raw.tell() if resp.raw is not None else 0
+    except Exception:
+        n = 0
+    if n:
+        return int(n)
+    length = _header_float(resp.headers, "Content-Length")
+    if length is not None:
+        return int(length)
+    return len(resp.content or b"")
+
+
+class RateLimiter:
+    """
+    Лимиты МС на аккаунт: token bucket (N запросов за окно) + не больше K параллельных запросов.
+    Подстраивается по ответам: X-RateLimit-Remaining, X-Lognex-Retry-After / X-Lognex-Retry-TimeInterval (мс).
+    """
+
+    def __init__(self, rate: int = 45, window_s: float = 3.0, max_parallel: int = 5):
+        self.capacity = float(max(1, rate))
+        self.refill_per_s = self.capacity / max(0.001, float(window_s))
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._sem = threading.BoundedSemaphore(max(1, int(max_parallel)))
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.refill_per_s)
+        self._ts = now
+
+    def _take(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait = (1.0 - self._tokens) / self.refill_per_s
+            time.sleep(wait)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self._sem.acquire()
+        try:
+            self._take()
+            yield
+        finally:
+            self._sem.release()
+
+    def feedback(self, status: int, headers: Mapping[str, str]) -> None:
+        remaining = _header_float(headers, "X-RateLimit-Remaining")
+        retry_after_ms = _header_float(headers, "X-Lognex-Retry-After")
+        if retry_after_ms is None and status == 429:
+            retry_after_ms = _header_float(headers, "X-Lognex-Retry-TimeInterval") or 1000.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining is not None:
+                # сервер знает точнее: у нас не может остаться больше, чем у него
+                self._tokens = min(self._tokens, max(0.0, remaining))
+            if retry_after_ms is not None and retry_after_ms > 0:
+                self._blocked_until = max(self._blocked_until, now + retry_after_ms / 1000.0)
+
+
+class HttpTransport:
+    """
+    Единый HTTP-слой: keep-alive сессия с пулом соединений, заранее собранные заголовки,
+    gzip, одна политика ретраев и таймаутов.
+    """
+
+    def __init__(
+        self,
+        headers: Optional[Dict[str, str]] = None,
+        pool_connections: int = 4,
+        pool_maxsize: int = 10,
+        timeout: Timeout = (20.0, 90.0),  # (connect, read)
+        max_retries: int = 4,
+        limiter: Optional[RateLimiter] = None,
+        metrics: Optional[HttpMetrics] = None,
+    ):
+        self.timeout = timeout
+        self.max_retries = max(1, int(max_retries))
+        self.limiter = limiter
+        self.metrics = metrics if metrics is not None else HttpMetrics()
+
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip"})
+        self.session.headers.update(headers or {})
+        # ретраи делаем сами (ниже), у адаптера — только пул
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _send(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[Dict[str, str]],
+        params: Optional[Dict[str, Any]],
+        json: Any,
+        timeout: Timeout,
+    ) -> requests.Response:
+        if self.limiter is None:
+            return self._timed(method, url, headers, params, json, timeout)
+        with self.limiter.slot():
+            resp = self._timed(method, url, headers, params, json, timeout)
+        self.limiter.feedback(resp.status_code, resp.headers)
+        return resp
+
+    def _timed(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[Dict[str, str]],
+        params: Optional[Dict[str, Any]],
+        json: Any,
+        timeout: Timeout,
+    ) -> requests.Response:
+        # время — только сам запрос (без ожидания в limiter), чтобы видеть задержки МС, а не наши очереди
+        endpoint = endpoint_template(url)
+        t0 = time.perf_counter()
+        try:
+            resp = self.session.request(method, url, headers=headers, params=params, json=json, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            self.metrics.observe_failure(endpoint, timeout=isinstance(e, requests.exceptions.Timeout))
+            raise
+        body = resp.request.body if resp.request is not None else None
+        self.metrics.observe_response(
+            method,
+            endpoint,
+            resp.status_code,
+            time.perf_counter() - t0,
+            bytes_in=_wire_bytes(resp),
+            bytes_out=len(body) if body else 0,
+        )
+        return resp
+
+    def request_json(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        params: Optional[Dict[str, Any]] = None,
+        json: Any = None,
+        timeout: Optional[Timeout] = None,
+        max_retries: Optional[int] = None,
+    ) -> Any:
+        timeout = self.timeout if timeout is None else timeout
+        max_retries = self.max_retries if max_retries is None else max(1, int(max_retries))
+        last_exc: Optional[Exception] = None
+
+        for attempt in range(1, max_retries + 1):
+            try:
+                resp = self._send(method, url, headers, params, json, timeout)
+
+                if resp.status_code >= 400:
+                    try:
+                        payload = resp.json()
+                    except Exception:
+                        payload = resp.text
+
+                    if _should_retry_http(resp.status_code) and attempt < max_retries:
+                        self.metrics.observe_retry(endpoint_template(url))
+                        # на 429 паузу держит limiter (Retry-After), свой sleep не нужен
+                        if not (self.limiter is not None and resp.status_code == 429):
+                            time.sleep(min(2.0, 0.4 * (2 ** (attempt - 1))))
+                        continue
+
+                    raise HttpError(resp.status_code, payload)
+
+                if resp.status_code == 204 or not resp.content.strip():
+                    return None
+                return resp.json()
+
+            except requests.exceptions.RequestException as e:
+                last_exc = e
+                if attempt < max_retries:
+                    self.metrics.observe_retry(endpoint_template(url))
+                    time.sleep(min(2.0, 0.4 * (2 ** (attempt - 1))))
+                    continue
+                raise
+
+        if last_exc:
+            raise last_exc
+        raise RuntimeError("request_json failed unexpectedly")
+
+
+_default_transport: Optional[HttpTransport] = None
+_default_lock = threading.Lock()
+
+
+def default_transport() -> HttpTransport:
+    """Общий транспорт процесса для вызовов без клиента."""
+    global _default_transport
+    with _default_lock:
+        if _default_transport is None:
+            _default_transport = HttpTransport()
+        return _default_transport
+
+
 def request_json(
     method: str,
     url: str,
     headers: Dict[str, str],
     params: Optional[Dict[str, Any]] = None,
     json_body: Optional[Dict[str, Any]] = None,
-    timeout: int = 60,
+    timeout: Timeout = 60,
+    transport: Optional[HttpTransport] = None,
 ) -> Any:
-    resp = requests.request(method, url, headers=headers, params=params, json=json_body, timeout=timeout)
-    if resp.status_code >= 400:
-        try:
-            payload = resp.json()
-        except Exception:
-            payload = resp.text
-        raise HttpError(resp.status_code, payload)
-    if resp.status_code == 204:
-        return None
-    if resp.text.strip() == "":
-        return None
-    return resp.json()
+    t = transport or default_transport()
+    return t.request_json(method, url, headers=headers, params=params, json=json_body, timeout=timeout)
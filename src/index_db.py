@@ -1,24 +1,109 @@
 from __future__ import annotations
 
+import json
 import sqlite3
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
-from datetime import datetime
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
 
 
 def _utcnow_iso() -> str:
     return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
 
 
+_UPSERT_ORDER_SQL = """
+    INSERT INTO orders_index(
+        barcode128, order_id, order_name, moment, expected_units, cis_units, done, done_at, ms_updated, updated_at
+    )
+    VALUES(?,?,?,?,?,?,?,NULL,?,?)
+    ON CONFLICT(barcode128) DO UPDATE SET
+        order_id=excluded.order_id,
+        order_name=excluded.order_name,
+        moment=excluded.moment,
+        expected_units=excluded.expected_units,
+        cis_units=excluded.cis_units,
+        -- пока [CIS] по заказу ждёт отправки в outbox, переиндексация не возвращает его в список
+        done=CASE
+            WHEN EXISTS (SELECT 1 FROM cis_outbox o WHERE o.barcode128=excluded.barcode128 AND o.status!='sent')
+            THEN orders_index.done ELSE excluded.done
+        END,
+        ms_updated=excluded.ms_updated,
+        updated_at=excluded.updated_at
+"""
+
+_INSERT_POSITION_SQL = """
+    INSERT INTO exploded_positions(
+        barcode128, line_no, assortment_href, assortment_type, code, name, ean13, quantity, need_cis, cis_units
+    ) VALUES (?,?,?,?,?,?,?,?,?,?)
+"""
+
+
+def _order_row(rec: Dict[str, Any], now: str) -> Tuple[Any, ...]:
+    return (
+        rec["barcode128"],
+        rec.get("order_id") or "",
+        rec.get("order_name") or "",
+        rec.get("moment") or "",
+        float(rec.get("expected_units") or 0),
+        None if rec.get("cis_units") is None else float(rec["cis_units"]),
+        int(rec.get("done") or 0),
+        rec.get("ms_updated") or None,
+        now,
+    )
+
+
+def _position_rows(barcode128: str, positions: List[Dict[str, Any]]) -> List[Tuple[Any, ...]]:
+    return [
+        (
+            barcode128,
+            i,
+            p.get("assortment_href"),
+            p.get("assortment_type"),
+            p.get("code"),
+            p.get("name"),
+            p.get("ean13"),
+            float(p.get("quantity", 0) or 0),
+            None if p.get("need_cis") is None else int(bool(p["need_cis"])),
+            None if p.get("cis_units") is None else float(p["cis_units"]),
+        )
+        for i, p in enumerate(positions, start=1)
+    ]
+
+
 @dataclass
 class IndexDB:
     path: str = "data/index.sqlite"
+    # 20 МБ page cache на соединение (отрицательное значение — в КиБ)
+    cache_size_kib: int = 20000
+
+    _local: threading.local = field(default_factory=threading.local, init=False, repr=False)
 
     def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.path, timeout=30)
-        conn.row_factory = sqlite3.Row
+        """
+        Одно соединение на поток (переиспользуется между вызовами).
+        WAL: читатели (сканы на станциях) не ждут писателя (индексатор).
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
         return conn
 
+    def close(self) -> None:
+        """Закрыть соединение текущего потока."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
     def _ensure_column(self, conn: sqlite3.Connection, table: str, col: str, ddl: str) -> None:
         cols = [r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
         if col not in cols:
@@ -34,8 +119,10 @@ class IndexDB:
                     order_name TEXT NOT NULL,
                     moment TEXT,
                     expected_units REAL DEFAULT 0,
+                    cis_units REAL,
                     done INTEGER DEFAULT 0,
                     done_at TEXT,
+                    ms_updated TEXT,
                     updated_at TEXT NOT NULL
                 )
                 """
@@ -51,19 +138,200 @@ class IndexDB:
                     name TEXT,
                     ean13 TEXT,
                     quantity REAL NOT NULL,
+                    need_cis INTEGER,
+                    cis_units REAL,
                     PRIMARY KEY (barcode128, line_no)
                 )
                 """
             )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS orders_archive (
+                    barcode128 TEXT PRIMARY KEY,
+                    order_id TEXT NOT NULL,
+                    order_name TEXT NOT NULL,
+                    moment TEXT,
+                    expected_units REAL DEFAULT 0,
+                    done_at TEXT,
+                    archived_at TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    acquired_at REAL NOT NULL,
+                    heartbeat_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+            # выданные коды маркировки: один код — один заказ. Retention их не трогает.
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cis_codes (
+                    code TEXT PRIMARY KEY,
+                    barcode128 TEXT NOT NULL,
+                    order_id TEXT,
+                    created_at TEXT NOT NULL
+                ) WITHOUT ROWID
+                """
+            )
+            # зеркало каталога МС: товары/модификации, комплекты с уже раскрытыми компонентами
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS catalog_items (
+                    id TEXT PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    href TEXT,
+                    product_id TEXT,
+                    code TEXT,
+                    name TEXT,
+                    ean13 TEXT,
+                    cis_required INTEGER,
+                    updated TEXT
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS catalog_bundles (
+                    id TEXT PRIMARY KEY,
+                    href TEXT,
+                    code TEXT,
+                    name TEXT,
+                    marked INTEGER,
+                    updated TEXT
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS catalog_bundle_components (
+                    bundle_id TEXT NOT NULL,
+                    line_no INTEGER NOT NULL,
+                    assortment_id TEXT,
+                    assortment_type TEXT,
+                    assortment_href TEXT,
+                    code TEXT,
+                    name TEXT,
+                    ean13 TEXT,
+                    cis_required INTEGER,
+                    quantity REAL NOT NULL,
+                    PRIMARY KEY (bundle_id, line_no)
+                ) WITHOUT ROWID
+                """
+            )
+            # outbox: блоки [CIS], записанные локально и ещё не доставленные в МС
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cis_outbox (
+                    barcode128 TEXT PRIMARY KEY,
+                    order_id TEXT NOT NULL,
+                    codes TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    claimed_by TEXT,
+                    claimed_until REAL,
+                    last_error TEXT,
+                    created_at TEXT NOT NULL,
+                    sent_at TEXT
+                )
+                """
+            )
+            # журнал сканов станции: только INSERT (add / undo / clear), переживает перезагрузку страницы
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS scan_journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    station TEXT NOT NULL,
+                    barcode128 TEXT NOT NULL,
+                    op TEXT NOT NULL,
+                    code_key TEXT,
+                    code TEXT,
+                    created_at TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    source TEXT PRIMARY KEY,
+                    watermark TEXT,
+                    updated_at TEXT NOT NULL
+                )
+                """
+            )
 
             # миграции на всякий случай (если таблица уже была старой)
             self._ensure_column(conn, "orders_index", "expected_units", "expected_units REAL DEFAULT 0")
             self._ensure_column(conn, "orders_index", "done", "done INTEGER DEFAULT 0")
             self._ensure_column(conn, "orders_index", "done_at", "done_at TEXT")
+            self._ensure_column(conn, "orders_index", "ms_updated", "ms_updated TEXT")
+            # сколько КМ нужно по заказу/строке (правила маркировки применены при индексации); NULL — старая запись
+            self._ensure_column(conn, "orders_index", "cis_units", "cis_units REAL")
+            self._ensure_column(conn, "exploded_positions", "need_cis", "need_cis INTEGER")
+            self._ensure_column(conn, "exploded_positions", "cis_units", "cis_units REAL")
+            self._ensure_column(conn, "sync_state", "last_run_at", "last_run_at TEXT")
+            self._ensure_column(conn, "sync_state", "last_ok", "last_ok INTEGER")
+            self._ensure_column(conn, "sync_state", "last_stats", "last_stats TEXT")
+            self._ensure_column(conn, "sync_state", "last_error", "last_error TEXT")
+            self._ensure_column(conn, "sync_state", "sync_requested_at", "sync_requested_at TEXT")
+            self._ensure_column(conn, "sync_state", "profile_requested_at", "profile_requested_at TEXT")
 
             conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_id ON orders_index(order_id)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_done ON orders_index(done)")
+            # покрывающий индекс под list_open_orders: WHERE done=0 ORDER BY moment DESC — только по индексу
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_orders_done_moment
+                ON orders_index(done, moment, barcode128, order_id, order_name, expected_units, updated_at)
+                """
+            )
+            conn.execute("DROP INDEX IF EXISTS idx_orders_done")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_positions_barcode ON exploded_positions(barcode128)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_station ON scan_journal(station, barcode128, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON cis_outbox(status, next_attempt_at)")
+
+            # счётчик ревизий: любая запись в orders_index получает новый rev (триггеры), удаление — tombstone.
+            # По нему HotOrderMap догружает только изменения.
+            self._ensure_column(conn, "orders_index", "rev", "rev INTEGER DEFAULT 0")
+            conn.execute("CREATE TABLE IF NOT EXISTS index_rev (id INTEGER PRIMARY KEY CHECK (id=1), rev INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO index_rev(id, rev) VALUES (1, 0)")
+            conn.execute("CREATE TABLE IF NOT EXISTS orders_tombstones (barcode128 TEXT PRIMARY KEY, rev INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_rev ON orders_index(rev)")
+            conn.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS trg_orders_rev_ins AFTER INSERT ON orders_index
+                BEGIN
+                    UPDATE index_rev SET rev=rev+1 WHERE id=1;
+                    UPDATE orders_index SET rev=(SELECT rev FROM index_rev WHERE id=1) WHERE barcode128=NEW.barcode128;
+                    DELETE FROM orders_tombstones WHERE barcode128=NEW.barcode128;
+                END
+                """
+            )
+            conn.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS trg_orders_rev_upd AFTER UPDATE ON orders_index
+                WHEN NEW.rev IS OLD.rev
+                BEGIN
+                    UPDATE index_rev SET rev=rev+1 WHERE id=1;
+                    UPDATE orders_index SET rev=(SELECT rev FROM index_rev WHERE id=1) WHERE barcode128=NEW.barcode128;
+                END
+                """
+            )
+            conn.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS trg_orders_rev_del AFTER DELETE ON orders_index
+                BEGIN
+                    UPDATE index_rev SET rev=rev+1 WHERE id=1;
+                    INSERT OR REPLACE INTO orders_tombstones(barcode128, rev)
+                    VALUES (OLD.barcode128, (SELECT rev FROM index_rev WHERE id=1));
+                END
+                """
+            )
             conn.commit()
 
     def upsert_order(
@@ -74,27 +342,25 @@ class IndexDB:
         moment: str = "",
         expected_units: float = 0.0,
         done: int = 0,
+        ms_updated: str = "",
+        cis_units: Optional[float] = None,
     ) -> None:
         barcode128 = (barcode128 or "").strip()
         if not barcode128:
             return
 
+        rec = {
+            "barcode128": barcode128,
+            "order_id": order_id,
+            "order_name": order_name,
+            "moment": moment,
+            "expected_units": expected_units,
+            "cis_units": cis_units,
+            "done": done,
+            "ms_updated": ms_updated,
+        }
         with self._connect() as conn:
-            conn.execute(
-                """
-                INSERT INTO orders_index(barcode128, order_id, order_name, moment, expected_units, done, done_at, updated_at)
-                VALUES(?,?,?,?,?,?,NULL,?)
-                ON CONFLICT(barcode128) DO UPDATE SET
-                    order_id=excluded.order_id,
-                    order_name=excluded.order_name,
-                    moment=excluded.moment,
-                    expected_units=excluded.expected_units,
-                    done=excluded.done,
-                    updated_at=excluded.updated_at
-                """,
-                (barcode128, order_id, order_name, moment, float(expected_units or 0), int(done or 0), _utcnow_iso()),
-            )
-            conn.commit()
+            conn.execute(_UPSERT_ORDER_SQL, _order_row(rec, _utcnow_iso()))
 
     def replace_positions(self, barcode128: str, positions: List[Dict[str, Any]]) -> None:
         barcode128 = (barcode128 or "").strip()
@@ -102,25 +368,34 @@ class IndexDB:
             return
         with self._connect() as conn:
             conn.execute("DELETE FROM exploded_positions WHERE barcode128=?", (barcode128,))
-            for i, p in enumerate(positions, start=1):
-                conn.execute(
-                    """
-                    INSERT INTO exploded_positions(
-                        barcode128, line_no, assortment_href, assortment_type, code, name, ean13, quantity
-                    ) VALUES (?,?,?,?,?,?,?,?)
-                    """,
-                    (
-                        barcode128,
-                        i,
-                        p.get("assortment_href"),
-                        p.get("assortment_type"),
-                        p.get("code"),
-                        p.get("name"),
-                        p.get("ean13"),
-                        float(p.get("quantity", 0) or 0),
-                    ),
-                )
-            conn.commit()
+            conn.executemany(_INSERT_POSITION_SQL, _position_rows(barcode128, positions))
+            # новый rev заказа — чтобы HotOrderMap перечитал позиции
+            conn.execute("UPDATE orders_index SET updated_at=? WHERE barcode128=?", (_utcnow_iso(), barcode128))
+
+    def ingest_orders(self, batch: List[Dict[str, Any]]) -> int:
+        """
+        Пачка заказов вместе с позициями — одной транзакцией (один fsync на пачку).
+        Элемент: barcode128, order_id, order_name, moment, expected_units, cis_units, ms_updated, positions.
+        """
+        recs = []
+        for rec in batch:
+            b128 = (rec.get("barcode128") or "").strip()
+            if b128:
+                recs.append(dict(rec, barcode128=b128))
+        if not recs:
+            return 0
+        now = _utcnow_iso()
+        with self._connect() as conn:
+            conn.executemany(_UPSERT_ORDER_SQL, [_order_row(r, now) for r in recs])
+            conn.executemany(
+                "DELETE FROM exploded_positions WHERE barcode128=?",
+                [(r["barcode128"],) for r in recs],
+            )
+            conn.executemany(
+                _INSERT_POSITION_SQL,
+                [row for r in recs for row in _position_rows(r["barcode128"], r.get("positions") or [])],
+            )
+        return len(recs)
 
     def mark_done(self, barcode128: str) -> None:
         barcode128 = (barcode128 or "").strip()
@@ -133,6 +408,17 @@ class IndexDB:
             )
             conn.commit()
 
+    def drop_open(self, barcode128: str) -> int:
+        """Удаляет НЕ обработанный заказ по ШККОД128 (заказ ушёл из статуса «упаковка»); tombstone — триггером."""
+        barcode128 = (barcode128 or "").strip()
+        if not barcode128:
+            return 0
+        with self._connect() as conn:
+            gone = "SELECT barcode128 FROM orders_index WHERE barcode128=? AND done=0"
+            conn.execute(f"DELETE FROM exploded_positions WHERE barcode128 IN ({gone})", (barcode128,))
+            cur = conn.execute("DELETE FROM orders_index WHERE barcode128=? AND done=0", (barcode128,))
+            return cur.rowcount
+
     def lookup_order(self, barcode128: str) -> Optional[Dict[str, Any]]:
         barcode128 = (barcode128 or "").strip()
         if not barcode128:
@@ -140,7 +426,7 @@ class IndexDB:
         with self._connect() as conn:
             row = conn.execute(
                 """
-                SELECT barcode128, order_id, order_name, moment, expected_units, done, done_at, updated_at
+                SELECT barcode128, order_id, order_name, moment, expected_units, cis_units, done, done_at, updated_at
                 FROM orders_index
                 WHERE barcode128=?
                 """,
@@ -155,7 +441,7 @@ class IndexDB:
         with self._connect() as conn:
             rows = conn.execute(
                 """
-                SELECT line_no, assortment_href, assortment_type, code, name, ean13, quantity
+                SELECT line_no, assortment_href, assortment_type, code, name, ean13, quantity, need_cis, cis_units
                 FROM exploded_positions
                 WHERE barcode128=?
                 ORDER BY line_no ASC
@@ -164,6 +450,123 @@ class IndexDB:
             ).fetchall()
             return [dict(r) for r in rows]
 
+    def known_updated(self, order_ids: List[str]) -> Dict[str, str]:
+        """order_id -> ms_updated для уже проиндексированных заказов."""
+        ids = [str(x) for x in order_ids if x]
+        out: Dict[str, str] = {}
+        if not ids:
+            return out
+        with self._connect() as conn:
+            # sqlite ограничивает число параметров — идём чанками
+            for i in range(0, len(ids), 500):
+                chunk = ids[i : i + 500]
+                marks = ",".join("?" for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT order_id, ms_updated FROM orders_index WHERE order_id IN ({marks})",
+                    chunk,
+                ).fetchall()
+                for r in rows:
+                    if r["ms_updated"]:
+                        out[r["order_id"]] = r["ms_updated"]
+        return out
+
+    # ---------------- sync_state ----------------
+
+    def get_watermark(self, source: str) -> str:
+        with self._connect() as conn:
+            row = conn.execute("SELECT watermark FROM sync_state WHERE source=?", (source,)).fetchone()
+            return (row["watermark"] or "") if row else ""
+
+    def set_watermark(self, source: str, watermark: str) -> None:
+        if not watermark:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO sync_state(source, watermark, updated_at)
+                VALUES(?,?,?)
+                ON CONFLICT(source) DO UPDATE SET
+                    watermark=excluded.watermark,
+                    updated_at=excluded.updated_at
+                """,
+                (source, watermark, _utcnow_iso()),
+            )
+            conn.commit()
+
+    def reset_watermark(self, source: str) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE sync_state SET watermark=NULL WHERE source=?", (source,))
+            conn.commit()
+
+    def record_sync_run(self, source: str, ok: bool, stats: Dict[str, Any], error: str = "") -> None:
+        now = _utcnow_iso()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO sync_state(source, watermark, updated_at, last_run_at, last_ok, last_stats, last_error)
+                VALUES(?,NULL,?,?,?,?,?)
+                ON CONFLICT(source) DO UPDATE SET
+                    updated_at=excluded.updated_at,
+                    last_run_at=excluded.last_run_at,
+                    last_ok=excluded.last_ok,
+                    last_stats=excluded.last_stats,
+                    last_error=excluded.last_error
+                """,
+                (source, now, now, 1 if ok else 0, json.dumps(stats, ensure_ascii=False), error or None),
+            )
+            conn.commit()
+
+    def get_sync_status(self, source: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                SELECT source, watermark, last_run_at, last_ok, last_stats, last_error, sync_requested_at,
+                       profile_requested_at
+                FROM sync_state
+                WHERE source=?
+                """,
+                (source,),
+            ).fetchone()
+        if not row:
+            return None
+        out = dict(row)
+        out["last_stats"] = json.loads(out["last_stats"]) if out.get("last_stats") else {}
+        return out
+
+    def request_sync(self, source: str, profile: bool = False) -> None:
+        """Просьба к фоновому индексатору запустить проход вне расписания (profile — под профилировщиком)."""
+        now = _utcnow_iso()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO sync_state(source, updated_at, sync_requested_at, profile_requested_at)
+                VALUES(?,?,?,?)
+                ON CONFLICT(source) DO UPDATE SET
+                    sync_requested_at=excluded.sync_requested_at,
+                    profile_requested_at=COALESCE(excluded.profile_requested_at, sync_state.profile_requested_at)
+                """,
+                (source, now, now, now if profile else None),
+            )
+            conn.commit()
+
+    def take_sync_request(self, source: str) -> bool:
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE sync_state SET sync_requested_at=NULL WHERE source=? AND sync_requested_at IS NOT NULL",
+                (source,),
+            )
+            conn.commit()
+            return cur.rowcount > 0
+
+    def take_profile_request(self, source: str) -> bool:
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE sync_state SET profile_requested_at=NULL WHERE source=? AND profile_requested_at IS NOT NULL",
+                (source,),
+            )
+            conn.commit()
+            return cur.rowcount > 0
+
     def list_open_orders(self, limit: int = 200) -> List[Dict[str, Any]]:
         with self._connect() as conn:
             rows = conn.execute(
@@ -178,9 +581,624 @@ class IndexDB:
             ).fetchall()
             return [dict(r) for r in rows]
 
+    # ---------------- catalog ----------------
+
+    def catalog_upsert_items(self, rows: List[Dict[str, Any]]) -> int:
+        """Товары/модификации: id, type, href, product_id (у модификации), code, name, ean13, cis_required, updated."""
+        if not rows:
+            return 0
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO catalog_items(id, type, href, product_id, code, name, ean13, cis_required, updated)
+                VALUES (?,?,?,?,?,?,?,?,?)
+                """,
+                [
+                    (
+                        r["id"],
+                        r.get("type") or "",
+                        r.get("href"),
+                        r.get("product_id"),
+                        r.get("code"),
+                        r.get("name"),
+                        r.get("ean13") or "",
+                        r.get("cis_required"),
+                        r.get("updated"),
+                    )
+                    for r in rows
+                ],
+            )
+        return len(rows)
+
+    def catalog_upsert_bundles(self, rows: List[Dict[str, Any]]) -> int:
+        """Комплекты: id, href, code, name, marked, updated, components (уже плоский список)."""
+        if not rows:
+            return 0
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO catalog_bundles(id, href, code, name, marked, updated) VALUES (?,?,?,?,?,?)",
+                [(r["id"], r.get("href"), r.get("code"), r.get("name"), r.get("marked"), r.get("updated")) for r in rows],
+            )
+            conn.executemany("DELETE FROM catalog_bundle_components WHERE bundle_id=?", [(r["id"],) for r in rows])
+            conn.executemany(
+                """
+                INSERT INTO catalog_bundle_components(
+                    bundle_id, line_no, assortment_id, assortment_type, assortment_href, code, name, ean13, cis_required, quantity
+                ) VALUES (?,?,?,?,?,?,?,?,?,?)
+                """,
+                [
+                    (
+                        r["id"],
+                        i,
+                        c.get("assortment_id"),
+                        c.get("assortment_type"),
+                        c.get("assortment_href"),
+                        c.get("code"),
+                        c.get("name"),
+                        c.get("ean13") or "",
+                        c.get("cis_required"),
+                        float(c.get("quantity") or 0),
+                    )
+                    for r in rows
+                    for i, c in enumerate(r.get("components") or [], start=1)
+                ],
+            )
+        return len(rows)
+
+    def catalog_delete(self, entity: str, ids: List[str]) -> int:
+        """Убрать из зеркала товары/модификации/комплекты (entity: product | variant | bundle) по id."""
+        ids = [str(x) for x in dict.fromkeys(ids) if x]
+        if not ids:
+            return 0
+        n = 0
+        with self._connect() as conn:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i : i + 500]
+                marks = ",".join("?" for _ in chunk)
+                if entity == "bundle":
+                    conn.execute(f"DELETE FROM catalog_bundle_components WHERE bundle_id IN ({marks})", chunk)
+                    n += conn.execute(f"DELETE FROM catalog_bundles WHERE id IN ({marks})", chunk).rowcount
+                else:
+                    n += conn.execute(
+                        f"DELETE FROM catalog_items WHERE type=? AND id IN ({marks})", [entity, *chunk]
+                    ).rowcount
+        return n
+
+    def catalog_retain(self, entity: str, keep_ids: List[str]) -> int:
+        """
+        Сверка после полного списка: удаляет из зеркала сущности entity, которых нет в keep_ids
+        (удалены в МС — дельта по updated их не видит; архивных полный список не отдаёт).
+        """
+        keep = [(str(x),) for x in dict.fromkeys(keep_ids) if x]
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS _keep_catalog_ids (id TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM _keep_catalog_ids")
+            conn.executemany("INSERT OR IGNORE INTO _keep_catalog_ids(id) VALUES (?)", keep)
+            if entity == "bundle":
+                gone = "SELECT id FROM catalog_bundles WHERE id NOT IN (SELECT id FROM _keep_catalog_ids)"
+                conn.execute(f"DELETE FROM catalog_bundle_components WHERE bundle_id IN ({gone})")
+                cur = conn.execute(f"DELETE FROM catalog_bundles WHERE id IN ({gone})")
+            else:
+                cur = conn.execute(
+                    "DELETE FROM catalog_items WHERE type=? AND id NOT IN (SELECT id FROM _keep_catalog_ids)", (entity,)
+                )
+            conn.execute("DELETE FROM _keep_catalog_ids")
+            return cur.rowcount
+
+    def catalog_bundles(self, bundle_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Комплекты с компонентами из зеркала — локальный join (свежие ean13/признак ЧЗ берутся из catalog_items,
+        у модификации признак — от товара). Нет в зеркале — нет в результате.
+        """
+        ids = list(dict.fromkeys(str(x) for x in bundle_ids if x))
+        out: Dict[str, Dict[str, Any]] = {}
+        if not ids:
+            return out
+        with self._connect() as conn:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i : i + 500]
+                marks = ",".join("?" for _ in chunk)
+                for r in conn.execute(
+                    f"SELECT id, href, code, name, marked FROM catalog_bundles WHERE id IN ({marks})", chunk
+                ).fetchall():
+                    out[r["id"]] = dict(r, components=[])
+                rows = conn.execute(
+                    f"""
+                    SELECT c.bundle_id, c.assortment_id, c.assortment_type, c.assortment_href, c.quantity,
+                           COALESCE(i.code, c.code) AS code,
+                           COALESCE(i.name, c.name) AS name,
+                           COALESCE(NULLIF(i.ean13, ''), c.ean13) AS ean13,
+                           COALESCE(i.cis_required, p.cis_required, c.cis_required) AS cis_required
+                    FROM catalog_bundle_components c
+                    LEFT JOIN catalog_items i ON i.id = c.assortment_id
+                    LEFT JOIN catalog_items p ON p.id = i.product_id
+                    WHERE c.bundle_id IN ({marks})
+                    ORDER BY c.bundle_id, c.line_no
+                    """,
+                    chunk,
+                ).fetchall()
+                for r in rows:
+                    if r["bundle_id"] in out:
+                        out[r["bundle_id"]]["components"].append(dict(r))
+        return out
+
+    def catalog_items(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Товары/модификации из зеркала; у модификации признак ЧЗ — от товара."""
+        uniq = list(dict.fromkeys(str(x) for x in ids if x))
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._connect() as conn:
+            for i in range(0, len(uniq), 500):
+                chunk = uniq[i : i + 500]
+                marks = ",".join("?" for _ in chunk)
+                rows = conn.execute(
+                    f"""
+                    SELECT i.id, i.type, i.href, i.code, i.name, i.ean13,
+                           COALESCE(i.cis_required, p.cis_required) AS cis_required
+                    FROM catalog_items i
+                    LEFT JOIN catalog_items p ON p.id = i.product_id
+                    WHERE i.id IN ({marks})
+                    """,
+                    chunk,
+                ).fetchall()
+                for r in rows:
+                    out[r["id"]] = dict(r)
+        return out
+
+    def catalog_stats(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            a = conn.execute("SELECT COUNT(*) AS c FROM catalog_items").fetchone()["c"]
+            b = conn.execute("SELECT COUNT(*) AS c FROM catalog_bundles").fetchone()["c"]
+            return {"catalog_items": int(a), "catalog_bundles": int(b)}
+
+    # ---------------- cis_codes ----------------
+
+    def cis_owner(self, code: str) -> Optional[Dict[str, Any]]:
+        """Чей код: точечный поиск по PRIMARY KEY (не зависит от числа кодов в базе)."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT code, barcode128, order_id, created_at FROM cis_codes WHERE code=?",
+                (code,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _cis_owners(self, conn: sqlite3.Connection, codes: List[str]) -> Dict[str, str]:
+        out: Dict[str, str] = {}
+        for i in range(0, len(codes), 500):
+            chunk = codes[i : i + 500]
+            marks = ",".join("?" for _ in chunk)
+            rows = conn.execute(f"SELECT code, barcode128 FROM cis_codes WHERE code IN ({marks})", chunk).fetchall()
+            for r in rows:
+                out[r["code"]] = r["barcode128"]
+        return out
+
+    def cis_owners(self, codes: List[str]) -> Dict[str, str]:
+        """code -> barcode128 для уже выданных кодов."""
+        with self._connect() as conn:
+            return self._cis_owners(conn, codes)
+
+    def register_cis_codes(self, barcode128: str, order_id: str, codes: List[str]) -> Dict[str, str]:
+        """
+        Закрепить коды за заказом одной транзакцией. Повтор для того же заказа — не ошибка.
+        Если хоть один код уже за другим заказом — ничего не пишем, возвращаем {code: чужой barcode128}.
+        """
+        barcode128 = (barcode128 or "").strip()
+        if not barcode128 or not codes:
+            return {}
+        now = _utcnow_iso()
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO cis_codes(code, barcode128, order_id, created_at) VALUES (?,?,?,?)",
+                [(c, barcode128, order_id, now) for c in codes],
+            )
+            conflicts = {c: b for c, b in self._cis_owners(conn, codes).items() if b != barcode128}
+            if conflicts:
+                conn.rollback()
+        return conflicts
+
+    # ---------------- scan_journal ----------------
+
+    def _journal(self, station: str, barcode128: str, op: str, code_key: str = "", code: str = "") -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO scan_journal(station, barcode128, op, code_key, code, created_at) VALUES (?,?,?,?,?,?)",
+                (station, barcode128, op, code_key or None, code or None, _utcnow_iso()),
+            )
+
+    def journal_add(self, station: str, barcode128: str, code_key: str, code: str) -> None:
+        self._journal(station, barcode128, "add", code_key, code)
+
+    def journal_undo(self, station: str, barcode128: str, code_key: str) -> None:
+        """Отмена скана — не DELETE, а tombstone-строка."""
+        self._journal(station, barcode128, "undo", code_key)
+
+    def journal_clear(self, station: str, barcode128: str) -> None:
+        """Сессия по заказу закрыта (очистка или отправка): всё до этой строки больше не читается."""
+        self._journal(station, barcode128, "clear")
+
+    def journal_load(self, station: str, barcode128: str) -> List[Tuple[str, str]]:
+        """Живые сканы (code_key, code) по порядку: с последнего clear, минус отменённые."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT op, code_key, code
+                FROM scan_journal
+                WHERE station=? AND barcode128=? AND id > COALESCE(
+                    (SELECT MAX(id) FROM scan_journal WHERE station=? AND barcode128=? AND op='clear'), 0
+                )
+                ORDER BY id ASC
+                """,
+                (station, barcode128, station, barcode128),
+            ).fetchall()
+        live: Dict[str, str] = {}
+        for r in rows:
+            if r["op"] == "add":
+                live.setdefault(r["code_key"], r["code"])
+            elif r["op"] == "undo":
+                live.pop(r["code_key"], None)
+        return list(live.items())
+
+    def journal_open_order(self, station: str) -> str:
+        """ШККОД128 незакрытой сессии станции (после перезагрузки страницы) или ''."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT barcode128, op FROM scan_journal WHERE station=? ORDER BY id DESC LIMIT 1",
+                (station,),
+            ).fetchone()
+        return row["barcode128"] if row and row["op"] != "clear" else ""
+
+    # ---------------- cis_outbox ----------------
+
+    def outbox_enqueue(self, barcode128: str, order_id: str, codes: List[str]) -> None:
+        """Поставить блок [CIS] заказа в очередь. Повторная отправка по заказу заменяет коды."""
+        barcode128 = (barcode128 or "").strip()
+        if not barcode128:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO cis_outbox(barcode128, order_id, codes, status, attempts, next_attempt_at, created_at)
+                VALUES(?,?,?,'pending',0,0,?)
+                ON CONFLICT(barcode128) DO UPDATE SET
+                    order_id=excluded.order_id,
+                    codes=excluded.codes,
+                    status='pending',
+                    attempts=0,
+                    next_attempt_at=0,
+                    last_error=NULL,
+                    sent_at=NULL
+                """,
+                (barcode128, order_id, json.dumps(list(codes), ensure_ascii=False), _utcnow_iso()),
+            )
+
+    def outbox_claim(self, worker: str, limit: int = 10, claim_s: float = 120.0) -> List[Dict[str, Any]]:
+        """Забрать готовые к отправке записи; claim истекает, если воркер упал."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE cis_outbox SET claimed_by=?, claimed_until=?
+                WHERE barcode128 IN (
+                    SELECT barcode128 FROM cis_outbox
+                    WHERE status='pending' AND next_attempt_at <= ? AND COALESCE(claimed_until, 0) < ?
+                    ORDER BY created_at ASC
+                    LIMIT ?
+                )
+                """,
+                (worker, now + float(claim_s), now, now, int(limit)),
+            )
+            rows = conn.execute(
+                """
+                SELECT barcode128, order_id, codes, attempts
+                FROM cis_outbox
+                WHERE claimed_by=? AND claimed_until > ? AND status='pending'
+                """,
+                (worker, now),
+            ).fetchall()
+        out = []
+        for r in rows:
+            d = dict(r)
+            d["codes"] = json.loads(d["codes"])
+            out.append(d)
+        return out
+
+    @staticmethod
+    def _release_requeued(conn: sqlite3.Connection, barcode128: str, worker: str, codes: str) -> None:
+        # пока воркер отправлял, заказ поставили в очередь заново с другими кодами: результат относится
+        # к старым кодам — снимаем claim, запись остаётся pending и уйдёт следующим проходом
+        conn.execute(
+            """
+            UPDATE cis_outbox SET claimed_by=NULL, claimed_until=NULL, next_attempt_at=0
+            WHERE barcode128=? AND claimed_by=? AND codes<>?
+            """,
+            (barcode128, worker, codes),
+        )
+
+    def outbox_sent(self, barcode128: str, worker: str, codes: List[str]) -> None:
+        """codes — те, что воркер забрал в outbox_claim и отправил; sent ставится, только если они не менялись."""
+        codes_json = json.dumps(list(codes), ensure_ascii=False)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE cis_outbox SET status='sent', sent_at=?, claimed_by=NULL, claimed_until=NULL, last_error=NULL
+                WHERE barcode128=? AND claimed_by=? AND codes=?
+                """,
+                (_utcnow_iso(), barcode128, worker, codes_json),
+            )
+            self._release_requeued(conn, barcode128, worker, codes_json)
+
+    def outbox_failed(
+        self, barcode128: str, worker: str, codes: List[str], error: str, retry_in_s: Optional[float]
+    ) -> None:
+        """retry_in_s=None — окончательная ошибка (status=failed), иначе повтор после паузы."""
+        codes_json = json.dumps(list(codes), ensure_ascii=False)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE cis_outbox SET
+                    status=?,
+                    attempts=attempts+1,
+                    next_attempt_at=?,
+                    last_error=?,
+                    claimed_by=NULL,
+                    claimed_until=NULL
+                WHERE barcode128=? AND claimed_by=? AND codes=?
+                """,
+                (
+                    "failed" if retry_in_s is None else "pending",
+                    time.time() + float(retry_in_s or 0),
+                    (error or "")[:1000],
+                    barcode128,
+                    worker,
+                    codes_json,
+                ),
+            )
+            self._release_requeued(conn, barcode128, worker, codes_json)
+
+    def outbox_retry_failed(self) -> int:
+        with self._connect() as conn:
+            cur = conn.execute("UPDATE cis_outbox SET status='pending', attempts=0, next_attempt_at=0 WHERE status='failed'")
+            return cur.rowcount
+
+    def outbox_counts(self) -> Dict[str, int]:
+        out = {"pending": 0, "failed": 0, "sent": 0}
+        with self._connect() as conn:
+            for r in conn.execute("SELECT status, COUNT(*) AS c FROM cis_outbox GROUP BY status").fetchall():
+                out[r["status"]] = int(r["c"])
+        return out
+
+    def outbox_list(self, status: str, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT barcode128, order_id, status, attempts, last_error, created_at, sent_at
+                FROM cis_outbox
+                WHERE status=?
+                ORDER BY created_at DESC
+                LIMIT ?
+                """,
+                (status, int(limit)),
+            ).fetchall()
+            return [dict(r) for r in rows]
+
+    # ---------------- leases ----------------
+
+    def acquire_lease(self, name: str, holder: str, ttl_s: float) -> bool:
+        """
+        Взять или продлить lease. Успех, если lease свободен, истёк или уже наш.
+        Один UPSERT — атомарно между процессами, работающими с одним файлом.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO leases(name, holder, acquired_at, heartbeat_at, expires_at)
+                VALUES(?,?,?,?,?)
+                ON CONFLICT(name) DO UPDATE SET
+                    holder=excluded.holder,
+                    acquired_at=CASE WHEN leases.holder=excluded.holder THEN leases.acquired_at ELSE excluded.acquired_at END,
+                    heartbeat_at=excluded.heartbeat_at,
+                    expires_at=excluded.expires_at
+                WHERE leases.holder=excluded.holder OR leases.expires_at < excluded.heartbeat_at
+                """,
+                (name, holder, now, now, now + float(ttl_s)),
+            )
+            row = conn.execute("SELECT holder FROM leases WHERE name=?", (name,)).fetchone()
+        return bool(row) and row["holder"] == holder
+
+    def release_lease(self, name: str, holder: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+    def lease_info(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT name, holder, acquired_at, heartbeat_at, expires_at FROM leases WHERE name=?",
+                (name,),
+            ).fetchone()
+        if not row:
+            return None
+        out = dict(row)
+        out["alive"] = out["expires_at"] >= time.time()
+        return out
+
+    # ---------------- retention ----------------
+
+    def prune_done(self, older_than_days: int, archive: bool = False) -> int:
+        """
+        Удаляет обработанные заказы (и их позиции), отмеченные done раньше, чем N дней назад.
+        archive=True — заголовки заказов перед удалением копируются в orders_archive.
+        """
+        cutoff = (datetime.utcnow() - timedelta(days=max(0, int(older_than_days)))).strftime("%Y-%m-%d %H:%M:%S")
+        with self._connect() as conn:
+            if archive:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO orders_archive(
+                        barcode128, order_id, order_name, moment, expected_units, done_at, archived_at
+                    )
+                    SELECT barcode128, order_id, order_name, moment, expected_units, done_at, ?
+                    FROM orders_index
+                    WHERE done=1 AND done_at < ?
+                    """,
+                    (_utcnow_iso(), cutoff),
+                )
+            conn.execute(
+                """
+                DELETE FROM exploded_positions
+                WHERE barcode128 IN (SELECT barcode128 FROM orders_index WHERE done=1 AND done_at < ?)
+                """,
+                (cutoff,),
+            )
+            cur = conn.execute("DELETE FROM orders_index WHERE done=1 AND done_at < ?", (cutoff,))
+            return cur.rowcount
+
+    def prune_open_except(self, keep_order_ids: List[str], snapshot_at: str) -> int:
+        """
+        Удаляет НЕ обработанные заказы, которых нет в keep_order_ids (заказ ушёл из статуса «упаковка»).
+        keep_order_ids — полный список id заказов в статусе, снятый начиная с snapshot_at (UTC, как updated_at):
+        строки, записанные позже (вебхук, resolve_barcode), список мог не застать — их не трогаем.
+        """
+        keep = [(str(x),) for x in dict.fromkeys(keep_order_ids) if x]
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS _keep_ids (order_id TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM _keep_ids")
+            conn.executemany("INSERT OR IGNORE INTO _keep_ids(order_id) VALUES (?)", keep)
+            gone = (
+                "SELECT barcode128 FROM orders_index WHERE done=0 AND updated_at < ? "
+                "AND order_id NOT IN (SELECT order_id FROM _keep_ids)"
+            )
+            conn.execute(f"DELETE FROM exploded_positions WHERE barcode128 IN ({gone})", (snapshot_at,))
+            cur = conn.execute(f"DELETE FROM orders_index WHERE barcode128 IN ({gone})", (snapshot_at,))
+            conn.execute("DELETE FROM _keep_ids")
+            return cur.rowcount
+
+    def optimize(self) -> None:
+        with self._connect() as conn:
+            # старые tombstones не нужны: HotOrderMap, отставший так сильно, перечитает всё
+            conn.execute("DELETE FROM orders_tombstones WHERE rev < (SELECT rev FROM index_rev WHERE id=1) - 1000000")
+            sent_cutoff = (datetime.utcnow() - timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S")
+            conn.execute("DELETE FROM cis_outbox WHERE status='sent' AND sent_at < ?", (sent_cutoff,))
+            # закрытые сессии журнала сканов больше не читаются
+            conn.execute(
+                """
+                DELETE FROM scan_journal
+                WHERE id < (
+                    SELECT MAX(j.id) FROM scan_journal j
+                    WHERE j.station=scan_journal.station AND j.barcode128=scan_journal.barcode128 AND j.op='clear'
+                )
+                """
+            )
+            conn.execute("PRAGMA optimize")
+
     def stats(self) -> Dict[str, int]:
         with self._connect() as conn:
             a = conn.execute("SELECT COUNT(*) AS c FROM orders_index").fetchone()["c"]
             b = conn.execute("SELECT COUNT(*) AS c FROM exploded_positions").fetchone()["c"]
             c = conn.execute("SELECT COUNT(*) AS c FROM orders_index WHERE done=0").fetchone()["c"]
-            return {"orders_index": int(a), "exploded_positions": int(b), "open_orders": int(c)}
+            d = conn.execute("SELECT COUNT(*) AS c FROM cis_codes").fetchone()["c"]
+            return {"orders_index": int(a), "exploded_positions": int(b), "open_orders": int(c), "cis_codes": int(d)}
+
+
+class HotOrderMap:
+    """
+    Карта ШККОД128 → заказ (+ позиции) в памяти процесса для пути скана.
+    Свежесть: PRAGMA data_version (меняется, когда пишет другое соединение) → index_rev →
+    догрузка только строк с rev больше загруженного и tombstones.
+    """
+
+    def __init__(self, db: IndexDB, check_interval_s: float = 0.5, with_positions: bool = True):
+        self.db = db
+        self.check_interval_s = float(check_interval_s)
+        self.with_positions = with_positions
+        self.orders: Dict[str, Dict[str, Any]] = {}
+        self.positions: Dict[str, List[Dict[str, Any]]] = {}
+        self.rev = -1
+        self.reloads = 0
+        self.last_refresh_ms = 0.0
+        self._data_version: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+        # отдельное соединение: data_version имеет смысл только в рамках одного соединения
+        self._conn = sqlite3.connect(db.path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+
+    def refresh(self, force: bool = False) -> int:
+        """Догрузить изменения. Возвращает число изменённых/удалённых ШККОД128."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < self.check_interval_s:
+                return 0
+            self._checked_at = now
+            dv = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if not force and dv == self._data_version:
+                return 0
+            self._data_version = dv
+
+            t0 = time.perf_counter()
+            cur_rev = self._conn.execute("SELECT rev FROM index_rev WHERE id=1").fetchone()[0]
+            if cur_rev == self.rev:
+                return 0
+            rows = self._conn.execute(
+                """
+                SELECT barcode128, order_id, order_name, moment, expected_units, cis_units, done, done_at, updated_at, rev
+                FROM orders_index
+                WHERE rev > ?
+                """,
+                (self.rev,),
+            ).fetchall()
+            gone = self._conn.execute(
+                "SELECT barcode128 FROM orders_tombstones WHERE rev > ?",
+                (self.rev,),
+            ).fetchall()
+
+            changed = [r["barcode128"] for r in rows]
+            for r in rows:
+                self.orders[r["barcode128"]] = dict(r)
+            for r in gone:
+                self.orders.pop(r["barcode128"], None)
+                self.positions.pop(r["barcode128"], None)
+
+            if self.with_positions and changed:
+                fresh: Dict[str, List[Dict[str, Any]]] = {b: [] for b in changed}
+                for i in range(0, len(changed), 500):
+                    chunk = changed[i : i + 500]
+                    marks = ",".join("?" for _ in chunk)
+                    for p in self._conn.execute(
+                        f"""
+                        SELECT barcode128, line_no, assortment_href, assortment_type, code, name, ean13, quantity,
+                               need_cis, cis_units
+                        FROM exploded_positions
+                        WHERE barcode128 IN ({marks})
+                        ORDER BY barcode128, line_no
+                        """,
+                        chunk,
+                    ):
+                        d = dict(p)
+                        fresh[d.pop("barcode128")].append(d)
+                self.positions.update(fresh)
+
+            self.rev = cur_rev
+            self.reloads += 1
+            self.last_refresh_ms = (time.perf_counter() - t0) * 1000.0
+            return len(changed) + len(gone)
+
+    def lookup(self, barcode128: str) -> Optional[Dict[str, Any]]:
+        barcode128 = (barcode128 or "").strip()
+        if not barcode128:
+            return None
+        self.refresh()
+        row = self.orders.get(barcode128)
+        return dict(row) if row else None
+
+    def lookup_positions(self, barcode128: str) -> List[Dict[str, Any]]:
+        self.refresh()
+        return [dict(p) for p in self.positions.get((barcode128 or "").strip(), [])]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "orders": len(self.orders),
+            "rev": self.rev,
+            "reloads": self.reloads,
+            "last_refresh_ms": round(self.last_refresh_ms, 2),
+        }
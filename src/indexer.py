@@ -1,9 +1,31 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+import argparse
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
 
-from src.moysklad import MoySkladClient
+from dotenv import load_dotenv
+
+from src.catalog import (
+    assortment_id,
+    bundle_marked,
+    fetch_bundles,
+    load_bundles,
+    pick_ean13,
+    resolve_cis_flags,
+    sync_catalog,
+)
+from src.config import Settings
+from src.index_db import IndexDB
+from src.metrics import StageTimer
+from src.profiling import profiled
+from src.moysklad import MS_MAX_PAGE_LIMIT, MoySkladClient, id_from_href, watermark_after_crawl
 
 
 def _norm_date_from(date_from: str) -> str:
@@ -30,63 +52,142 @@ def is_done_by_description(order: Dict[str, Any]) -> bool:
     return "[CIS]" in desc and "[/CIS]" in desc
 
 
+def iter_customerorders_packing_since(
+    ms: MoySkladClient,
+    packing_state_href: str,
+    date_from: str,
+    limit: int = MS_MAX_PAGE_LIMIT,
+    max_total: int = 4000,
+    updated_from: str = "",
+    expand_positions: bool = False,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Заказы в статусе — по страницам (генератор), в порядке moment,desc.
+    Вперёд читается не больше окна страниц клиента, дальше — по мере разбора потребителем.
+    expand_positions=True — позиции (с assortment) приходят прямо в строках списка,
+    description/attributes там есть всегда, так что полные чтения заказа не нужны.
+    """
+    df = _norm_date_from(date_from)
+    uf = _norm_date_from(updated_from)[:19]  # фильтр МС — с точностью до секунды
+    flt = f"state={packing_state_href}"
+    if df:
+        flt += f";moment>={df}"
+    if uf:
+        # дельта: только заказы, изменённые начиная с watermark
+        flt += f";updated>={uf}"
+    params: Dict[str, Any] = {"filter": flt, "order": "moment,desc"}
+    if expand_positions:
+        params["expand"] = "positions.assortment"
+    # первая страница даёт meta.size, остальные окна offset догружаются параллельно
+    yield from ms.iter_pages("/entity/customerorder", params=params, page_size=limit, max_total=max_total)
+
+
 def list_customerorders_packing_since(
     ms: MoySkladClient,
     packing_state_href: str,
     date_from: str,
-    limit: int = 200,
+    limit: int = MS_MAX_PAGE_LIMIT,
     max_total: int = 4000,
+    updated_from: str = "",
+    expand_positions: bool = False,
 ) -> List[Dict[str, Any]]:
-    df = _norm_date_from(date_from)
-    offset = 0
     out: List[Dict[str, Any]] = []
-    while True:
-        if len(out) >= max_total:
-            break
-        take = min(limit, max_total - len(out))
-        flt = f"state={packing_state_href}"
-        if df:
-            flt += f";moment>={df}"
-        page = ms.get(
-            "/entity/customerorder",
-            params={"filter": flt, "order": "moment,desc", "limit": take, "offset": offset},
-        )
-        rows = page.get("rows", []) if isinstance(page, dict) else []
-        if not rows:
-            break
+    for rows in iter_customerorders_packing_since(
+        ms,
+        packing_state_href,
+        date_from,
+        limit=limit,
+        max_total=max_total,
+        updated_from=updated_from,
+        expand_positions=expand_positions,
+    ):
         out.extend(rows)
-        offset += len(rows)
-        if len(rows) < take:
-            break
     return out
 
 
+def sync_source_key(packing_state_href: str) -> str:
+    return f"customerorder:{(packing_state_href or '').strip()}"
+
+
+def max_updated(orders: List[Dict[str, Any]], current: str = "") -> str:
+    """Новый watermark: максимальный `updated` среди заказов (строки МС сравнимы лексикографически)."""
+    best = (current or "").strip()
+    for o in orders:
+        u = str(o.get("updated") or "").strip()
+        if u and u > best:
+            best = u
+    return best
+
+
 def get_customerorder_positions_expand(ms: MoySkladClient, order_id: str) -> List[Dict[str, Any]]:
-    page = ms.get(
+    path, params = _positions_call(order_id)
+    page = ms.get(path, params=params)
+    return page.get("rows", []) if isinstance(page, dict) else []
+
+
+def _positions_if_complete(order: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    pos = order.get("positions")
+    if isinstance(pos, dict):
+        rows = pos.get("rows")
+        size = (pos.get("meta") or {}).get("size")
+        if isinstance(rows, list) and (size is None or len(rows) >= int(size)):
+            if all(isinstance((r.get("assortment") or {}).get("meta"), dict) for r in rows):
+                return rows
+    return None
+
+
+def _positions_call(order_id: str) -> Tuple[str, Dict[str, Any]]:
+    return (
         f"/entity/customerorder/{order_id}/positions",
-        params={"limit": 1000, "offset": 0, "expand": "assortment"},
+        {"limit": 1000, "offset": 0, "expand": "assortment"},
     )
-    return page.get("rows", []) if isinstance(page, dict) else []
 
 
-def get_bundle_components(ms: MoySkladClient, bundle_id: str) -> List[Dict[str, Any]]:
-    b = ms.get(f"/entity/bundle/{bundle_id}", params={"expand": "components.assortment"})
-    comps = (b.get("components") or {}).get("rows") or []
-    return comps
+def order_positions(ms: MoySkladClient, order: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Позиции из строки списка (expand=positions.assortment).
+    Отдельный запрос — только если МС обрезал вложенную коллекцию или не раскрыл её.
+    """
+    rows = _positions_if_complete(order)
+    if rows is not None:
+        return rows
+    return get_customerorder_positions_expand(ms, str(order.get("id") or ""))
+
+
+def order_positions_many(ms: MoySkladClient, orders: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """То же для пачки заказов: все догрузки позиций уходят параллельно, порядок сохраняется."""
+    out: List[Optional[List[Dict[str, Any]]]] = [_positions_if_complete(o) for o in orders]
+    missing = [i for i, rows in enumerate(out) if rows is None]
+    pages = ms.gather_get([_positions_call(str(orders[i].get("id") or "")) for i in missing])
+    for i, page in zip(missing, pages):
+        out[i] = page.get("rows", []) if isinstance(page, dict) else []
+    return [rows or [] for rows in out]
 
 
-def pick_ean13(assortment: Dict[str, Any]) -> str:
-    bcs = assortment.get("barcodes") or []
-    for bc in bcs:
-        if isinstance(bc, dict) and bc.get("ean13"):
-            return str(bc["ean13"])
-    return ""
+def _is_bundle_position(p: Dict[str, Any]) -> bool:
+    return (((p.get("assortment") or {}).get("meta") or {}).get("type") or "").strip() == "bundle"
 
 
-def explode_order_positions(ms: MoySkladClient, positions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def bundle_ids_of(positions: List[Dict[str, Any]]) -> List[str]:
+    ids = [str((p.get("assortment") or {}).get("id") or "") for p in positions if _is_bundle_position(p)]
+    return list(dict.fromkeys(i for i in ids if i))
+
+
+def explode_order_positions(
+    ms: MoySkladClient,
+    positions: List[Dict[str, Any]],
+    bundles: Optional[Dict[str, Dict[str, Any]]] = None,
+    cis_flags: Optional[Dict[str, bool]] = None,
+    bundle_mark_flag: str = "",
+) -> List[Dict[str, Any]]:
+    """
+    bundles — заранее загруженные комплекты (fetch_bundles / load_bundles); недостающие догружаются одной пачкой.
+    cis_flags (resolve_cis_flags) — применить правила маркировки: у строки появляются need_cis и cis_units.
+    Компонент маркируемого комплекта (bundle_mark_flag) требует КМ всегда, иначе — по признаку товара.
+    """
     out: List[Dict[str, Any]] = []
 
-    def add_line(ass: Dict[str, Any], qty: float):
+    def add_line(ass: Dict[str, Any], qty: float, need: Optional[bool]):
         meta = ass.get("meta") or {}
         href = meta.get("href")
         a_type = meta.get("type") or ass.get("type")
@@ -98,24 +199,38 @@ def explode_order_positions(ms: MoySkladClient, positions: List[Dict[str, Any]])
                 "name": ass.get("name"),
                 "ean13": pick_ean13(ass),
                 "quantity": qty,
+                "need_cis": need,
+                "cis_units": None if need is None else (qty if need else 0.0),
             }
         )
 
+    def need_of(ass: Dict[str, Any], own: Optional[Any] = None) -> Optional[bool]:
+        if cis_flags is None:
+            return None
+        if own is not None:
+            return bool(own)
+        return cis_flags.get(assortment_id(ass), False)
+
+    bundles = dict(bundles or {})
+    missing = [bid for bid in bundle_ids_of(positions) if bid not in bundles]
+    if missing:
+        bundles.update(fetch_bundles(ms, missing))
+
     for p in positions:
         qty = float(p.get("quantity", 0) or 0)
         ass = p.get("assortment") or {}
-        meta = ass.get("meta") or {}
-        a_type = (meta.get("type") or "").strip()
 
-        if a_type == "bundle":
-            bundle_id = ass.get("id")
-            comps = get_bundle_components(ms, bundle_id)
+        if _is_bundle_position(p):
+            b = bundles.get(str(ass.get("id") or "")) or {}
+            marked = bundle_marked(b, bundle_mark_flag)
+            comps = (b.get("components") or {}).get("rows") or []
             for c in comps:
                 c_qty = float(c.get("quantity", 0) or 0)
                 c_ass = c.get("assortment") or {}
-                add_line(c_ass, qty * c_qty)
+                need = need_of(c_ass, True if marked else c.get("cis_required"))
+                add_line(c_ass, qty * c_qty, need)
         else:
-            add_line(ass, qty)
+            add_line(ass, qty, need_of(ass))
 
     # агрегируем одинаковые
     agg: Dict[str, Dict[str, Any]] = {}
@@ -124,14 +239,597 @@ def explode_order_positions(ms: MoySkladClient, positions: List[Dict[str, Any]])
         if key not in agg:
             agg[key] = dict(row)
         else:
-            agg[key]["quantity"] = float(agg[key].get("quantity", 0) or 0) + float(row.get("quantity", 0) or 0)
+            a = agg[key]
+            a["quantity"] = float(a.get("quantity", 0) or 0) + float(row.get("quantity", 0) or 0)
+            if a.get("cis_units") is not None:
+                a["cis_units"] = float(a["cis_units"]) + float(row.get("cis_units") or 0)
+                a["need_cis"] = a["cis_units"] > 0
 
     return list(agg.values())
 
 
+def _flag_assortments(positions_list: List[List[Dict[str, Any]]], bundles: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Чьи признаки ЧЗ нужны: товары вне комплектов и компоненты без признака из зеркала."""
+    out: List[Dict[str, Any]] = []
+    for positions in positions_list:
+        for p in positions:
+            if not _is_bundle_position(p):
+                out.append(p.get("assortment") or {})
+    for b in bundles.values():
+        for c in (b.get("components") or {}).get("rows") or []:
+            if c.get("cis_required") is None:
+                out.append(c.get("assortment") or {})
+    return out
+
+
+def explode_orders(
+    ms: MoySkladClient,
+    db: IndexDB,
+    positions_list: List[List[Dict[str, Any]]],
+    use_catalog: bool = False,
+    attr_cis_required: str = "",
+    bundle_mark_flag: str = "",
+) -> List[List[Dict[str, Any]]]:
+    """
+    Раскрытие пачки заказов: комплекты — из зеркала (use_catalog) или одним bulk-запросом,
+    правила маркировки — один раз на пачку. Без attr_cis_required/bundle_mark_flag правила не применяются.
+    """
+    bundle_ids = list(dict.fromkeys(b for pos in positions_list for b in bundle_ids_of(pos)))
+    if use_catalog:
+        bundles = load_bundles(ms, db, bundle_ids, attr_cis_required, bundle_mark_flag)
+    else:
+        bundles = fetch_bundles(ms, bundle_ids)
+    flags = None
+    if attr_cis_required or bundle_mark_flag:
+        flags = resolve_cis_flags(ms, db, _flag_assortments(positions_list, bundles), attr_cis_required, use_catalog)
+    return [
+        explode_order_positions(ms, pos, bundles=bundles, cis_flags=flags, bundle_mark_flag=bundle_mark_flag)
+        for pos in positions_list
+    ]
+
+
 def expected_units_from_exploded(exploded: List[Dict[str, Any]]) -> int:
     total = 0.0
     for r in exploded:
         total += float(r.get("quantity", 0) or 0)
     # в твоём кейсе КИЗы = штуки → округляем до int
     return int(round(total))
+
+
+def cis_units_from_exploded(exploded: List[Dict[str, Any]]) -> Optional[int]:
+    """Сколько КМ нужно по заказу; None — правила маркировки не применялись."""
+    if any(r.get("cis_units") is None for r in exploded):
+        return None
+    return int(round(sum(float(r["cis_units"]) for r in exploded)))
+
+
+# ---------------- проход индексации ----------------
+
+def order_record(order: Dict[str, Any], barcode128: str, exploded: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Запись для IndexDB.ingest_orders."""
+    return {
+        "barcode128": barcode128,
+        "order_id": str(order.get("id")),
+        "order_name": str(order.get("name") or ""),
+        "moment": str(order.get("moment") or ""),
+        "expected_units": expected_units_from_exploded(exploded),
+        "cis_units": cis_units_from_exploded(exploded),
+        "done": 0,
+        "ms_updated": str(order.get("updated") or ""),
+        "positions": exploded,
+    }
+
+
+def index_order(
+    ms: MoySkladClient,
+    db: IndexDB,
+    order: Dict[str, Any],
+    qr_attr_id: str = "",
+    qr_attr_name: str = "",
+    packing_state_href: str = "",
+    use_catalog: bool = False,
+    attr_cis_required: str = "",
+    bundle_mark_flag: str = "",
+) -> str:
+    """
+    Переиндексация одного заказа (webhook). Возвращает исход:
+    added | skipped_done | no_barcode | not_packing.
+    use_catalog — комплекты из локального зеркала каталога (см. src.catalog).
+    """
+    b128 = str(extract_attr_value(order, attr_id=qr_attr_id, attr_name=qr_attr_name) or "").strip()
+    if not b128:
+        return "no_barcode"
+
+    if is_done_by_description(order):
+        db.mark_done(b128)
+        return "skipped_done"
+
+    if packing_state_href:
+        state_href = ((order.get("state") or {}).get("meta") or {}).get("href") or ""
+        if id_from_href(state_href) != id_from_href(packing_state_href):
+            # заказ ушёл из «упаковки» — открытая строка индекса больше не нужна (prune_index дошёл бы не сразу)
+            db.drop_open(b128)
+            return "not_packing"
+
+    exploded = explode_orders(
+        ms,
+        db,
+        [order_positions(ms, order)],
+        use_catalog=use_catalog,
+        attr_cis_required=attr_cis_required,
+        bundle_mark_flag=bundle_mark_flag,
+    )[0]
+    db.ingest_orders([order_record(order, b128, exploded)])
+    return "added"
+
+
+ProgressCb = Callable[[int, int, Dict[str, int]], None]
+
+
+def resolve_barcode(
+    ms: MoySkladClient,
+    db: IndexDB,
+    barcode128: str,
+    qr_attr_id: str = "",
+    qr_attr_name: str = "",
+    packing_state_href: str = "",
+    use_catalog: bool = False,
+    attr_cis_required: str = "",
+    bundle_mark_flag: str = "",
+) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    ШККОД128 → заказ из индекса. Промах — один запрос в МС с фильтром по доп. полю,
+    найденный заказ сразу пишется в индекс. Возвращает (строка индекса | None, источник/исход):
+    index | added | not_found | skipped_done | no_barcode | not_packing.
+    """
+    barcode128 = (barcode128 or "").strip()
+    if not barcode128:
+        return None, "not_found"
+    found = db.lookup_order(barcode128)
+    if found:
+        return found, "index"
+
+    rows = ms.find_customerorders_by_attr(
+        barcode128,
+        attr_id=qr_attr_id,
+        attr_name=qr_attr_name,
+        expand="positions.assortment",
+        limit=1,
+    )
+    if not rows:
+        return None, "not_found"
+    outcome = index_order(
+        ms,
+        db,
+        rows[0],
+        qr_attr_id=qr_attr_id,
+        qr_attr_name=qr_attr_name,
+        packing_state_href=packing_state_href,
+        use_catalog=use_catalog,
+        attr_cis_required=attr_cis_required,
+        bundle_mark_flag=bundle_mark_flag,
+    )
+    return db.lookup_order(barcode128), outcome
+
+
+_END = object()
+
+
+def _put(q: "queue.Queue[Any]", item: Any, stop: threading.Event) -> bool:
+    """put с backpressure, но без вечной блокировки, если соседняя стадия упала."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: "queue.Queue[Any]", stop: threading.Event) -> Any:
+    while True:
+        try:
+            return q.get(timeout=0.2)
+        except queue.Empty:
+            if stop.is_set():
+                return _END
+
+
+def _page_todo(
+    db: IndexDB,
+    rows: List[Dict[str, Any]],
+    stats: Dict[str, int],
+    qr_attr_id: str,
+    qr_attr_name: str,
+) -> List[Tuple[Dict[str, Any], str]]:
+    """Заказы страницы, которые нужно (пере)индексировать: (заказ, ШККОД128)."""
+    known = db.known_updated([o.get("id") for o in rows])
+
+    todo = []
+    for o in rows:
+        oid = o.get("id")
+        if not oid:
+            continue
+
+        # не менялся с прошлой индексации — позиции/комплекты не раскрываем
+        ms_updated = str(o.get("updated") or "")
+        if ms_updated and known.get(str(oid)) == ms_updated:
+            stats["unchanged"] += 1
+            continue
+
+        # description/attributes/positions уже пришли в странице списка
+        if is_done_by_description(o):
+            stats["skipped_done"] += 1
+            continue
+
+        b128 = extract_attr_value(o, attr_id=qr_attr_id, attr_name=qr_attr_name)
+        if not b128:
+            stats["no_barcode"] += 1
+            continue
+
+        todo.append((o, str(b128).strip()))
+    return todo
+
+
+def run_indexing(
+    ms: MoySkladClient,
+    db: IndexDB,
+    packing_state_href: str,
+    date_from: str = "",
+    qr_attr_id: str = "",
+    qr_attr_name: str = "",
+    page_limit: int = MS_MAX_PAGE_LIMIT,
+    max_total: int = 4000,
+    full_resync: bool = False,
+    progress_cb: Optional[ProgressCb] = None,  # progress_cb(listed, max_total, stats)
+    queue_size: int = 4,
+    cancel: Optional[threading.Event] = None,  # напр. LeaseKeeper.lost — прервать проход
+    use_catalog: bool = False,  # комплекты — из локального зеркала каталога
+    attr_cis_required: str = "",
+    bundle_mark_flag: str = "",
+) -> Dict[str, int]:
+    """
+    Конвейер: чтение страниц → фильтр (без изменений / обработан / без ШККОД128) → раскрытие → запись.
+    Между стадиями — ограниченные очереди: память не растёт с max_total,
+    первые заказы попадают в индекс, пока остальные страницы ещё читаются.
+    """
+    source = sync_source_key(packing_state_href)
+    watermark = "" if full_resync else db.get_watermark(source)
+    crawl_t0 = time.monotonic()
+
+    stats = {"listed": 0, "added": 0, "unchanged": 0, "skipped_done": 0, "no_barcode": 0}
+    # время стадий за проход (list / filter / positions — дочитка позиций / bundles — раскрытие / write)
+    timer = StageTimer(ms.metrics)
+    new_watermark = watermark
+    pages_q: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, queue_size))
+    write_q: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, queue_size))
+    stop = threading.Event()
+    errors: List[BaseException] = []
+
+    def fetch_stage() -> None:
+        try:
+            pages = iter_customerorders_packing_since(
+                ms=ms,
+                packing_state_href=packing_state_href.strip(),
+                date_from=date_from.strip(),
+                limit=int(page_limit),
+                max_total=int(max_total),
+                updated_from=watermark,
+                expand_positions=True,
+            )
+            while True:
+                # ожидание места в очереди (backpressure) в стадию не входит
+                with timer.stage("list"):
+                    rows = next(pages, None)
+                if rows is None or not _put(pages_q, rows, stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(pages_q, _END, stop)
+
+    def write_stage() -> None:
+        try:
+            while True:
+                batch = _get(write_q, stop)
+                if batch is _END:
+                    return
+                # вся пачка — одной транзакцией
+                with timer.stage("write"):
+                    stats["added"] += db.ingest_orders(batch)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    fetcher = threading.Thread(target=fetch_stage, name="index-fetch", daemon=True)
+    writer = threading.Thread(target=write_stage, name="index-write", daemon=True)
+    fetcher.start()
+    writer.start()
+
+    try:
+        while True:
+            rows = _get(pages_q, stop)
+            if rows is _END:
+                break
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("indexing cancelled")
+            stats["listed"] += len(rows)
+            new_watermark = max_updated(rows, new_watermark)
+            with timer.stage("filter"):
+                todo = _page_todo(db, rows, stats, qr_attr_id, qr_attr_name)
+
+            if todo:
+                # догрузка позиций — параллельно через общий пул клиента; комплекты и признаки ЧЗ — на всю страницу
+                # (из зеркала каталога — локальный join, иначе bulk-запросами)
+                with timer.stage("positions"):
+                    positions = order_positions_many(ms, [o for o, _ in todo])
+                with timer.stage("bundles"):
+                    exploded = explode_orders(
+                        ms,
+                        db,
+                        positions,
+                        use_catalog=use_catalog,
+                        attr_cis_required=attr_cis_required,
+                        bundle_mark_flag=bundle_mark_flag,
+                    )
+                batch = [order_record(o, b128, ex) for (o, b128), ex in zip(todo, exploded)]
+                if not _put(write_q, batch, stop):
+                    break
+
+            if progress_cb:
+                progress_cb(stats["listed"], int(max_total), stats)
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        _put(write_q, _END, stop)
+        fetcher.join()
+        writer.join()
+
+    if errors:
+        raise errors[0]
+    stats.update(timer.as_ms())
+
+    # watermark двигаем только после успешного и полного (не обрезанного MAX_TOTAL) прохода,
+    # с перекрытием на длительность обхода — правки, сделанные во время обхода, попадут в следующую дельту
+    if stats["listed"] < int(max_total):
+        db.set_watermark(source, watermark_after_crawl(new_watermark, watermark, time.monotonic() - crawl_t0))
+
+    return stats
+
+
+# ---------------- retention ----------------
+
+def prune_index(
+    ms: MoySkladClient,
+    db: IndexDB,
+    packing_state_href: str,
+    date_from: str = "",
+    retention_days: int = 14,
+    archive: bool = False,
+    max_total: int = 20000,
+) -> Dict[str, int]:
+    """
+    1) обработанные старше retention_days — в архив/удалить;
+    2) открытые заказы, которых больше нет в статусе «упаковка», — удалить.
+    Для (2) нужен полный список id в статусе: без expand МС отдаёт до 1000 строк на страницу.
+    """
+    stats = {"expired": db.prune_done(retention_days, archive=archive), "left_packing": 0}
+
+    # момент начала снимка в формате updated_at индекса — строки новее него prune не трогает
+    snapshot_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    ids: List[str] = []
+    for rows in iter_customerorders_packing_since(
+        ms=ms,
+        packing_state_href=packing_state_href.strip(),
+        date_from=date_from.strip(),
+        limit=1000,
+        max_total=int(max_total),
+    ):
+        ids.extend(str(o.get("id") or "") for o in rows)
+    # пустой или обрезанный список — не повод чистить индекс
+    if ids and len(ids) < int(max_total):
+        stats["left_packing"] = db.prune_open_except(ids, snapshot_at)
+
+    db.optimize()
+    return stats
+
+
+# ---------------- фоновый процесс: python -m src.indexer --loop ----------------
+
+class LeaseKeeper:
+    """
+    Lease на индексацию в IndexDB: индексирует только держатель, остальные реплики ждут.
+    Держатель продлевает lease heartbeat-ом; упавший держатель перестаёт продлевать,
+    и после ttl lease забирает другой процесс.
+    """
+
+    def __init__(self, db: IndexDB, name: str, ttl_s: float = 60.0, holder: str = ""):
+        self.db = db
+        self.name = name
+        self.ttl_s = float(ttl_s)
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def held(self) -> bool:
+        return self._thread is not None and not self.lost.is_set()
+
+    def acquire(self) -> bool:
+        if self.held():
+            return True
+        if not self.db.acquire_lease(self.name, self.holder, self.ttl_s):
+            return False
+        self.lost.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat, name="index-lease", daemon=True)
+        self._thread.start()
+        return True
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.ttl_s / 3):
+            try:
+                ok = self.db.acquire_lease(self.name, self.holder, self.ttl_s)
+            except Exception:
+                ok = False
+            if not ok:
+                self.lost.set()
+                return
+
+    def release(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.db.release_lease(self.name, self.holder)
+
+
+def lease_name(packing_state_href: str) -> str:
+    return "indexer:" + sync_source_key(packing_state_href)
+
+
+def run_once(
+    ms: MoySkladClient,
+    db: IndexDB,
+    cfg: Settings,
+    full_resync: bool = False,
+    cancel: Optional[threading.Event] = None,
+) -> bool:
+    source = sync_source_key(cfg.MS_PACKING_STATE_HREF)
+    t0 = time.monotonic()
+    catalog_stats: Dict[str, int] = {}
+    if cfg.CATALOG_MIRROR:
+        # зеркало не обязательно: что не успело синхронизироваться, раскрытие догрузит из МС
+        t_catalog = time.perf_counter()
+        try:
+            catalog_stats = sync_catalog(
+                ms,
+                db,
+                attr_cis_required=cfg.MS_ATTR_CIS_REQUIRED,
+                bundle_mark_flag=cfg.MS_BUNDLE_MARK_FLAG,
+                full=full_resync,
+                reconcile_s=cfg.CATALOG_RECONCILE_S,
+            )
+        except Exception as e:
+            print(f"[indexer] каталог: ошибка {e!r}", flush=True)
+        catalog_s = time.perf_counter() - t_catalog
+        ms.metrics.observe_stage("catalog", catalog_s)
+        catalog_stats["ms"] = int(round(catalog_s * 1000))
+    try:
+        stats = run_indexing(
+            ms,
+            db,
+            packing_state_href=cfg.MS_PACKING_STATE_HREF,
+            date_from=cfg.DATE_FROM,
+            qr_attr_id=cfg.MS_ORDER_QR_ATTR_ID,
+            qr_attr_name=cfg.MS_ORDER_QR_ATTR_NAME,
+            page_limit=cfg.PAGE_LIMIT,
+            max_total=cfg.MAX_TOTAL,
+            full_resync=full_resync,
+            cancel=cancel,
+            use_catalog=cfg.CATALOG_MIRROR,
+            attr_cis_required=cfg.MS_ATTR_CIS_REQUIRED,
+            bundle_mark_flag=cfg.MS_BUNDLE_MARK_FLAG,
+        )
+    except Exception as e:
+        db.record_sync_run(source, ok=False, stats={"seconds": round(time.monotonic() - t0, 1)}, error=repr(e))
+        print(f"[indexer] ошибка: {e!r}", flush=True)
+        write_metrics(ms, cfg)
+        return False
+
+    for entity, n in catalog_stats.items():
+        stats[f"catalog_{entity}"] = n
+    stats["seconds"] = round(time.monotonic() - t0, 1)
+    db.record_sync_run(source, ok=True, stats=stats)
+    print(f"[indexer] готово: {stats}", flush=True)
+    write_metrics(ms, cfg)
+    return True
+
+
+def write_metrics(ms: MoySkladClient, cfg: Settings) -> None:
+    if not cfg.METRICS_PATH:
+        return
+    try:
+        ms.metrics.write_prometheus(cfg.METRICS_PATH)
+    except OSError as e:
+        print(f"[indexer] метрики: {e!r}", flush=True)
+
+
+def run_prune(ms: MoySkladClient, db: IndexDB, cfg: Settings) -> None:
+    try:
+        stats = prune_index(
+            ms,
+            db,
+            packing_state_href=cfg.MS_PACKING_STATE_HREF,
+            date_from=cfg.DATE_FROM,
+            retention_days=cfg.INDEX_RETENTION_DAYS,
+            archive=cfg.INDEX_ARCHIVE,
+        )
+    except Exception as e:
+        print(f"[indexer] очистка: ошибка {e!r}", flush=True)
+        return
+    print(f"[indexer] очистка: {stats}", flush=True)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Фоновая индексация заказов в статусе «упаковка» в IndexDB")
+    ap.add_argument("--loop", action="store_true", help="работать постоянно, по расписанию")
+    ap.add_argument("--interval", type=int, default=None, help="секунд между проходами (INDEX_INTERVAL_S)")
+    ap.add_argument("--full", action="store_true", help="первый проход — полный, без watermark (и каталог целиком)")
+    ap.add_argument("--db", default=None, help="путь к sqlite (INDEX_DB_PATH)")
+    ap.add_argument("--profile", type=int, default=None, help="профилировать первые N проходов (PROFILE_INDEXING)")
+    args = ap.parse_args(argv)
+
+    load_dotenv()
+    cfg = Settings.from_env()
+    if not cfg.MS_PACKING_STATE_HREF.strip():
+        ap.error("не задан MS_PACKING_STATE_HREF")
+
+    db_path = args.db or cfg.INDEX_DB_PATH
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    db = IndexDB(db_path)
+    db.init()
+    ms = MoySkladClient(token=cfg.MS_TOKEN, base_url=cfg.MS_BASE_URL, cache=cfg.make_cache())
+
+    interval = int(args.interval or cfg.INDEX_INTERVAL_S)
+    source = sync_source_key(cfg.MS_PACKING_STATE_HREF)
+    full_resync = bool(args.full)
+    passes = 0
+    profile_left = int(cfg.PROFILE_INDEXING if args.profile is None else args.profile)
+    lease = LeaseKeeper(db, lease_name(cfg.MS_PACKING_STATE_HREF), ttl_s=cfg.INDEX_LEASE_TTL_S)
+
+    try:
+        while True:
+            ok = True
+            if lease.acquire():
+                # профиль — по счётчику при старте или по запросу из UI (забирает только держатель lease)
+                profile = db.take_profile_request(source) or profile_left > 0
+                with profiled("indexing", enabled=profile, out_dir=cfg.PROFILE_DIR):
+                    ok = run_once(ms, db, cfg, full_resync=full_resync, cancel=lease.lost)
+                if profile:
+                    profile_left = max(0, profile_left - 1)
+                full_resync = False
+                if ok and cfg.INDEX_PRUNE_EVERY > 0 and passes % cfg.INDEX_PRUNE_EVERY == 0:
+                    run_prune(ms, db, cfg)
+                passes += 1
+            else:
+                info = db.lease_info(lease.name) or {}
+                print(f"[indexer] индексирует другой процесс: {info.get('holder')}", flush=True)
+            if not args.loop:
+                return 0 if ok else 1
+
+            # ждём интервал, но раньше — если из UI попросили «обновить сейчас» (запрос забирает держатель lease);
+            # без lease проверяем чаще, не освободился ли он (держатель упал)
+            deadline = time.monotonic() + (interval if lease.held() else min(interval, lease.ttl_s))
+            while time.monotonic() < deadline:
+                if lease.held() and db.take_sync_request(source):
+                    break
+                time.sleep(2)
+    finally:
+        lease.release()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
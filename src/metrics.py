@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+# границы корзин гистограммы задержек, сек
+LATENCY_BUCKETS: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 90.0)
+
+_ID_RE = re.compile(r"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)")
+_API_PREFIX_RE = re.compile(r"^/api/remap/[\d.]+")
+
+
+def endpoint_template(url: str) -> str:
+    """https://.../api/remap/1.2/entity/customerorder/<uuid>/positions -> /entity/customerorder/{id}/positions"""
+    path = urlparse(url).path or "/"
+    path = _API_PREFIX_RE.sub("", path)
+    return _ID_RE.sub("/{id}", path) or "/"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Оценка квантиля: линейная интерполяция внутри корзины, как histogram_quantile в Prometheus.
+        Края корзины сужены до наблюдённых min/max — иначе все вызовы по 9 мс дали бы p50 = 25 мс.
+        """
+        if not self.count:
+            return 0.0
+        rank = min(max(q, 0.0), 1.0) * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lo = max(self.buckets[i - 1] if i > 0 else 0.0, self.min)
+                hi = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return self.max
+
+
+def _labels(**kv: Any) -> str:
+    parts = []
+    for k, v in kv.items():
+        s = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{s}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class HttpMetrics:
+    """
+    Метрики HTTP-слоя и стадий индексации: гистограммы задержек по шаблону эндпоинта,
+    ответы по статусам, ретраи, 429, таймауты, байты; суммарное время стадий run_indexing.
+    Потокобезопасно: пишут все потоки пула клиента.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latency: Dict[Tuple[str, str], Histogram] = {}  # (method, endpoint) -> Histogram
+        self.responses: Dict[Tuple[str, int], int] = {}  # (endpoint, status) -> n
+        self.retries: Dict[str, int] = {}
+        self.throttled: Dict[str, int] = {}  # 429
+        self.timeouts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}  # сетевые ошибки без ответа, кроме таймаутов
+        self.bytes_in: Dict[str, int] = {}
+        self.bytes_out: Dict[str, int] = {}
+        self.stages: Dict[str, List[float]] = {}  # stage -> [seconds_total, calls]
+        self.started_at = time.time()
+
+    @staticmethod
+    def _inc(d: Dict[Any, int], key: Any, n: int = 1) -> None:
+        d[key] = d.get(key, 0) + n
+
+    def observe_response(
+        self, method: str, endpoint: str, status: int, seconds: float, bytes_in: int = 0, bytes_out: int = 0
+    ) -> None:
+        with self._lock:
+            h = self.latency.get((method, endpoint))
+            if h is None:
+                h = self.latency[(method, endpoint)] = Histogram()
+            h.observe(seconds)
+            self._inc(self.responses, (endpoint, int(status)))
+            if status == 429:
+                self._inc(self.throttled, endpoint)
+            self._inc(self.bytes_in, endpoint, int(bytes_in))
+            self._inc(self.bytes_out, endpoint, int(bytes_out))
+
+    def observe_failure(self, endpoint: str, timeout: bool) -> None:
+        with self._lock:
+            self._inc(self.timeouts if timeout else self.errors, endpoint)
+
+    def observe_retry(self, endpoint: str) -> None:
+        with self._lock:
+            self._inc(self.retries, endpoint)
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            acc = self.stages.setdefault(stage, [0.0, 0])
+            acc[0] += seconds
+            acc[1] += 1
+
+    # ---------------- выдача ----------------
+
+    def stats(self) -> Dict[str, Any]:
+        """Сводка для сайдбара: по эндпоинту — число запросов, p50/p95, ретраи, 429, таймауты, байты."""
+        with self._lock:
+            endpoints: Dict[str, Dict[str, Any]] = {}
+            for (method, ep), h in self.latency.items():
+                key = f"{method} {ep}"
+                endpoints[key] = {
+                    "requests": h.count,
+                    "avg_ms": round(h.sum / h.count * 1000, 1) if h.count else 0.0,
+                    "p50_ms": round(h.quantile(0.5) * 1000, 1),
+                    "p95_ms": round(h.quantile(0.95) * 1000, 1),
+                }
+            per_ep = {
+                ep: {
+                    "retries": self.retries.get(ep, 0),
+                    "429": self.throttled.get(ep, 0),
+                    "timeouts": self.timeouts.get(ep, 0),
+                    "bytes_in": self.bytes_in.get(ep, 0),
+                }
+                for ep in set(self.retries) | set(self.throttled) | set(self.timeouts) | set(self.bytes_in)
+            }
+            for key, row in endpoints.items():
+                row.update(per_ep.get(key.split(" ", 1)[1], {}))
+            return {
+                "requests": sum(h.count for h in self.latency.values()),
+                "retries": sum(self.retries.values()),
+                "429": sum(self.throttled.values()),
+                "timeouts": sum(self.timeouts.values()),
+                "errors": sum(self.errors.values()),
+                "bytes_in": sum(self.bytes_in.values()),
+                "bytes_out": sum(self.bytes_out.values()),
+                "endpoints": endpoints,
+                "stages_s": {k: round(v[0], 3) for k, v in self.stages.items()},
+            }
+
+    def prometheus_text(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            lines.append("# HELP ms_http_request_seconds Латентность запросов к МС по шаблону эндпоинта")
+            lines.append("# TYPE ms_http_request_seconds histogram")
+            for (method, ep), h in sorted(self.latency.items()):
+                acc = 0
+                for i, b in enumerate(h.buckets):
+                    acc += h.counts[i]
+                    lines.append(f"ms_http_request_seconds_bucket{_labels(method=method, endpoint=ep, le=b)} {acc}")
+                lines.append(f"ms_http_request_seconds_bucket{_labels(method=method, endpoint=ep, le='+Inf')} {h.count}")
+                lines.append(f"ms_http_request_seconds_sum{_labels(method=method, endpoint=ep)} {h.sum:.6f}")
+                lines.append(f"ms_http_request_seconds_count{_labels(method=method, endpoint=ep)} {h.count}")
+
+            lines.append("# TYPE ms_http_responses_total counter")
+            for (ep, status), n in sorted(self.responses.items()):
+                lines.append(f"ms_http_responses_total{_labels(endpoint=ep, status=status)} {n}")
+
+            for name, data in (
+                ("ms_http_retries_total", self.retries),
+                ("ms_http_throttled_total", self.throttled),
+                ("ms_http_timeouts_total", self.timeouts),
+                ("ms_http_errors_total", self.errors),
+                ("ms_http_received_bytes_total", self.bytes_in),
+                ("ms_http_sent_bytes_total", self.bytes_out),
+            ):
+                lines.append(f"# TYPE {name} counter")
+                for ep, n in sorted(data.items()):
+                    lines.append(f"{name}{_labels(endpoint=ep)} {n}")
+
+            lines.append("# TYPE indexer_stage_seconds_total counter")
+            for stage, (secs, _) in sorted(self.stages.items()):
+                lines.append(f"indexer_stage_seconds_total{_labels(stage=stage)} {secs:.6f}")
+            lines.append("# TYPE indexer_stage_runs_total counter")
+            for stage, (_, calls) in sorted(self.stages.items()):
+                lines.append(f"indexer_stage_runs_total{_labels(stage=stage)} {int(calls)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """Атомарно (через временный файл) — под node_exporter textfile collector или ручной просмотр."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+
+class StageTimer:
+    """Время стадий одного прохода (сумма по потокам) + копия в HttpMetrics для накопленных метрик."""
+
+    def __init__(self, metrics: Optional[HttpMetrics] = None):
+        self.metrics = metrics
+        self.seconds: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + dt
+            if self.metrics is not None:
+                self.metrics.observe_stage(name, dt)
+
+    def as_ms(self) -> Dict[str, int]:
+        with self._lock:
+            return {f"{k}_ms": int(round(v * 1000)) for k, v in self.seconds.items()}
@@ -1,18 +1,17 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Any, Dict, Optional, List, Tuple
-from datetime import datetime
-import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, List, Sequence, Tuple
+from datetime import datetime, timedelta
+import threading
 
-import requests
-
-
-class HttpError(Exception):
-    def __init__(self, status: int, payload: Any):
-        super().__init__(f"HTTP {status}: {payload}")
-        self.status = status
-        self.payload = payload
+from src.cache import ResponseCache
+from src.cis_logic import replace_cis_block
+from src.http import HttpError, HttpTransport, RateLimiter, default_transport
+from src.metrics import HttpMetrics
 
 
 def parse_ms_dt(s: str) -> Optional[datetime]:
@@ -27,8 +26,37 @@ def parse_ms_dt(s: str) -> Optional[datetime]:
     return None
 
 
-def _should_retry_http(status: int) -> bool:
-    return status in (429, 500, 502, 503, 504)
+# запас к перекрытию watermark: округление фильтра МС до секунды, задержка индексации изменений на стороне МС
+WATERMARK_MARGIN_S = 5.0
+
+
+def watermark_after_crawl(newest: str, previous: str, crawl_s: float, margin_s: float = WATERMARK_MARGIN_S) -> str:
+    """
+    Watermark после прохода: самый новый `updated` минус длительность обхода (и запас), но не меньше прежнего.
+    Сущность, изменённая во время обхода уже после чтения её страницы, имеет updated не раньше начала обхода
+    по часам МС, а newest — не позже его конца: сдвиг на длительность даёт перекрытие без сверки часов.
+    Повторно прочитанное в следующей дельте дёшево (заказы с тем же updated индексатор пропускает).
+    """
+    if not newest or newest == previous:
+        return previous
+    dt = parse_ms_dt(newest)
+    if dt is None:
+        return previous
+    shifted = (dt - timedelta(seconds=max(0.0, crawl_s) + margin_s)).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    return max(shifted, previous or "")
+
+
+# максимальный limit списков МС; с expand — не больше 100
+MS_MAX_PAGE_LIMIT = 1000
+MS_EXPAND_PAGE_LIMIT = 100
+# массовое создание/обновление: до 1000 объектов в одном POST
+MS_MASS_UPDATE_LIMIT = 1000
+
+
+def id_from_href(href: str) -> str:
+    """.../entity/product/<id>?expand=... -> <id>"""
+    h = (href or "").split("?", 1)[0].rstrip("/")
+    return h.rsplit("/", 1)[-1] if h else ""
 
 
 def request_json(
@@ -39,59 +67,43 @@ def request_json(
     json: Any = None,
     timeout: Tuple[float, float] = (20.0, 90.0),  # (connect, read)
     max_retries: int = 4,
+    transport: Optional[HttpTransport] = None,
 ) -> Any:
-    last_exc: Optional[Exception] = None
-
-    for attempt in range(1, max_retries + 1):
-        try:
-            resp = requests.request(
-                method,
-                url,
-                headers=headers,
-                params=params,
-                json=json,
-                timeout=timeout,
-            )
-
-            if resp.status_code >= 400:
-                try:
-                    payload = resp.json()
-                except Exception:
-                    payload = resp.text
-
-                if _should_retry_http(resp.status_code) and attempt < max_retries:
-                    time.sleep(min(2.0, 0.4 * (2 ** (attempt - 1))))
-                    continue
-
-                raise HttpError(resp.status_code, payload)
-
-            if resp.status_code == 204:
-                return None
-            return resp.json()
-
-        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectTimeout) as e:
-            last_exc = e
-            if attempt < max_retries:
-                time.sleep(min(2.0, 0.4 * (2 ** (attempt - 1))))
-                continue
-            raise
-
-        except requests.exceptions.RequestException as e:
-            last_exc = e
-            if attempt < max_retries:
-                time.sleep(min(2.0, 0.4 * (2 ** (attempt - 1))))
-                continue
-            raise
-
-    if last_exc:
-        raise last_exc
-    raise RuntimeError("request_json failed unexpectedly")
+    t = transport or default_transport()
+    return t.request_json(method, url, headers=headers, params=params, json=json, timeout=timeout, max_retries=max_retries)
 
 
 @dataclass
 class MoySkladClient:
     token: str
     base_url: str = "https://api.moysklad.ru/api/remap/1.2"
+    # лимиты МС: 45 запросов / 3 сек и 5 параллельных запросов на аккаунт
+    rate_limit: int = 45
+    rate_window_s: float = 3.0
+    max_parallel: int = 5
+    # пул keep-alive соединений (должен быть не меньше max_parallel)
+    pool_connections: int = 4
+    pool_maxsize: int = 10
+    # кэш GET-ответов (опционально): TTL по типу сущности, LRU, single-flight
+    cache: Optional[ResponseCache] = None
+    # метрики HTTP (латентность по эндпоинтам, ретраи, 429, таймауты, байты) и стадий индексации
+    metrics: HttpMetrics = field(default_factory=HttpMetrics)
+
+    _limiter: RateLimiter = field(init=False, repr=False)
+    transport: HttpTransport = field(init=False, repr=False)
+    _pool: Optional[ThreadPoolExecutor] = field(default=None, init=False, repr=False)
+    _pool_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _attr_ids: Dict[str, str] = field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._limiter = RateLimiter(self.rate_limit, self.rate_window_s, self.max_parallel)
+        self.transport = HttpTransport(
+            headers=self._headers(),
+            pool_connections=self.pool_connections,
+            pool_maxsize=max(self.pool_maxsize, self.max_parallel),
+            limiter=self._limiter,
+            metrics=self.metrics,
+        )
 
     def _headers(self) -> Dict[str, str]:
         auth = (self.token or "").strip()
@@ -103,13 +115,182 @@ class MoySkladClient:
             "Content-Type": "application/json",
         }
 
-    def get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+    def get(self, path: str, params: Optional[Dict[str, Any]] = None, cache: bool = True) -> Any:
+        """cache=False — мимо ResponseCache (списки, где важна свежесть: дельта каталога по updated)."""
         url = f"{self.base_url}{path}"
-        return request_json("GET", url, headers=self._headers(), params=params)
+        if self.cache is None or not cache:
+            return self.transport.request_json("GET", url, params=params)
+        return self.cache.get_or_fetch(path, params, lambda: self.transport.request_json("GET", url, params=params))
 
     def put(self, path: str, payload: Any) -> Any:
         url = f"{self.base_url}{path}"
-        return request_json("PUT", url, headers=self._headers(), json=payload)
+        out = self.transport.request_json("PUT", url, json=payload)
+        if self.cache is not None:
+            self.cache.invalidate(path)
+        return out
+
+    def post(self, path: str, payload: Any) -> Any:
+        url = f"{self.base_url}{path}"
+        out = self.transport.request_json("POST", url, json=payload)
+        if self.cache is not None:
+            self.cache.invalidate(path)
+        return out
+
+    # ---------------- параллельные GET ----------------
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=max(1, self.max_parallel), thread_name_prefix="ms")
+            return self._pool
+
+    def submit_get(self, path: str, params: Optional[Dict[str, Any]] = None, cache: bool = True) -> "Future[Any]":
+        return self._executor().submit(self.get, path, params, cache)
+
+    def gather_get(self, calls: Sequence[Tuple[str, Optional[Dict[str, Any]]]]) -> List[Any]:
+        """
+        Пачка GET через общий пул (в рамках лимитов МС). Результаты — в порядке calls.
+        Не вызывать из задач самого пула.
+        """
+        if not calls:
+            return []
+        if len(calls) == 1:
+            path, params = calls[0]
+            return [self.get(path, params)]
+        futures = [self.submit_get(path, params) for path, params in calls]
+        return [f.result() for f in futures]
+
+    def iter_pages(
+        self,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        page_size: int = MS_MAX_PAGE_LIMIT,
+        max_total: Optional[int] = None,
+        stop_before: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        max_inflight: Optional[int] = None,
+        cache: bool = True,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Постраничный список с параллельной догрузкой: первая страница даёт meta.size,
+        остальные окна offset запрашиваются сразу (не больше max_inflight одновременно, в рамках лимитов МС).
+        Страницы отдаются строго по порядку offset, т.е. в порядке сортировки запроса.
+        stop_before(row) -> True — строка и всё после неё уже не нужны (например, moment < date_from при moment,desc).
+        cache=False — страницы не берутся из ResponseCache и не кладутся в него.
+        """
+        params = dict(params or {})
+        cap = MS_EXPAND_PAGE_LIMIT if params.get("expand") else MS_MAX_PAGE_LIMIT
+        page_size = max(1, min(int(page_size), cap))
+        limit_total = int(max_total) if max_total is not None else None
+        if limit_total is not None and limit_total <= 0:
+            return
+
+        seen: set = set()
+
+        def _rows(page: Any) -> Tuple[List[Dict[str, Any]], bool]:
+            rows = page.get("rows", []) if isinstance(page, dict) else []
+            out: List[Dict[str, Any]] = []
+            for r in rows:
+                if stop_before and stop_before(r):
+                    return out, True
+                # пока листаем, в начало списка могут добавиться заказы и сдвинуть offset — дубли убираем
+                rid = r.get("id") if isinstance(r, dict) else None
+                if rid and rid in seen:
+                    continue
+                if rid:
+                    seen.add(rid)
+                out.append(r)
+            return out, False
+
+        first_take = page_size if limit_total is None else min(page_size, limit_total)
+        first = self.get(path, params={**params, "limit": first_take, "offset": 0}, cache=cache)
+        rows, stopped = _rows(first)
+        if rows:
+            yield rows
+        raw_len = len(first.get("rows", []) if isinstance(first, dict) else [])
+        if stopped or raw_len < first_take:
+            return
+
+        size = (first.get("meta") or {}).get("size") if isinstance(first, dict) else None
+        end = int(size) if size is not None else None
+        if limit_total is not None:
+            end = limit_total if end is None else min(end, limit_total)
+        if end is None:
+            # МС не сообщил размер — листаем последовательно
+            offset = raw_len
+            while True:
+                page = self.get(path, params={**params, "limit": page_size, "offset": offset}, cache=cache)
+                rows, stopped = _rows(page)
+                if rows:
+                    yield rows
+                n = len(page.get("rows", []) if isinstance(page, dict) else [])
+                if stopped or n < page_size:
+                    return
+                offset += n
+
+        offsets = iter(range(raw_len, end, page_size))
+        window = max(1, int(max_inflight or self.max_parallel * 2))
+        pending: Deque["Future[Any]"] = deque()
+
+        def _submit(off: int) -> None:
+            pending.append(
+                self.submit_get(path, {**params, "limit": min(page_size, end - off), "offset": off}, cache=cache)
+            )
+
+        for off in islice(offsets, window):
+            _submit(off)
+        try:
+            while pending:
+                page = pending.popleft().result()
+                nxt = next(offsets, None)
+                if nxt is not None:
+                    _submit(nxt)
+                rows, stopped = _rows(page)
+                if rows:
+                    yield rows
+                if stopped or not (page.get("rows") if isinstance(page, dict) else None):
+                    return
+        finally:
+            for f in pending:
+                f.cancel()
+
+    def get_many(
+        self,
+        entity_type: str,
+        ids: Sequence[str],
+        expand: str = "",
+        chunk_size: int = 40,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Сущности по списку id: filter=id=..;id=.. (условия по одному полю МС объединяет через ИЛИ).
+        Дубли убираются, чанки уходят параллельно. Результат: {id: entity}, ненайденных id в нём нет.
+        """
+        uniq = list(dict.fromkeys(str(i).strip() for i in ids if i and str(i).strip()))
+        if not uniq:
+            return {}
+        # длина URL + лимит 100 строк на страницу при expand
+        chunk_size = max(1, min(int(chunk_size), 100))
+        calls: List[Tuple[str, Optional[Dict[str, Any]]]] = []
+        for i in range(0, len(uniq), chunk_size):
+            chunk = uniq[i : i + chunk_size]
+            params: Dict[str, Any] = {"filter": ";".join(f"id={x}" for x in chunk), "limit": len(chunk)}
+            if expand:
+                params["expand"] = expand
+            calls.append((f"/entity/{entity_type}", params))
+
+        out: Dict[str, Dict[str, Any]] = {}
+        for page in self.gather_get(calls):
+            rows = page.get("rows", []) if isinstance(page, dict) else []
+            for row in rows:
+                if isinstance(row, dict) and row.get("id"):
+                    out[str(row["id"])] = row
+        return out
+
+    def close(self) -> None:
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+        self.transport.session.close()
 
     # ---------------- CustomerOrder ----------------
 
@@ -126,6 +307,28 @@ class MoySkladClient:
         )
         return page.get("rows", []) if isinstance(page, dict) else []
 
+    def iter_customerorders(
+        self,
+        limit_total: int,
+        page_size: int = MS_MAX_PAGE_LIMIT,
+        date_from_dt: Optional[datetime] = None,
+        max_inflight: Optional[int] = None,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """Последние заказы (moment,desc) страницами с параллельной догрузкой; стоп на date_from_dt."""
+
+        def _older(co: Dict[str, Any]) -> bool:
+            m = parse_ms_dt(co.get("moment", ""))
+            return bool(date_from_dt and m and m < date_from_dt)
+
+        return self.iter_pages(
+            "/entity/customerorder",
+            params={"order": "moment,desc"},
+            page_size=page_size,
+            max_total=limit_total,
+            stop_before=_older if date_from_dt else None,
+            max_inflight=max_inflight,
+        )
+
     @staticmethod
     def _match_attrs(attrs: List[Dict[str, Any]], attr_id: str, attr_name: str, value: str) -> bool:
         for a in (attrs or []):
@@ -137,6 +340,48 @@ class MoySkladClient:
                 return True
         return False
 
+    def customerorder_attr_id(self, attr_name: str) -> str:
+        """id доп. поля заказа по имени (метаданные читаются один раз)."""
+        attr_name = (attr_name or "").strip()
+        if not attr_name:
+            return ""
+        if attr_name not in self._attr_ids:
+            page = self.get("/entity/customerorder/metadata/attributes")
+            for a in (page.get("rows", []) if isinstance(page, dict) else []):
+                if a.get("name") and a.get("id"):
+                    self._attr_ids[str(a["name"]).strip()] = str(a["id"])
+        return self._attr_ids.get(attr_name, "")
+
+    def find_customerorders_by_attr(
+        self,
+        value: str,
+        attr_id: str = "",
+        attr_name: str = "",
+        expand: str = "",
+        limit: int = 10,
+    ) -> List[Dict[str, Any]]:
+        """
+        Заказы по значению доп. поля — фильтром на стороне МС (один запрос).
+        Фильтр по доп. полю задаётся href-ом его метаданных, поэтому нужен id (или имя — тогда id найдём).
+        """
+        value = (value or "").strip()
+        attr_id = (attr_id or "").strip() or self.customerorder_attr_id(attr_name)
+        if not value:
+            return []
+        if not attr_id:
+            raise ValueError(f"attribute not found: {attr_name!r}")
+        # ';' в значении — разделитель условий фильтра МС, экранируем
+        v = value.replace("\\", "\\\\").replace(";", "\\;")
+        params: Dict[str, Any] = {
+            "filter": f"{self.base_url}/entity/customerorder/metadata/attributes/{attr_id}={v}",
+            "order": "moment,desc",
+            "limit": int(limit),
+        }
+        if expand:
+            params["expand"] = expand
+        page = self.get("/entity/customerorder", params=params)
+        return page.get("rows", []) if isinstance(page, dict) else []
+
     def find_customerorder_by_attr_value_recent(
         self,
         value: str,
@@ -161,6 +406,21 @@ class MoySkladClient:
                 df += " 00:00:00"
             date_from_dt = parse_ms_dt(df)
 
+        # быстрый путь: фильтр по доп. полю на стороне МС
+        try:
+            rows = self.find_customerorders_by_attr(value, attr_id=attr_id, attr_name=attr_name, limit=1)
+        except (ValueError, HttpError):
+            rows = None  # id поля не определить или МС не принял фильтр — остаётся перебор
+        if rows is not None:
+            if progress_cb:
+                progress_cb(len(rows), limit_total, 0, 0)
+            if not rows:
+                return None
+            m = parse_ms_dt(rows[0].get("moment", ""))
+            if date_from_dt and m and m < date_from_dt:
+                return None
+            return rows[0]
+
         offset = 0
         scanned = 0
         full_reads = 0
@@ -171,23 +431,12 @@ class MoySkladClient:
 
         _progress()
 
-        while scanned < limit_total:
-            take = min(page_size, limit_total - scanned)
-            rows = self.list_customerorders_page(limit=take, offset=offset)
-            if not rows:
-                break
-
+        # страницы догружаются параллельно; окно маленькое — совпадение обычно в первых страницах
+        for rows in self.iter_customerorders(limit_total, page_size=page_size, date_from_dt=date_from_dt, max_inflight=2):
             for co in rows:
                 if scanned >= limit_total:
                     break
 
-                # ранний stop по дате
-                if date_from_dt:
-                    m = parse_ms_dt(co.get("moment", ""))
-                    if m and m < date_from_dt:
-                        _progress()
-                        return None
-
                 scanned += 1
 
                 # если attributes вдруг пришли в short-rows — проверим сразу
@@ -220,8 +469,100 @@ class MoySkladClient:
             offset += len(rows)
             _progress()
 
+        # ранний stop по дате — внутри iter_customerorders
+        _progress()
         return None
 
+    def _order_meta(self, order_id: str) -> Dict[str, str]:
+        return {
+            "href": f"{self.base_url}/entity/customerorder/{order_id}",
+            "type": "customerorder",
+            "mediaType": "application/json",
+        }
+
+    def bulk_update_customerorders(
+        self,
+        updates: Dict[str, Dict[str, Any]],
+        chunk_size: int = 100,
+    ) -> Dict[str, Optional[Exception]]:
+        """
+        Массовое обновление заказов: POST /entity/customerorder массивом {meta, ...поля}.
+        updates: {order_id: {"description": ...}}. Результат по каждому заказу: None — ок, иначе ошибка.
+        Заказы, не прошедшие в пачке (ошибка элемента или всего запроса), повторяются по одному через PUT.
+        """
+        ids = list(updates)
+        chunk_size = max(1, min(int(chunk_size), MS_MASS_UPDATE_LIMIT))
+        out: Dict[str, Optional[Exception]] = {}
+        retry: List[str] = []
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i : i + chunk_size]
+            body = [dict(updates[oid], meta=self._order_meta(oid)) for oid in chunk]
+            try:
+                resp = self.post("/entity/customerorder", body)
+            except HttpError as e:
+                # МС может ответить ошибкой, но с массивом результатов по элементам
+                resp = e.payload if isinstance(e.payload, list) and len(e.payload) == len(chunk) else None
+                if resp is None:
+                    retry.extend(chunk)
+                    continue
+            except Exception:
+                retry.extend(chunk)
+                continue
+            rows = resp if isinstance(resp, list) else []
+            if self.cache is not None:
+                for oid in chunk:
+                    self.cache.invalidate(f"/entity/customerorder/{oid}")
+            for j, oid in enumerate(chunk):
+                row = rows[j] if j < len(rows) else None
+                if isinstance(row, dict) and not row.get("errors"):
+                    out[oid] = None
+                else:
+                    retry.append(oid)
+
+        for oid in retry:
+            try:
+                self.put(f"/entity/customerorder/{oid}", updates[oid])
+                out[oid] = None
+            except Exception as e:
+                out[oid] = e
+        return out
+
+    def set_customerorders_cis_blocks(self, blocks: Dict[str, List[str]]) -> Dict[str, Any]:
+        """
+        [CIS] для многих заказов: описания — пачкой (get_many), запись — одним массовым POST.
+        Результат по заказу: "updated" | "unchanged" | Exception.
+        """
+        current = self.get_many("customerorder", list(blocks))
+        out: Dict[str, Any] = {}
+        updates: Dict[str, Dict[str, Any]] = {}
+        for oid, codes in blocks.items():
+            cur = current.get(oid)
+            if cur is None:
+                out[oid] = HttpError(404, f"customerorder {oid} not found")
+                continue
+            desc = cur.get("description") or ""
+            new_desc = replace_cis_block(desc, codes)
+            if new_desc == desc:
+                out[oid] = "unchanged"
+            else:
+                updates[oid] = {"description": new_desc}
+        for oid, err in self.bulk_update_customerorders(updates).items():
+            out[oid] = err if err is not None else "updated"
+        return out
+
+    def set_customerorder_cis_block(self, order_id: str, codes: List[str]) -> bool:
+        """
+        Идемпотентная запись [CIS]: блок заменяется, а не дописывается, поэтому повтор после
+        таймаута не плодит дубли. Если описание уже такое — PUT не делаем. True — был PUT.
+        """
+        cur = self.get_customerorder(order_id)
+        desc = cur.get("description") or ""
+        new_desc = replace_cis_block(desc, codes)
+        if new_desc == desc:
+            return False
+        self.put(f"/entity/customerorder/{order_id}", {"description": new_desc})
+        return True
+
     def append_to_customerorder_description(self, order_id: str, text_to_append: str) -> Dict[str, Any]:
         cur = self.get_customerorder(order_id)
         desc = cur.get("description") or ""
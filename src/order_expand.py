@@ -1,56 +1,142 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-from src.moysklad import MoySkladClient
+from src.catalog import item_row, load_bundles
+from src.index_db import IndexDB
+from src.moysklad import MoySkladClient, id_from_href
 from src.cis_logic import _get_attr_bool
 
+
+def _ref(ass: Dict[str, Any]) -> Tuple[str, str]:
+    meta = ass.get("meta") or {}
+    return (meta.get("type") or "", id_from_href(meta.get("href") or ""))
+
+
+def _fetch_by_type(ms: MoySkladClient, refs: List[Tuple[str, str]], expand: str) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    by_type: Dict[str, List[str]] = {}
+    for t, i in refs:
+        if t and i:
+            by_type.setdefault(t, []).append(i)
+    out: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for t, ids in by_type.items():
+        for i, ent in ms.get_many(t, ids, expand=expand).items():
+            out[(t, i)] = ent
+    return out
+
+
+def _view_remote(
+    ms: MoySkladClient,
+    refs: List[Tuple[str, str]],
+    attr_cis_required: str,
+    bundle_mark_flag: str,
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """Комплекты и товары прямо из МС: bundle_id -> {name, marked, components}, id -> {name, cis_required}."""
+    bundles_raw = _fetch_by_type(ms, [r for r in refs if r[0] == "bundle"], expand="components.assortment")
+    items_raw = _fetch_by_type(ms, [r for r in refs if r[0] != "bundle"], expand="attributes")
+
+    comp_refs: List[Tuple[str, str]] = []
+    for bundle in bundles_raw.values():
+        comp_refs.extend(_ref(c.get("assortment") or {}) for c in (bundle.get("components") or {}).get("rows") or [])
+    components = _fetch_by_type(ms, comp_refs, expand="attributes")
+
+    bundles: Dict[str, Dict[str, Any]] = {}
+    for (_, bid), bundle in bundles_raw.items():
+        comps = []
+        for c in (bundle.get("components") or {}).get("rows") or []:
+            c_ref = _ref(c.get("assortment") or {})
+            if not c_ref[1]:
+                continue
+            c_full = components.get(c_ref) or c.get("assortment") or {}
+            comps.append({
+                "name": c_full.get("name"),
+                "quantity": c.get("quantity"),
+                "cis_required": _get_attr_bool(c_full, attr_cis_required),
+            })
+        bundles[bid] = {"marked": _get_attr_bool(bundle, bundle_mark_flag), "components": comps}
+    items = {
+        i: {"name": full.get("name"), "cis_required": _get_attr_bool(full, attr_cis_required)}
+        for (_, i), full in items_raw.items()
+    }
+    return bundles, items
+
+
+def _view_local(
+    ms: MoySkladClient,
+    db: IndexDB,
+    refs: List[Tuple[str, str]],
+    attr_cis_required: str,
+    bundle_mark_flag: str,
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """То же из зеркала каталога; в МС — только то, чего в зеркале нет."""
+    loaded = load_bundles(ms, db, [i for t, i in refs if t == "bundle" and i], attr_cis_required, bundle_mark_flag)
+    bundles: Dict[str, Dict[str, Any]] = {}
+    for bid, b in loaded.items():
+        comps = [
+            {"name": (c.get("assortment") or {}).get("name"), "quantity": c.get("quantity"), "cis_required": c.get("cis_required")}
+            for c in (b.get("components") or {}).get("rows") or []
+            if (c.get("assortment") or {}).get("id")
+        ]
+        bundles[bid] = {"marked": b.get("marked"), "components": comps}
+
+    item_refs = [r for r in refs if r[0] != "bundle" and r[1]]
+    items = db.catalog_items([i for _, i in item_refs])
+    missing = [r for r in item_refs if r[1] not in items]
+    if missing:
+        fetched = _fetch_by_type(ms, missing, expand="attributes")
+        db.catalog_upsert_items([item_row(ent, attr_cis_required) for ent in fetched.values()])
+        items.update(db.catalog_items([i for _, i in fetched]))
+    return bundles, items
+
+
 def calc_expected_cis_units(
     ms: MoySkladClient,
     order_full: Dict[str, Any],
     attr_cis_required: str,
     bundle_mark_flag: str,
     max_component_fetch: int,
+    db: Optional[IndexDB] = None,
 ) -> Tuple[int, List[Dict[str, Any]], List[str]]:
+    """db — брать каталог из локального зеркала (src.catalog), а не из МС."""
     warnings: List[str] = []
     lines: List[Dict[str, Any]] = []
     expected = 0
 
     positions = (order_full.get("positions") or {}).get("rows") or []
 
-    for pos in positions:
+    # 1) собираем все id, 2) тянем пачками (зеркало / get_many), 3) считаем локально
+    refs = [_ref(pos.get("assortment") or {}) for pos in positions]
+    if db is not None:
+        bundles, items = _view_local(ms, db, refs, attr_cis_required, bundle_mark_flag)
+    else:
+        bundles, items = _view_remote(ms, refs, attr_cis_required, bundle_mark_flag)
+
+    for pos, ref in zip(positions, refs):
         qty = int(round(pos.get("quantity") or 0))
         ass = pos.get("assortment") or {}
-        meta = ass.get("meta") or {}
-        a_type = meta.get("type")
+        a_type = ref[0]
 
         if a_type == "bundle":
-            bundle_href = meta.get("href")
-            if not bundle_href:
+            if not ref[1]:
                 warnings.append("Bundle без href")
                 continue
 
-            bundle = ms.get(bundle_href, params={"expand": "attributes"})
-            bundle_marked = bool(_get_attr_bool(bundle, bundle_mark_flag) or False)
+            bundle = bundles.get(ref[1]) or {}
+            bundle_marked = bool(bundle.get("marked") or False)
 
-            comps = ms.get_bundle_components(bundle_href)
+            comps = bundle.get("components") or []
             if len(comps) > max_component_fetch:
                 warnings.append(f"Слишком много компонентов в комплекте (>{max_component_fetch}), обрежу список")
                 comps = comps[:max_component_fetch]
 
             for c in comps:
                 c_qty = int(round(c.get("quantity") or 0))
-                c_ass = c.get("assortment") or {}
-                c_href = (c_ass.get("meta") or {}).get("href")
-                if not c_href:
-                    continue
-
-                c_full = ms.get(c_href, params={"expand": "attributes"})
-                need = True
+                # маркируемый комплект — КМ на каждый компонент, иначе — по признаку товара
+                need = bundle_marked or bool(c.get("cis_required") or False)
                 units = qty * c_qty
 
                 lines.append({
                     "type": "component",
-                    "name": c_full.get("name"),
+                    "name": c.get("name"),
                     "bundle": ass.get("name"),
                     "need_cis": need,
                     "units": units,
@@ -60,11 +146,10 @@ def calc_expected_cis_units(
                     expected += units
 
         else:
-            href = meta.get("href")
-            if not href:
+            if not ref[1]:
                 continue
-            full = ms.get(href, params={"expand": "attributes"})
-            need = bool(_get_attr_bool(full, attr_cis_required) or False)
+            full = items.get(ref[1]) or {}
+            need = bool(full.get("cis_required") or False)
             lines.append({
                 "type": "item",
                 "name": full.get("name"),
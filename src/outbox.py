@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import uuid
+from typing import Dict, Optional
+
+from src.http import HttpError
+from src.index_db import IndexDB
+from src.moysklad import MoySkladClient
+
+
+def _is_permanent(e: Exception) -> bool:
+    # 4xx (кроме 429) не лечится повтором: заказ удалён, нет прав, битый payload
+    return isinstance(e, HttpError) and 400 <= e.status < 500 and e.status != 429
+
+
+class OutboxFlusher:
+    """
+    Фоновая доставка блоков [CIS] из cis_outbox в МС. Упаковщик не ждёт МС: отправка
+    только пишет в outbox, а этот воркер доставляет с повторами и паузами.
+    Запись идемпотентна (replace_cis_block), поэтому повтор после таймаута безопасен.
+    Несколько процессов могут работать с одним outbox: записи разбираются через claim.
+    """
+
+    def __init__(
+        self,
+        ms: MoySkladClient,
+        db: IndexDB,
+        interval_s: float = 2.0,
+        batch: int = 50,
+        max_attempts: int = 8,
+        worker: str = "",
+    ):
+        self.ms = ms
+        self.db = db
+        self.interval_s = float(interval_s)
+        self.batch = max(1, int(batch))
+        self.max_attempts = max(1, int(max_attempts))
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.stats: Dict[str, int] = {"sent": 0, "unchanged": 0, "retried": 0, "failed": 0}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def backoff_s(self, attempts: int) -> float:
+        return float(min(600, 5 * 2 ** max(0, attempts)))
+
+    def flush_once(self) -> int:
+        """
+        Один проход по готовым записям; возвращает число обработанных.
+        Описания читаются пачкой, запись — массовым обновлением: ~2 запроса на пачку вместо 2 на заказ.
+        """
+        items = self.db.outbox_claim(self.worker, limit=self.batch)
+        if not items:
+            return 0
+        try:
+            results = self.ms.set_customerorders_cis_blocks({it["order_id"]: it["codes"] for it in items})
+        except Exception as e:
+            results = {it["order_id"]: e for it in items}
+        for it in items:
+            res = results.get(it["order_id"])
+            if res in ("updated", "unchanged"):
+                self.db.outbox_sent(it["barcode128"], self.worker, it["codes"])
+                self.stats["sent" if res == "updated" else "unchanged"] += 1
+                continue
+            e = res if isinstance(res, Exception) else RuntimeError("no result")
+            attempts = int(it["attempts"]) + 1
+            if _is_permanent(e) or attempts >= self.max_attempts:
+                self.db.outbox_failed(it["barcode128"], self.worker, it["codes"], repr(e), retry_in_s=None)
+                self.stats["failed"] += 1
+            else:
+                self.db.outbox_failed(
+                    it["barcode128"], self.worker, it["codes"], repr(e), retry_in_s=self.backoff_s(attempts)
+                )
+                self.stats["retried"] += 1
+        return len(items)
+
+    def wake(self) -> None:
+        """Не ждать интервала — в outbox появилась запись."""
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                n = self.flush_once()
+            except Exception as e:
+                n = 0
+                print(f"[outbox] {e!r}", flush=True)
+            if n >= self.batch:
+                continue
+            self._wake.wait(self.interval_s)
+            self._wake.clear()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cis-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
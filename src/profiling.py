@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import cProfile
+import glob
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from types import CodeType
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+PROFILE_DIR = "data/profiles"
+SAMPLE_INTERVAL_S = 0.005
+# кроме вызывающего потока — пул клиента МС (ms_N) и стадии индексатора (index-fetch / index-write)
+THREAD_PREFIXES: Tuple[str, ...] = ("ms_", "index-")
+
+# грубая раскладка по листовому кадру стека: куда уходит время; первое совпадение по "путь:функция"
+CATEGORIES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("network", ("/socket.py:", "/ssl.py:", "/http/client.py:", "/urllib3/", "/selectors.py:")),
+    ("json", ("/json/",)),
+    ("sqlite", ("/sqlite3/", "/src/index_db.py:")),
+    ("dates", ("/_strptime.py:", "/src/moysklad.py:parse_ms_dt")),
+    ("rate_limit", ("/src/http.py:_take", "/src/http.py:slot")),
+    ("wait", ("/threading.py:", "/queue.py:", "/concurrent/futures/")),
+)
+
+
+def _label(code: CodeType) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _idle_worker(code: CodeType) -> bool:
+    # воркер пула без задачи (ждёт в очереди) — это не время прохода, в сэмплы не берём
+    return code.co_name == "_worker" and "concurrent" in code.co_filename
+
+
+def category_of(code: CodeType) -> str:
+    key = code.co_filename.replace("\\", "/") + ":" + code.co_name
+    for name, needles in CATEGORIES:
+        if any(n in key for n in needles):
+            return name
+    return "other"
+
+
+class StackSampler:
+    """
+    Сэмплер стеков: раз в interval_s снимает стеки (sys._current_frames) вызывающего потока
+    и рабочих потоков с именами из thread_prefixes. cProfile видит только свой поток, сэмплер — все.
+    """
+
+    def __init__(self, interval_s: float = SAMPLE_INTERVAL_S, thread_prefixes: Tuple[str, ...] = THREAD_PREFIXES):
+        self.interval_s = float(interval_s)
+        self.thread_prefixes = tuple(thread_prefixes)
+        self.counts: "Counter[Tuple[str, Tuple[CodeType, ...]]]" = Counter()  # (поток, стек от корня) -> сэмплов
+        self.owner = 0
+        self._active = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def resume(self) -> None:
+        # в Streamlit каждый rerun может идти в другом потоке — «свой» поток тот, кто включил
+        self.owner = threading.get_ident()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+            self._thread.start()
+        self._active.set()
+
+    def pause(self) -> None:
+        self._active.clear()
+
+    def stop(self) -> None:
+        self._active.clear()
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.is_set():
+            if not self._active.wait(0.5):
+                continue
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                name = names.get(ident, "")
+                if ident == self.owner:
+                    thread = "caller"
+                elif name.startswith(self.thread_prefixes) and not _idle_worker(frame.f_code):
+                    thread = re.sub(r"_\d+$", "", name)
+                else:
+                    continue
+                stack: List[CodeType] = []
+                f = frame
+                while f is not None:
+                    stack.append(f.f_code)
+                    f = f.f_back
+                stack.reverse()
+                self.counts[(thread, tuple(stack))] += 1
+            time.sleep(self.interval_s)
+
+    def samples(self) -> int:
+        return sum(self.counts.values())
+
+    def collapsed(self) -> str:
+        """Формат collapsed stacks (flamegraph.pl, speedscope): «поток;кадр;...;кадр N»."""
+        agg: Dict[str, int] = {}
+        for (thread, stack), n in list(self.counts.items()):
+            key = ";".join([thread] + [_label(c) for c in stack])
+            agg[key] = agg.get(key, 0) + n
+        return "".join(f"{k} {n}\n" for k, n in sorted(agg.items()))
+
+    def hotspots(self, limit: int = 25) -> List[Dict[str, Any]]:
+        """Функции по собственному времени (лист стека) и по полному (есть в стеке), % от всех сэмплов."""
+        total = self.samples()
+        own: Dict[CodeType, int] = {}
+        incl: Dict[CodeType, int] = {}
+        for (_, stack), n in list(self.counts.items()):
+            if not stack:
+                continue
+            own[stack[-1]] = own.get(stack[-1], 0) + n
+            for c in set(stack):
+                incl[c] = incl.get(c, 0) + n
+        rows = sorted(own.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+        return [
+            {
+                "function": _label(c),
+                "category": category_of(c),
+                "self_pct": round(100.0 * n / total, 1),
+                "total_pct": round(100.0 * incl.get(c, 0) / total, 1),
+                "samples": n,
+            }
+            for c, n in rows
+        ]
+
+    def categories(self) -> Dict[str, float]:
+        total = self.samples()
+        out: Dict[str, int] = {}
+        for (_, stack), n in list(self.counts.items()):
+            if stack:
+                cat = category_of(stack[-1])
+                out[cat] = out.get(cat, 0) + n
+        return {k: round(100.0 * v / total, 1) for k, v in sorted(out.items(), key=lambda kv: kv[1], reverse=True)}
+
+
+def top_functions(stats: pstats.Stats, limit: int = 25) -> List[Dict[str, Any]]:
+    """Топ cProfile по собственному времени: (файл, строка, функция) → вызовы, self/total сек."""
+    rows = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:limit]  # type: ignore[attr-defined]
+    return [
+        {
+            "function": f"{func} ({os.path.basename(file)}:{line})",
+            "calls": nc,
+            "self_s": round(tt, 4),
+            "total_s": round(ct, 4),
+        }
+        for (file, line, func), (_, nc, tt, ct, _) in rows
+    ]
+
+
+class Profiler:
+    """
+    Профиль одного прохода: cProfile вызывающего потока (→ .pstats) + сэмплер стеков всех рабочих потоков
+    (→ .collapsed.txt для flame graph) + сводка .json (горячие функции, раскладка по категориям).
+    resume/pause можно вызывать много раз — время складывается (цикл «скан → отправка» идёт несколькими rerun).
+    """
+
+    def __init__(self, name: str, out_dir: str = PROFILE_DIR, interval_s: float = SAMPLE_INTERVAL_S):
+        self.name = re.sub(r"[^\w.-]+", "_", name) or "profile"
+        self.out_dir = out_dir
+        self.started_at = datetime.now()
+        self.seconds = 0.0
+        self.sampler = StackSampler(interval_s)
+        self._cprof = cProfile.Profile()
+        self._cprof_used = False
+        self._cprof_on = False
+        self._t0: Optional[float] = None
+
+    def resume(self) -> None:
+        if self._t0 is not None:
+            self.pause()
+        self._t0 = time.perf_counter()
+        self.sampler.resume()
+        try:
+            self._cprof.enable()
+            self._cprof_on = self._cprof_used = True
+        except ValueError:
+            # другой профилировщик уже активен (3.12+: один на интерпретатор) — остаётся сэмплер
+            self._cprof_on = False
+
+    def pause(self) -> None:
+        if self._t0 is None:
+            return
+        if self._cprof_on:
+            self._cprof.disable()
+            self._cprof_on = False
+        self.sampler.pause()
+        self.seconds += time.perf_counter() - self._t0
+        self._t0 = None
+
+    def discard(self) -> None:
+        self.pause()
+        self.sampler.stop()
+
+    def save(self) -> Dict[str, Any]:
+        """Остановить и записать файлы в out_dir; возвращает сводку (то же, что в .json)."""
+        self.pause()
+        self.sampler.stop()
+        os.makedirs(self.out_dir, exist_ok=True)
+        stem = os.path.join(self.out_dir, f"{self.started_at:%Y%m%d-%H%M%S}-{self.name}")
+
+        summary: Dict[str, Any] = {
+            "name": self.name,
+            "started_at": self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds": round(self.seconds, 3),
+            "samples": self.sampler.samples(),
+            "categories": self.sampler.categories() if self.sampler.samples() else {},
+            "hotspots": self.sampler.hotspots() if self.sampler.samples() else [],
+            "top_functions": [],
+            "pstats": "",
+            "collapsed": f"{stem}.collapsed.txt",
+        }
+        with open(summary["collapsed"], "w", encoding="utf-8") as f:
+            f.write(self.sampler.collapsed())
+        if self._cprof_used:
+            stats = pstats.Stats(self._cprof)
+            summary["pstats"] = f"{stem}.pstats"
+            stats.dump_stats(summary["pstats"])
+            summary["top_functions"] = top_functions(stats)
+        with open(f"{stem}.json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        return summary
+
+
+@contextmanager
+def profiled(name: str, enabled: bool = True, out_dir: str = PROFILE_DIR) -> Iterator[Optional[Profiler]]:
+    """with profiled("indexing", enabled=...) — профиль блока; при enabled=False ничего не делает."""
+    if not enabled:
+        yield None
+        return
+    prof = Profiler(name, out_dir)
+    prof.resume()
+    try:
+        yield prof
+    finally:
+        summary = prof.save()
+        top = ", ".join(f"{h['function']} {h['self_pct']}%" for h in summary["hotspots"][:5])
+        print(f"[profile] {name}: {summary['seconds']} с, {summary['categories']} → {summary['collapsed']}", flush=True)
+        if top:
+            print(f"[profile] горячие: {top}", flush=True)
+
+
+def list_profiles(out_dir: str = PROFILE_DIR, limit: int = 20) -> List[Dict[str, Any]]:
+    """Сводки сохранённых профилей, новые первыми."""
+    out: List[Dict[str, Any]] = []
+    for path in sorted(glob.glob(os.path.join(out_dir, "*.json")), reverse=True)[: max(0, limit)]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        summary["path"] = path
+        out.append(summary)
+    return out
@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import argparse
+import ipaddress
+import json
+import os
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+from dotenv import load_dotenv
+
+from src.config import Settings
+from src.index_db import IndexDB
+from src.indexer import index_order
+from src.moysklad import MoySkladClient, id_from_href
+
+ORDER_ACTIONS = ("CREATE", "UPDATE")
+
+
+def order_ids_from_payload(payload: Any) -> List[str]:
+    """id заказов из тела вебхука МС: {"events": [{"meta": {"type", "href"}, "action"}, ...]}"""
+    out: List[str] = []
+    events = payload.get("events") if isinstance(payload, dict) else None
+    for ev in events or []:
+        if not isinstance(ev, dict):
+            continue
+        meta = ev.get("meta") or {}
+        if meta.get("type") != "customerorder" or ev.get("action") not in ORDER_ACTIONS:
+            continue
+        oid = id_from_href(meta.get("href") or "")
+        if oid:
+            out.append(oid)
+    return out
+
+
+class DedupQueue:
+    """
+    Ограниченная очередь id: повторное событие по заказу, который ещё ждёт обработки, склеивается.
+    Если очередь полна — событие отбрасывается (его подберёт периодическая синхронизация).
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        self._q: "queue.Queue[str]" = queue.Queue(maxsize=max(1, maxsize))
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self.merged = 0
+        self.dropped = 0
+
+    def put(self, order_id: str) -> bool:
+        with self._lock:
+            if order_id in self._pending:
+                self.merged += 1
+                return False
+            try:
+                self._q.put_nowait(order_id)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._pending.add(order_id)
+            return True
+
+    def get(self, timeout: Optional[float] = None) -> str:
+        order_id = self._q.get(timeout=timeout)
+        # снимаем отметку до обработки: событие, пришедшее во время обработки, даст ещё один проход
+        with self._lock:
+            self._pending.discard(order_id)
+        return order_id
+
+    def task_done(self) -> None:
+        self._q.task_done()
+
+    def join(self) -> None:
+        self._q.join()
+
+    def qsize(self) -> int:
+        return self._q.qsize()
+
+
+class WebhookIndexer:
+    """Приёмник вебхуков customerorder + воркер, переиндексирующий заказы по одному."""
+
+    def __init__(self, ms: MoySkladClient, db: IndexDB, cfg: Settings, queue_size: int = 1000):
+        self.ms = ms
+        self.db = db
+        self.cfg = cfg
+        self.queue = DedupQueue(queue_size)
+        self.stats: Dict[str, int] = {}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def submit(self, payload: Any) -> int:
+        accepted = 0
+        for oid in order_ids_from_payload(payload):
+            if self.queue.put(oid):
+                accepted += 1
+        return accepted
+
+    def process(self, order_id: str) -> str:
+        order = self.ms.get(f"/entity/customerorder/{order_id}", params={"expand": "positions.assortment"})
+        return index_order(
+            self.ms,
+            self.db,
+            order,
+            qr_attr_id=self.cfg.MS_ORDER_QR_ATTR_ID,
+            qr_attr_name=self.cfg.MS_ORDER_QR_ATTR_NAME,
+            packing_state_href=self.cfg.MS_PACKING_STATE_HREF,
+            use_catalog=self.cfg.CATALOG_MIRROR,
+            attr_cis_required=self.cfg.MS_ATTR_CIS_REQUIRED,
+            bundle_mark_flag=self.cfg.MS_BUNDLE_MARK_FLAG,
+        )
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                oid = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._count(self.process(oid))
+            except Exception as e:
+                self._count("errors")
+                print(f"[webhook] {oid}: {e!r}", flush=True)
+            finally:
+                self.queue.task_done()
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="webhook-indexer", daemon=True)
+            self._worker.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join(timeout=5)
+            self._worker = None
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._stats_lock:
+            out = dict(self.stats)
+        out.update(queued=self.queue.qsize(), merged=self.queue.merged, dropped=self.queue.dropped)
+        return out
+
+
+def make_server(indexer: WebhookIndexer, host: str = "0.0.0.0", port: int = 8085, token: str = "") -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: Dict[str, Any]) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _authorized(self) -> bool:
+            if not token:
+                return True
+            return parse_qs(urlparse(self.path).query).get("token", [""])[0] == token
+
+        def do_POST(self) -> None:
+            if not self._authorized():
+                self._reply(403, {"error": "forbidden"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except Exception:
+                self._reply(400, {"error": "bad json"})
+                return
+            # МС ждёт быстрый ответ: только ставим в очередь
+            self._reply(200, {"accepted": indexer.submit(payload)})
+
+        def do_GET(self) -> None:
+            path = urlparse(self.path).path
+            if path == "/health":
+                self._reply(200, indexer.snapshot())
+            elif path == "/metrics":
+                data = indexer.ms.metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def is_loopback(host: str) -> bool:
+    host = (host or "").strip().strip("[]")
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def post_events(url: str, order_ids: List[str], action: str = "UPDATE", base_url: str = "") -> Dict[str, Any]:
+    """Локальная замена МС для проверки: шлёт синтетические события customerorder на приёмник."""
+    base_url = base_url or "https://api.moysklad.ru/api/remap/1.2"
+    body = {
+        "events": [
+            {
+                "meta": {"type": "customerorder", "href": f"{base_url}/entity/customerorder/{oid}"},
+                "action": action,
+                "accountId": "local-test",
+            }
+            for oid in order_ids
+        ]
+    }
+    req = Request(
+        url,
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urlopen(req, timeout=10) as resp:
+        return json.loads(resp.read() or b"{}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Приёмник вебхуков МС: переиндексация заказа по событию")
+    sub = ap.add_subparsers(dest="cmd")
+
+    serve = sub.add_parser("serve", help="запустить приёмник (по умолчанию)")
+    serve.add_argument("--host", default=None)
+    serve.add_argument("--port", type=int, default=None)
+
+    emit = sub.add_parser("emit", help="отправить синтетические события на приёмник")
+    emit.add_argument("--url", default="http://127.0.0.1:8085/")
+    emit.add_argument("--action", default="UPDATE", choices=ORDER_ACTIONS)
+    emit.add_argument("order_ids", nargs="+")
+
+    args = ap.parse_args(argv)
+    load_dotenv()
+
+    if args.cmd == "emit":
+        print(post_events(args.url, args.order_ids, action=args.action))
+        return 0
+
+    cfg = Settings.from_env()
+    host = getattr(args, "host", None) or cfg.WEBHOOK_HOST
+    port = getattr(args, "port", None) or cfg.WEBHOOK_PORT
+    if not cfg.WEBHOOK_TOKEN and not is_loopback(host):
+        # без токена любой, кто достучится до порта, может гонять переиндексацию
+        print(f"[webhook] WEBHOOK_TOKEN не задан — слушать {host} нельзя, только loopback (127.0.0.1)", flush=True)
+        return 2
+    os.makedirs(os.path.dirname(cfg.INDEX_DB_PATH) or ".", exist_ok=True)
+    db = IndexDB(cfg.INDEX_DB_PATH)
+    db.init()
+    ms = MoySkladClient(token=cfg.MS_TOKEN, base_url=cfg.MS_BASE_URL, cache=cfg.make_cache())
+
+    indexer = WebhookIndexer(ms, db, cfg, queue_size=cfg.WEBHOOK_QUEUE_SIZE)
+    indexer.start()
+    server = make_server(indexer, host=host, port=port, token=cfg.WEBHOOK_TOKEN)
+    print(f"[webhook] слушаю http://{host}:{port}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        indexer.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -6,16 +6,13 @@ import streamlit as st
 from streamlit_autorefresh import st_autorefresh
 from requests.exceptions import ReadTimeout, ConnectTimeout
 
-from src.moysklad import MoySkladClient, HttpError
-from src.index_db import IndexDB
-from src.indexer import (
-    list_customerorders_packing_since,
-    extract_attr_value,
-    is_done_by_description,
-    get_customerorder_positions_expand,
-    explode_order_positions,
-    expected_units_from_exploded,
-)
+from src.cache import ResponseCache
+from src.cis_logic import LineMatcher, ScanSet, parse_gs1
+from src.moysklad import MoySkladClient
+from src.index_db import HotOrderMap, IndexDB
+from src.indexer import lease_name, resolve_barcode, sync_source_key
+from src.outbox import OutboxFlusher
+from src.profiling import PROFILE_DIR, Profiler, list_profiles
 
 st.set_page_config(page_title="Упаковка → CIS", layout="wide")
 st.write("BUILD:", "2025-12-24 AUTO-10MIN-AUTO-SCAN")
@@ -43,14 +40,35 @@ with st.sidebar:
     )
 
     st.divider()
-    st.header("Авто-индекс каждые 10 минут")
-    date_from = st.text_input("DATE_FROM (YYYY-MM-DD)", value=st.secrets.get("DATE_FROM", "2025-12-20"))
-    max_total = st.number_input("MAX_TOTAL", min_value=50, max_value=20000, value=int(st.secrets.get("MAX_TOTAL", 4000)))
-    page_limit = st.number_input("PAGE_LIMIT", min_value=50, max_value=500, value=int(st.secrets.get("PAGE_LIMIT", 200)))
+    st.header("Индекс")
+    st.caption("Индексацию делает отдельный процесс: `python -m src.indexer --loop`")
+    index_db_path = st.text_input("INDEX_DB_PATH", value=st.secrets.get("INDEX_DB_PATH", "data/index.sqlite"))
+    # id станции — в URL (?station=...), чтобы журнал сканов находился после перезагрузки страницы
+    station = st.text_input(
+        "Станция",
+        value=st.query_params.get("station") or st.secrets.get("STATION_ID", "station-1"),
+    ).strip() or "station-1"
+    st.query_params["station"] = station
     list_limit = st.number_input("Сколько показывать в списке", min_value=20, max_value=2000, value=int(st.secrets.get("LIST_LIMIT", 200)))
 
-db = IndexDB("data/index.sqlite")
-db.init()
+@st.cache_resource
+def get_index_db(path: str) -> IndexDB:
+    # один экземпляр на процесс: соединения переиспользуются (по одному на поток)
+    d = IndexDB(path)
+    d.init()
+    return d
+
+
+db = get_index_db(index_db_path)
+
+
+@st.cache_resource
+def get_hot_map(path: str) -> HotOrderMap:
+    # карта ШККОД128 → заказ в памяти процесса, общая для всех сессий
+    return HotOrderMap(get_index_db(path))
+
+
+hot = get_hot_map(index_db_path)
 
 if not ms_token.strip():
     st.warning("Укажи MS_TOKEN.")
@@ -59,82 +77,121 @@ if not ms_packing_state_href.strip():
     st.warning("Укажи MS_PACKING_STATE_HREF (href статуса «упаковка»).")
     st.stop()
 
-ms = MoySkladClient(token=ms_token)
+@st.cache_resource
+def get_ms_client(token: str) -> MoySkladClient:
+    # один клиент на процесс: общий пул, общий rate limiter и общий кэш для всех сессий
+    use_cache = str(st.secrets.get("MS_CACHE", "")).strip().lower() in ("1", "true", "yes")
+    return MoySkladClient(token=token, cache=ResponseCache() if use_cache else None)
 
-# Авто-обновление страницы каждые 10 минут (600_000 мс)
-tick = st_autorefresh(interval=10 * 60 * 1000, key="auto_refresh_10m")
 
-# ---------- авто-индексация (с защитой от частого запуска) ----------
-def run_indexing(auto: bool = True) -> None:
-    now = time.time()
-    last = float(st.session_state.get("last_index_ts", 0.0))
-    if auto and (now - last) < 9.5 * 60:
-        return  # не чаще ~раз в 10 минут
+ms = get_ms_client(ms_token)
+# зеркало каталога ведёт индексатор (CATALOG_MIRROR); при выключенном — товары читаются из МС
+use_catalog = str(st.secrets.get("CATALOG_MIRROR", "true")).strip().lower() in ("1", "true", "yes")
 
-    st.session_state["last_index_ts"] = now
 
-    prog = st.progress(0, text="Авто-индексация: загружаю заказы из МС...")
-    status = st.empty()
+@st.cache_resource
+def get_outbox(path: str, token: str) -> OutboxFlusher:
+    # один фоновый отправщик [CIS] на процесс
+    flusher = OutboxFlusher(get_ms_client(token), get_index_db(path))
+    flusher.start()
+    return flusher
 
-    orders = list_customerorders_packing_since(
-        ms=ms,
-        packing_state_href=ms_packing_state_href.strip(),
-        date_from=date_from.strip(),
-        limit=int(page_limit),
-        max_total=int(max_total),
-    )
-
-    added = 0
-    skipped_done = 0
-    no_barcode = 0
-
-    for i, o in enumerate(orders, start=1):
-        oid = o.get("id")
-        if not oid:
-            continue
-
-        # берём full, чтобы прочитать description/attributes
-        full = ms.get_customerorder(oid)
-
-        # 2) обработанные — убираем
-        if is_done_by_description(full):
-            skipped_done += 1
-            continue
-
-        b128 = extract_attr_value(full, attr_id=qr_attr_id, attr_name=qr_attr_name)
-        if not b128:
-            no_barcode += 1
-            continue
-
-        pos = get_customerorder_positions_expand(ms, oid)
-        exploded = explode_order_positions(ms, pos)
-        expected_units = expected_units_from_exploded(exploded)
-
-        db.upsert_order(
-            barcode128=str(b128).strip(),
-            order_id=str(oid),
-            order_name=str(full.get("name") or ""),
-            moment=str(full.get("moment") or ""),
-            expected_units=expected_units,
-            done=0,
-        )
-        db.replace_positions(str(b128).strip(), exploded)
-        added += 1
 
-        if i % 10 == 0:
-            pct = int((i / max(1, len(orders))) * 100)
-            prog.progress(pct, text=f"Авто-индексация {i}/{len(orders)}...")
-            status.write(f"Обновлено: {added} | уже обработано: {skipped_done} | без ШККОД128: {no_barcode}")
+outbox = get_outbox(index_db_path, ms_token)
 
-    prog.progress(100, text="Авто-индексация завершена")
-    status.write(f"Готово. Обновлено: {added} | уже обработано: {skipped_done} | без ШККОД128: {no_barcode}")
+# Авто-обновление страницы каждые 10 минут (600_000 мс)
+tick = st_autorefresh(interval=10 * 60 * 1000, key="auto_refresh_10m")
 
-# запуск авто-индекса при первом заходе и на каждом тике
-try:
-    run_indexing(auto=True)
-except Exception:
-    # авто не должно валить всю страницу
-    pass
+# ---------- статус фонового индексатора (только чтение) ----------
+sync_source = sync_source_key(ms_packing_state_href)
+sync_status = db.get_sync_status(sync_source) or {}
+with st.sidebar:
+    st.divider()
+    st.header("Последняя синхронизация")
+    if not sync_status.get("last_run_at"):
+        st.warning("Индексатор ещё не запускался.")
+    elif sync_status.get("last_ok"):
+        st.success(f"OK, {sync_status['last_run_at']} UTC")
+    else:
+        st.error(f"Ошибка, {sync_status['last_run_at']} UTC: {sync_status.get('last_error')}")
+    if sync_status.get("last_stats"):
+        st.json(sync_status["last_stats"])
+    if sync_status.get("sync_requested_at"):
+        st.caption(f"Запрошено обновление: {sync_status['sync_requested_at']} UTC")
+    lease = db.lease_info(lease_name(ms_packing_state_href)) or {}
+    if lease.get("alive"):
+        st.caption(f"Индексатор: {lease['holder']}")
+    else:
+        st.caption("Индексатор сейчас не запущен (нет живого lease).")
+    st.divider()
+    st.header("Отправка [CIS] в МС")
+    outbox_counts = db.outbox_counts()
+    st.write(f"В очереди: **{outbox_counts['pending']}** | Ошибки: **{outbox_counts['failed']}**")
+    if outbox_counts["failed"]:
+        st.dataframe(db.outbox_list("failed", limit=20), use_container_width=True)
+        if st.button("🔁 Повторить с ошибками"):
+            db.outbox_retry_failed()
+            outbox.wake()
+            st.rerun()
+    st.caption("Карта ШККОД128 в памяти")
+    st.json(hot.stats())
+    if ms.cache is not None:
+        st.caption("Кэш ответов МС")
+        st.json(ms.cache.stats())
+    with st.expander("Метрики HTTP (МС)"):
+        st.json(ms.metrics.stats())
+        st.download_button("Prometheus", ms.metrics.prometheus_text(), file_name="metrics.prom")
+    profile_dir = st.secrets.get("PROFILE_DIR", PROFILE_DIR)
+    with st.expander("Профилирование"):
+        profile_cycle = st.checkbox(
+            "Профилировать цикл скан → отправка",
+            value=str(st.secrets.get("PROFILE_SCAN", "")).strip().lower() in ("1", "true", "yes"),
+            key="profile_cycle",
+        )
+        if st.button("🔬 Проход индексатора под профилировщиком"):
+            # индексатор снимет профиль ближайшего прохода и положит его в PROFILE_DIR
+            db.request_sync(sync_source, profile=True)
+            st.rerun()
+        if sync_status.get("profile_requested_at"):
+            st.caption(f"Профиль запрошен: {sync_status['profile_requested_at']} UTC")
+        profiles = list_profiles(profile_dir, limit=10)
+        if profiles:
+            pick = st.selectbox(
+                "Профиль",
+                range(len(profiles)),
+                format_func=lambda i: f"{profiles[i]['started_at']} · {profiles[i]['name']} · {profiles[i]['seconds']} с",
+            )
+            prof_view = profiles[pick]
+            st.caption("Куда уходит время, % сэмплов (все рабочие потоки)")
+            st.json(prof_view.get("categories") or {})
+            st.dataframe(prof_view.get("hotspots") or [], use_container_width=True)
+            if prof_view.get("top_functions"):
+                st.caption("cProfile потока вызова, по собственному времени")
+                st.dataframe(prof_view["top_functions"], use_container_width=True)
+            for kind in ("collapsed", "pstats"):
+                if prof_view.get(kind) and os.path.exists(prof_view[kind]):
+                    with open(prof_view[kind], "rb") as f:
+                        st.download_button(kind, f.read(), file_name=os.path.basename(prof_view[kind]), key=f"profile_{kind}")
+        else:
+            st.caption(f"В {profile_dir} профилей пока нет.")
+
+# профиль цикла «скан → отправка»: работа всех rerun от открытия заказа до отправки — в один профиль
+cycle_prof = st.session_state.get("cycle_profiler")
+if not profile_cycle and cycle_prof is not None:
+    st.session_state.pop("cycle_profiler", None)
+    cycle_prof.discard()
+    cycle_prof = None
+elif profile_cycle and cycle_prof is None:
+    cycle_prof = st.session_state["cycle_profiler"] = Profiler("scan-cycle", profile_dir)
+if cycle_prof is not None:
+    cycle_prof.resume()
+
+
+def rerun() -> None:
+    # в профиль — только работа скрипта, не ожидание следующего rerun
+    if cycle_prof is not None:
+        cycle_prof.pause()
+    st.rerun()
 
 # ---------- UI ----------
 left, right = st.columns([1, 1], gap="large")
@@ -148,12 +205,49 @@ with left:
 
 with right:
     st.subheader("Скан QR/Code128 → сразу найти заказ (без кнопки)")
-    scan_val = st.text_input("ШККОД128", value="", placeholder="*CtzwYRSH", key="scan_code128")
-
-    found = db.lookup_order(scan_val.strip()) if scan_val.strip() else None
+    # после перезагрузки страницы — вернуться к незакрытому заказу станции
+    if "journal_restored" not in st.session_state:
+        st.session_state["journal_restored"] = True
+        st.session_state["scan_code128"] = db.journal_open_order(station)
+    scan_val = st.text_input("ШККОД128", placeholder="*CtzwYRSH", key="scan_code128")
+
+    t_lookup = time.perf_counter()
+    found = hot.lookup(scan_val.strip()) if scan_val.strip() else None
+    if scan_val.strip():
+        st.caption(f"Поиск в индексе: {(time.perf_counter() - t_lookup) * 1000:.3f} мс")
+
+    # промах индекса — один запрос в МС по доп. полю (не повторяем на каждом rerun для того же кода)
+    if scan_val.strip() and not found and st.session_state.get("resolve_miss") != scan_val.strip():
+        try:
+            with st.spinner("Нет в индексе, ищу в МойСклад..."):
+                found, outcome = resolve_barcode(
+                    ms,
+                    db,
+                    scan_val.strip(),
+                    qr_attr_id=qr_attr_id,
+                    qr_attr_name=qr_attr_name,
+                    packing_state_href=ms_packing_state_href,
+                    use_catalog=use_catalog,
+                    attr_cis_required=st.secrets.get("MS_ATTR_CIS_REQUIRED", "ЧЗ"),
+                    bundle_mark_flag=st.secrets.get("MS_BUNDLE_MARK_FLAG", "Комплект_маркируемый"),
+                )
+        except Exception as e:
+            found, outcome = None, f"error: {e}"
+        if not found:
+            st.session_state["resolve_miss"] = scan_val.strip()
+            st.session_state["resolve_outcome"] = outcome
+        else:
+            # заказ только что записан в индекс, а карта в этом rerun уже проверялась (throttle) — догрузить сразу
+            hot.refresh(force=True)
 
     if scan_val.strip() and not found:
-        st.warning("Не найдено в индексе. Подожди авто-обновление (до 10 минут) или убедись, что заказ реально в статусе «упаковка» и с DATE_FROM попадает.")
+        outcome = st.session_state.get("resolve_outcome", "")
+        if outcome == "skipped_done":
+            st.warning("Заказ найден в МС, но КИЗы по нему уже записаны ([CIS] в описании).")
+        elif outcome == "not_packing":
+            st.warning("Заказ найден в МС, но он не в статусе «упаковка».")
+        else:
+            st.warning(f"Не найдено ни в индексе, ни в МойСклад ({outcome}).")
     if found:
         st.divider()
 
@@ -161,21 +255,58 @@ with right:
 st.subheader("Сканируй КИЗы (DataMatrix)")
 
 if "cis_scanned" not in st.session_state:
-    st.session_state["cis_scanned"] = []
+    st.session_state["cis_scanned"] = ScanSet()
+scans: ScanSet = st.session_state["cis_scanned"]
+
+# смена заказа: сканы — из журнала станции, GTIN → строка раскрытого заказа строится один раз (каждый скан — O(1))
+order_key = scan_val.strip() if found else ""
+if st.session_state.get("cis_matcher_key") != order_key:
+    order_positions = (hot.lookup_positions(order_key) or db.lookup_positions(order_key)) if order_key else []
+    # пустой список позиций у найденного заказа не кэшируем — на следующем rerun соберём заново
+    st.session_state["cis_matcher_key"] = order_key if order_positions or not order_key else None
+    matcher = LineMatcher(order_positions)
+    scans.clear()
+    for key, code in db.journal_load(station, order_key) if order_key else []:
+        scans.add(key, code)
+        matcher.add(code)
+    st.session_state["cis_matcher"] = matcher
+matcher: LineMatcher = st.session_state["cis_matcher"]
 
 def add_cis(val: str):
     v = (val or "").strip()
     if not v:
         return
-    if v not in st.session_state["cis_scanned"]:
-        st.session_state["cis_scanned"].append(v)
+    parsed = parse_gs1(v)
+    if parsed.key in scans:
+        return
+    # КМ уже записан в другой заказ — повторно использовать нельзя
+    owner = db.cis_owner(parsed.key)
+    if owner and owner["barcode128"] != order_key:
+        st.session_state["cis_reject"] = f"{v}: уже использован в заказе {owner['barcode128']}"
+        return
+    line_no, reason = matcher.add(v, parsed)
+    if line_no is None:
+        st.session_state["cis_reject"] = f"{v}: {reason}"
+        return
+    # формат с замечаниями, но товар совпал — засчитываем и показываем предупреждение
+    st.session_state["cis_reject"] = f"{v}: {'; '.join(parsed.errors)}" if parsed.errors else ""
+    scans.add(parsed.key, v)
+    db.journal_add(station, order_key, parsed.key, v)
 
 def on_cis_change():
-    v = (st.session_state.get("cis_one_input") or "").strip()
-    if v:
-        add_cis(v)
-    # очистка в callback — безопасно
-    st.session_state["cis_one_input"] = ""
+    # callback идёт до тела скрипта, где профилировщик включается, — сам скан профилируем здесь
+    prof = st.session_state.get("cycle_profiler")
+    if prof is not None:
+        prof.resume()
+    try:
+        v = (st.session_state.get("cis_one_input") or "").strip()
+        if v:
+            add_cis(v)
+        # очистка в callback — безопасно
+        st.session_state["cis_one_input"] = ""
+    finally:
+        if prof is not None:
+            prof.pause()
 
 # Поле под скан (если сканер шлёт Enter — on_change сработает)
 st.text_input(
@@ -193,40 +324,49 @@ with col_add1:
         if v:
             add_cis(v)
         st.session_state["cis_one_input"] = ""
-        st.rerun()
+        rerun()
 
 with col_add2:
     st.caption("Если у тебя сканер не нажимает Enter — используй кнопку ➕")
 
-expected = int(found.get("expected_units") or 0)
-scanned_count = len(st.session_state["cis_scanned"])
+# сколько КМ нужно — из индекса (правила маркировки применены при индексации); старые записи — все штуки
+cis_units = found.get("cis_units") if found else None
+expected = int((found.get("expected_units") if cis_units is None else cis_units) or 0) if found else 0
+scanned_count = len(scans)
 remaining = max(0, expected - scanned_count)
 
 st.write(f"Просканировано: **{scanned_count}** / **{expected}** | Осталось: **{remaining}**")
+if st.session_state.get("cis_reject"):
+    st.warning(st.session_state["cis_reject"])
+if matcher.lines:
+    st.dataframe(matcher.progress(), use_container_width=True, height=min(320, 40 + 35 * len(matcher.lines)))
 
-st.text_area(
-    "Список просканированных КИЗов",
-    value="\n".join(st.session_state["cis_scanned"]),
-    height=180,
-    key="cis_view",
-    disabled=True,
-)
+# только хвост списка: стоимость перерисовки не растёт с числом кодов
+CIS_TAIL = 15
+st.caption(f"Последние {min(CIS_TAIL, scanned_count)} из {scanned_count} (новые сверху)")
+st.code("\n".join(scans.tail(CIS_TAIL)) or "—", language=None)
 
 c1, c2, c3 = st.columns(3)
 with c1:
     if st.button("🧹 Очистить"):
-        st.session_state["cis_scanned"] = []
+        db.journal_clear(station, order_key)
+        scans.clear()
         st.session_state["cis_one_input"] = ""
-        st.rerun()
+        st.session_state["cis_matcher_key"] = None
+        st.session_state["cis_reject"] = ""
+        rerun()
 with c2:
     if st.button("↩️ Удалить последний"):
-        if st.session_state["cis_scanned"]:
-            st.session_state["cis_scanned"].pop()
-        st.rerun()
+        last = scans.pop()
+        if last:
+            matcher.remove(last[1])
+            db.journal_undo(station, order_key, last[0])
+        rerun()
 with c3:
     if st.button("🔄 Обновить индекс сейчас"):
-        run_indexing(auto=False)
-        st.rerun()
+        # индексатор подхватит запрос в течение пары секунд
+        db.request_sync(sync_source)
+        rerun()
 
 st.divider()
 
@@ -244,22 +384,37 @@ send_btn = st.button("✅ Записать [CIS] в customerorder.description",
 if send_btn:
     try:
         order_id = found["order_id"]
-        cis_lines = st.session_state["cis_scanned"]
-        block = "[CIS]\n" + "\n".join(cis_lines) + "\n[/CIS]"
-
-        updated = ms.append_to_customerorder_description(order_id, block)
+        cis_lines = scans.codes()
+        # закрепляем коды за заказом до записи в МС: один КМ — один заказ
+        conflicts = db.register_cis_codes(order_key, order_id, scans.keys())
+        if conflicts:
+            st.error("КМ уже использованы в других заказах — отправка отменена.")
+            st.json(conflicts)
+            if cycle_prof is not None:
+                cycle_prof.pause()
+            st.stop()
+        # в МС пишет фоновый outbox: упаковщик не ждёт ответа МС
+        db.outbox_enqueue(order_key, order_id, cis_lines)
+        outbox.wake()
 
         # помечаем как done, чтобы исчез из списка
         db.mark_done(scan_val.strip())
 
-        st.success("Записал ✅ Заказ помечен обработанным и исчезнет из списка.")
-        st.session_state["cis_scanned"] = []
+        st.success("Сохранено ✅ Заказ помечен обработанным, [CIS] уйдёт в МС в фоне.")
+        db.journal_clear(station, order_key)
+        scans.clear()
+        st.session_state["cis_matcher_key"] = None
         st.session_state["scan_code128"] = ""
         st.session_state["cis_one_input"] = ""
+        if cycle_prof is not None:
+            # цикл закрыт: профиль — в PROFILE_DIR, следующий заказ — новый профиль
+            st.session_state.pop("cycle_profiler", None)
+            cycle_prof.save()
+            cycle_prof = None
         st.rerun()
 
-    except HttpError as e:
-        st.error(f"Ошибка МойСклад: HTTP {e.status}")
-        st.json(e.payload)
     except Exception as e:
         st.exception(e)
+
+if cycle_prof is not None:
+    cycle_prof.pause()
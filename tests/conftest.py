@@ -0,0 +1,23 @@
+import pytest
+
+from bench.ms_stub import MsStub, start_stub
+from src.index_db import IndexDB
+
+
+@pytest.fixture
+def db(tmp_path):
+    d = IndexDB(str(tmp_path / "index.sqlite"))
+    d.init()
+    return d
+
+
+@pytest.fixture
+def stub():
+    """Заглушка МС (bench/ms_stub.py) на локальном порту: (MsStub, base_url)."""
+    ms_stub = MsStub()
+    server, base_url = start_stub(ms_stub, orders=10, products=30, bundles=5)
+    try:
+        yield ms_stub, base_url
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,164 @@
+import threading
+import time
+
+from src.cache import ResponseCache, entity_type_of
+from src.moysklad import MoySkladClient
+
+
+class Fetch:
+    """fetch-колбэк со счётчиком вызовов; gate — задержать ответ (проверка single-flight)."""
+
+    def __init__(self, value=None, gate: threading.Event = None):
+        self.value = value if value is not None else {"rows": [1]}
+        self.gate = gate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        return self.value
+
+
+def test_entity_type_of():
+    assert entity_type_of("/entity/bundle/abc") == "bundle"
+    assert entity_type_of("/entity/customerorder/metadata/attributes") == "metadata"
+    assert entity_type_of("/entity/product?x=1") == "product"
+
+
+def test_hit_returns_copy():
+    cache = ResponseCache()
+    fetch = Fetch()
+    first = cache.get_or_fetch("/entity/product", {"limit": 1}, fetch)
+    first["rows"].append("mutated")
+    assert cache.get_or_fetch("/entity/product", {"limit": 1}, fetch) == {"rows": [1]}
+    assert fetch.calls == 1
+    # другие параметры — другой ключ
+    cache.get_or_fetch("/entity/product", {"limit": 2}, fetch)
+    assert fetch.calls == 2
+    assert cache.stats()["hits"] == 1
+
+
+def test_zero_ttl_bypasses():
+    cache = ResponseCache()
+    fetch = Fetch()
+    cache.get_or_fetch("/entity/customerorder", None, fetch)
+    cache.get_or_fetch("/entity/customerorder", None, fetch)
+    assert fetch.calls == 2
+    assert cache.stats()["bypass"] == 2
+
+
+def test_ttl_expiry():
+    cache = ResponseCache(ttls={"product": 0.05})
+    fetch = Fetch()
+    cache.get_or_fetch("/entity/product/1", None, fetch)
+    time.sleep(0.1)
+    cache.get_or_fetch("/entity/product/1", None, fetch)
+    assert fetch.calls == 2
+    assert cache.stats()["expired"] == 1
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2)
+    fetch = Fetch()
+    for i in (1, 2):
+        cache.get_or_fetch(f"/entity/product/{i}", None, fetch)
+    cache.get_or_fetch("/entity/product/1", None, fetch)  # 1 свежее 2
+    cache.get_or_fetch("/entity/product/3", None, fetch)  # вытесняет 2
+    assert fetch.calls == 3
+    assert cache.stats()["evictions"] == 1
+
+    cache.get_or_fetch("/entity/product/1", None, fetch)
+    assert fetch.calls == 3
+    cache.get_or_fetch("/entity/product/2", None, fetch)
+    assert fetch.calls == 4
+
+
+def test_single_flight_collapses_concurrent_gets():
+    cache = ResponseCache()
+    gate = threading.Event()
+    fetch = Fetch(gate=gate)
+    results = []
+
+    def worker():
+        results.append(cache.get_or_fetch("/entity/bundle/1", None, fetch))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    gate.set()
+    for t in threads:
+        t.join(5)
+
+    assert fetch.calls == 1
+    assert results == [{"rows": [1]}] * 8
+    assert cache.stats()["coalesced"] == 7
+
+
+def test_failed_fetch_is_not_cached():
+    cache = ResponseCache()
+    calls = []
+
+    def boom():
+        calls.append(1)
+        raise RuntimeError("503")
+
+    for _ in range(2):
+        try:
+            cache.get_or_fetch("/entity/product/1", None, boom)
+        except RuntimeError:
+            pass
+    assert len(calls) == 2
+    assert cache.stats()["inflight"] == 0
+
+
+def test_invalidate_path_only(tmp_path):
+    cache = ResponseCache(sqlite_path=str(tmp_path / "cache.sqlite"))
+    fetch = Fetch()
+    cache.get_or_fetch("/entity/product/1", {"expand": "x"}, fetch)
+    cache.get_or_fetch("/entity/product/1", None, fetch)
+    cache.get_or_fetch("/entity/product/10", None, fetch)
+    assert cache.invalidate("/entity/product/1") == 2
+
+    cache.get_or_fetch("/entity/product/1", None, fetch)
+    cache.get_or_fetch("/entity/product/10", None, fetch)
+    assert fetch.calls == 4
+    assert cache.stats()["sqlite_hits"] == 0
+
+
+def test_sqlite_tier_shared_between_instances(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    fetch = Fetch()
+    ResponseCache(sqlite_path=path).get_or_fetch("/entity/bundle/1", None, fetch)
+
+    other = ResponseCache(sqlite_path=path)
+    assert other.get_or_fetch("/entity/bundle/1", None, fetch) == {"rows": [1]}
+    assert fetch.calls == 1
+    assert other.stats()["sqlite_hits"] == 1
+
+    other.clear()
+    ResponseCache(sqlite_path=path).get_or_fetch("/entity/bundle/1", None, fetch)
+    assert fetch.calls == 2
+
+
+def test_client_put_invalidates_and_cache_false_bypasses(stub):
+    ms_stub, base_url = stub
+    cache = ResponseCache()
+    ms = MoySkladClient(token="t", base_url=base_url, cache=cache)
+    oid = ms_stub.data.order_ids[0]
+    path = f"/entity/customerorder/{oid}"
+    # заказы по умолчанию не кэшируются — включаем, чтобы проверить сброс после PUT
+    cache.ttls["customerorder"] = 3600
+
+    ms.get(path)
+    ms.put(path, {"description": "edited"})
+    assert ms.get(path)["description"] == "edited"
+
+    pid = next(iter(ms_stub.data.entities["product"]))
+    ms.get(f"/entity/product/{pid}")
+    ms_stub.data.entities["product"][pid]["name"] = "RENAMED"
+    assert ms.get(f"/entity/product/{pid}")["name"] != "RENAMED"
+    assert ms.get(f"/entity/product/{pid}", cache=False)["name"] == "RENAMED"
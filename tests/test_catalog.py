@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from src.cache import ResponseCache
+from src.catalog import sync_catalog
+from src.moysklad import MoySkladClient
+
+
+def touch(entity: dict, **fields) -> None:
+    entity.update(fields)
+    entity["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.000")
+
+
+def test_delta_sees_edits_with_response_cache(stub, db, tmp_path):
+    ms_stub, base_url = stub
+    ms = MoySkladClient(token="t", base_url=base_url, cache=ResponseCache(sqlite_path=str(tmp_path / "cache.sqlite")))
+    sync_catalog(ms, db)
+    sync_catalog(ms, db)  # watermark тот же — тот же запрос, что и на следующем шаге
+
+    products = ms_stub.data.entities["product"]
+    pid = next(iter(products))
+    touch(products[pid], name="RENAMED")
+    sync_catalog(ms, db)
+
+    assert db.catalog_items([pid])[pid]["name"] == "RENAMED"
+
+
+def test_delta_drops_archived_and_reconcile_drops_deleted(stub, db):
+    ms_stub, base_url = stub
+    ms = MoySkladClient(token="t", base_url=base_url)
+    sync_catalog(ms, db)
+    before = db.catalog_stats()
+
+    entities = ms_stub.data.entities
+    pid = next(iter(entities["product"]))
+    touch(entities["product"][pid], archived=True)
+    bid = next(iter(entities["bundle"]))
+    del entities["bundle"][bid]
+
+    sync_catalog(ms, db)
+    assert db.catalog_items([pid]) == {}
+    assert bid in db.catalog_bundles([bid])  # удаление дельта не видит
+
+    sync_catalog(ms, db, reconcile_s=0)
+    assert db.catalog_bundles([bid]) == {}
+    assert db.catalog_stats() == {
+        "catalog_items": before["catalog_items"] - 1,
+        "catalog_bundles": before["catalog_bundles"] - 1,
+    }
@@ -0,0 +1,44 @@
+from src.cis_logic import GS, parse_gs1
+
+GTIN = "04006381333931"
+
+
+def km(serial: str, crypto: str = "EE06") -> str:
+    return f"01{GTIN}21{serial}{GS}91{crypto}{GS}92{'x' * 44}"
+
+
+def test_register_and_repeat_for_same_order(db):
+    keys = [parse_gs1(km("AAAAAAAAAAAAA")).key, parse_gs1(km("BBBBBBBBBBBBB")).key]
+    assert db.register_cis_codes("B1", "o1", keys) == {}
+    # повтор отправки того же заказа — не конфликт
+    assert db.register_cis_codes("B1", "o1", keys) == {}
+    assert db.cis_owners(keys) == {k: "B1" for k in keys}
+    assert db.cis_owner(keys[0])["order_id"] == "o1"
+
+
+def test_same_gtin_serial_with_other_crypto_tail_conflicts(db):
+    first = parse_gs1(km("AAAAAAAAAAAAA", "EE06")).key
+    again = parse_gs1(km("AAAAAAAAAAAAA", "FFFF")).key
+    assert first == again
+    db.register_cis_codes("B1", "o1", [first])
+    assert db.register_cis_codes("B2", "o2", [again]) == {again: "B1"}
+
+
+def test_conflict_rolls_back_whole_batch(db):
+    taken = parse_gs1(km("AAAAAAAAAAAAA")).key
+    fresh = [parse_gs1(km("CCCCCCCCCCCCC")).key, parse_gs1(km("DDDDDDDDDDDDD")).key]
+    db.register_cis_codes("B1", "o1", [taken])
+
+    assert db.register_cis_codes("B2", "o2", fresh + [taken]) == {taken: "B1"}
+    # ни один код второго заказа не закреплён — после исправления скана отправку можно повторить
+    assert db.cis_owners(fresh) == {}
+    assert db.cis_owner(taken)["barcode128"] == "B1"
+
+    assert db.register_cis_codes("B2", "o2", fresh) == {}
+    assert db.cis_owners(fresh) == {k: "B2" for k in fresh}
+
+
+def test_empty_input_is_noop(db):
+    assert db.register_cis_codes("", "o1", ["x"]) == {}
+    assert db.register_cis_codes("B1", "o1", []) == {}
+    assert db.cis_owner("x") is None
@@ -0,0 +1,149 @@
+import pytest
+
+from src.cis_logic import GS, LineMatcher, ScanSet, gtin14, gtin_check_digit_ok, parse_gs1
+
+GTIN = "04006381333931"
+BAD_GTIN = "04006381333932"
+OTHER_EAN = "4600000000008"
+SERIAL = "ABC1234567890"
+CRYPTO = "x" * 44
+CODE = f"01{GTIN}21{SERIAL}{GS}91EE06{GS}92{CRYPTO}"
+
+
+@pytest.mark.parametrize(
+    "gtin, ok",
+    [
+        ("4006381333931", True),
+        ("04006381333931", True),
+        ("96385074", True),
+        ("036000291452", True),
+        ("4006381333932", False),
+        ("400638133393", False),   # длина не GTIN
+        ("40063813339a1", False),
+        ("", False),
+    ],
+)
+def test_gtin_check_digit(gtin, ok):
+    assert gtin_check_digit_ok(gtin) is ok
+
+
+def test_gtin14_pads_ean13():
+    assert gtin14("4006381333931") == GTIN
+    assert gtin14(" 4006381333931 ") == GTIN
+    assert gtin14("not-a-gtin") == ""
+
+
+def test_parse_with_gs_separators():
+    r = parse_gs1(CODE)
+    assert r.ok, r.errors
+    assert r.ais == {"01": GTIN, "21": SERIAL, "91": "EE06", "92": CRYPTO}
+    assert r.key == f"01{GTIN}21{SERIAL}"
+
+
+def test_parse_without_gs_uses_typical_lengths():
+    # сканер потерял FNC1: длины переменных полей подбираются по типичным для ЧЗ
+    r = parse_gs1(CODE.replace(GS, ""))
+    assert r.ok, r.errors
+    assert r.ais["21"] == SERIAL
+    assert r.ais["91"] == "EE06"
+    assert r.ais["92"] == CRYPTO
+
+
+@pytest.mark.parametrize("alias", ["<GS>", "\\x1d", "{GS}", "␝"])
+def test_parse_gs_aliases_and_symbology_prefix(alias):
+    r = parse_gs1("]d2" + CODE.replace(GS, alias))
+    assert r.ok, r.errors
+    assert r.serial == SERIAL
+
+
+def test_key_ignores_crypto_tail():
+    assert parse_gs1(CODE).key == parse_gs1(f"01{GTIN}21{SERIAL}{GS}91FFFF{GS}92{'y' * 44}").key
+
+
+def test_parse_errors():
+    assert parse_gs1("").errors == ["пустой код"]
+    assert parse_gs1(f"01{GTIN}").errors == ["нет серийного номера (AI 21)"]
+    assert "неверная контрольная цифра GTIN" in parse_gs1(f"01{BAD_GTIN}21{SERIAL}").errors
+
+    r = parse_gs1("hello")
+    assert not r.ok
+    assert "нет GTIN (AI 01)" in r.errors
+
+
+def test_unparsable_tail_still_yields_gtin():
+    # хвост не разбирается, но GTIN достаётся — строку заказа всё равно можно сопоставить
+    r = parse_gs1(f"01{GTIN}??")
+    assert not r.ok
+    assert r.gtin == GTIN
+
+
+def km(serial: str, gtin: str = GTIN, crypto: str = "EE06") -> str:
+    return f"01{gtin}21{serial}{GS}91{crypto}{GS}92{CRYPTO}"
+
+
+def positions():
+    return [
+        {"line_no": 1, "name": "Шампунь", "ean13": "4006381333931", "quantity": 1, "cis_units": 2},
+        {"line_no": 2, "name": "Пакет", "ean13": "4600000000008", "quantity": 3, "cis_units": 0},
+        {"line_no": 3, "name": "Без штрихкода", "ean13": "", "quantity": 1},
+    ]
+
+
+def test_matcher_maps_gtin_to_line_and_rejects_overflow():
+    m = LineMatcher(positions())
+    assert m.add(km("AAAAAAAAAAAAA")) == (1, "")
+    assert m.add(km("BBBBBBBBBBBBB")) == (1, "")
+    line_no, reason = m.add(km("CCCCCCCCCCCCC"))
+    assert line_no is None and "лишний КМ" in reason
+    assert [(p["line_no"], p["scanned"], p["need"]) for p in m.progress()] == [(1, 2, 2), (3, 0, 1)]
+
+
+def test_matcher_skips_lines_without_cis():
+    m = LineMatcher(positions())
+    assert 2 not in m.lines
+    # строка «Пакет» КМ не требует — её GTIN уходит на строку без EAN
+    assert m.add(km("AAAAAAAAAAAAA", gtin=gtin14(OTHER_EAN))) == (3, "")
+
+
+def test_matcher_lines_without_ean_take_unknown_gtin_until_full():
+    m = LineMatcher(positions())
+    unknown = "00000000000017"
+    assert gtin_check_digit_ok(unknown)
+    assert m.add(km("AAAAAAAAAAAAA", gtin=unknown)) == (3, "")
+    line_no, reason = m.add(km("BBBBBBBBBBBBB", gtin=unknown))
+    assert line_no is None and "не из этого заказа" in reason
+
+
+def test_matcher_rejects_code_without_gtin_and_remove_frees_line():
+    m = LineMatcher(positions())
+    assert m.add("hello")[0] is None
+
+    code = km("AAAAAAAAAAAAA")
+    m.add(code)
+    m.add(km("BBBBBBBBBBBBB"))
+    m.remove(code)
+    assert m.add(km("CCCCCCCCCCCCC")) == (1, "")
+    m.remove("never-scanned")  # не ошибка
+
+
+def test_matcher_uses_quantity_when_cis_units_unknown():
+    m = LineMatcher([{"name": "Крем", "ean13": "4006381333931", "quantity": 2}])
+    assert [ln for _, ln, _ in m.add_many([km("A" * 13), km("B" * 13), km("C" * 13)])] == [1, 1, None]
+
+
+def test_scanset_dedupes_by_key():
+    s = ScanSet()
+    first, same_km = km("AAAAAAAAAAAAA"), km("AAAAAAAAAAAAA", crypto="FFFF")
+    assert s.add(parse_gs1(first).key, first)
+    # тот же КМ с другим крипто-хвостом (повторный скан) — дубль
+    assert not s.add(parse_gs1(same_km).key, same_km)
+    second = km("BBBBBBBBBBBBB")
+    s.add(parse_gs1(second).key, second)
+
+    assert len(s) == 2 and parse_gs1(same_km).key in s
+    assert s.codes() == [first, second]
+    assert s.tail(1) == [second]
+    assert s.pop() == (parse_gs1(second).key, second)
+    assert s.keys() == [parse_gs1(first).key]
+    s.clear()
+    assert len(s) == 0 and s.pop() is None
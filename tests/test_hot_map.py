@@ -0,0 +1,93 @@
+import sqlite3
+
+from bench.ms_stub import QR_ATTR_ID
+from src.index_db import HotOrderMap
+from src.indexer import resolve_barcode
+from src.moysklad import MoySkladClient
+
+
+def order(barcode128: str, order_id: str, positions=None) -> dict:
+    return {
+        "barcode128": barcode128,
+        "order_id": order_id,
+        "order_name": order_id,
+        "moment": "2026-01-01 10:00:00.000",
+        "expected_units": 1,
+        "cis_units": 1,
+        "done": 0,
+        "ms_updated": "2026-01-01 10:00:00.000",
+        "positions": positions or [],
+    }
+
+
+LINE = {"line_no": 1, "name": "Шампунь", "ean13": "4006381333931", "quantity": 1, "need_cis": 1, "cis_units": 1}
+
+
+def test_initial_load_and_incremental_refresh(db):
+    db.ingest_orders([order("B1", "o1", [LINE])])
+    hot = HotOrderMap(db, check_interval_s=0)
+    assert hot.lookup("B1")["order_id"] == "o1"
+    assert [p["name"] for p in hot.lookup_positions("B1")] == ["Шампунь"]
+    rev = hot.rev
+
+    # запись другим соединением: data_version сменился → догружаются только строки с новым rev
+    db.ingest_orders([order("B2", "o2")])
+    assert hot.refresh() == 1
+    assert hot.rev > rev
+    assert hot.lookup("B2")["order_id"] == "o2"
+
+
+def test_refresh_is_noop_without_changes(db):
+    db.ingest_orders([order("B1", "o1")])
+    hot = HotOrderMap(db, check_interval_s=0)
+    hot.refresh()
+    reloads = hot.reloads
+    assert hot.refresh() == 0
+    assert hot.reloads == reloads
+
+
+def test_throttle_and_force(db):
+    hot = HotOrderMap(db, check_interval_s=60)
+    hot.refresh()
+    db.ingest_orders([order("B1", "o1")])
+    # проверка раз в check_interval_s: до неё изменения не видны, force — сразу
+    assert hot.lookup("B1") is None
+    assert hot.refresh(force=True) == 1
+    assert hot.lookup("B1") is not None
+
+
+def test_done_and_tombstoned_orders(db):
+    db.ingest_orders([order("B1", "o1", [LINE]), order("B2", "o2")])
+    hot = HotOrderMap(db, check_interval_s=0)
+    hot.refresh()
+
+    db.mark_done("B1")
+    hot.refresh()
+    assert hot.lookup("B1")["done"] == 1
+
+    # удаление из orders_index (retention, заказ ушёл из «упаковки») → tombstone → из карты
+    with sqlite3.connect(db.path) as conn:
+        conn.execute("UPDATE orders_index SET done_at='2000-01-01 00:00:00' WHERE barcode128='B1'")
+    assert db.prune_done(1) == 1
+    assert db.drop_open("B2") == 1
+    assert hot.refresh() == 2
+    assert hot.lookup("B1") is None and hot.lookup_positions("B1") == []
+    assert hot.lookup("B2") is None
+
+
+def test_resolve_barcode_then_forced_refresh(stub, db):
+    ms_stub, base_url = stub
+    ms = MoySkladClient(token="t", base_url=base_url)
+    b128 = ms_stub.data.barcodes()[0]
+    hot = HotOrderMap(db, check_interval_s=60)
+    assert hot.lookup(b128) is None
+
+    found, outcome = resolve_barcode(
+        ms, db, b128, qr_attr_id=QR_ATTR_ID, packing_state_href=ms_stub.data.packing_state_href
+    )
+    assert outcome == "added" and found["barcode128"] == b128
+    # карта только что проверялась (throttle) — после resolve приложение догружает её принудительно
+    assert hot.lookup(b128) is None
+    hot.refresh(force=True)
+    assert hot.lookup(b128)["order_id"] == found["order_id"]
+    assert hot.lookup_positions(b128)
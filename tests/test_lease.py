@@ -0,0 +1,65 @@
+import time
+
+from src.indexer import LeaseKeeper
+
+
+def test_acquire_renew_and_block_other_holder(db):
+    assert db.acquire_lease("index", "a", ttl_s=60)
+    first = db.lease_info("index")
+    assert first["holder"] == "a" and first["alive"]
+
+    # продление своим держателем: acquired_at прежний, expires_at сдвигается
+    assert db.acquire_lease("index", "a", ttl_s=120)
+    renewed = db.lease_info("index")
+    assert renewed["acquired_at"] == first["acquired_at"]
+    assert renewed["expires_at"] > first["expires_at"]
+
+    assert not db.acquire_lease("index", "b", ttl_s=60)
+    assert db.lease_info("index")["holder"] == "a"
+
+
+def test_expired_lease_is_taken_over(db):
+    assert db.acquire_lease("index", "a", ttl_s=0.05)
+    time.sleep(0.1)
+    assert not db.lease_info("index")["alive"]
+
+    assert db.acquire_lease("index", "b", ttl_s=60)
+    info = db.lease_info("index")
+    assert info["holder"] == "b" and info["alive"]
+    # вернувшийся держатель lease уже не получит
+    assert not db.acquire_lease("index", "a", ttl_s=60)
+
+
+def test_release_only_by_holder(db):
+    db.acquire_lease("index", "a", ttl_s=60)
+    db.release_lease("index", "b")
+    assert db.lease_info("index")["holder"] == "a"
+    db.release_lease("index", "a")
+    assert db.lease_info("index") is None
+    assert db.acquire_lease("index", "b", ttl_s=60)
+
+
+def test_leases_are_independent_by_name(db):
+    assert db.acquire_lease("index:x", "a", ttl_s=60)
+    assert db.acquire_lease("index:y", "b", ttl_s=60)
+
+
+def test_keeper_heartbeat_and_loss(db):
+    keeper = LeaseKeeper(db, "index", ttl_s=0.3, holder="a")
+    other = LeaseKeeper(db, "index", ttl_s=0.3, holder="b")
+    try:
+        assert keeper.acquire() and keeper.held()
+        # heartbeat продлевает lease дольше ttl — второй не заберёт
+        time.sleep(0.5)
+        assert not other.acquire()
+
+        # lease перехватили (напр. сняли вручную и взял другой) — держатель замечает потерю
+        db.release_lease("index", "a")
+        assert db.acquire_lease("index", "c", ttl_s=60)
+        assert keeper.lost.wait(1.0)
+        assert not keeper.held()
+    finally:
+        keeper.release()
+        other.release()
+    # release потерявшего lease не снимает чужой
+    assert db.lease_info("index")["holder"] == "c"
@@ -0,0 +1,34 @@
+import pytest
+
+from src.metrics import HttpMetrics, Histogram
+
+
+def test_quantile_interpolates_within_observed_range():
+    h = Histogram()
+    for v in (0.008, 0.009, 0.009, 0.010, 0.011):
+        h.observe(v)
+    # все в корзине ≤50 мс: оценка — внутри [min, max], а не граница корзины
+    assert 0.008 <= h.quantile(0.5) <= 0.011
+    assert h.quantile(0.5) == pytest.approx(0.0095)
+    assert h.quantile(0.0) == pytest.approx(0.008)
+    assert h.quantile(1.0) == pytest.approx(0.011)
+
+
+def test_quantile_across_buckets_and_overflow():
+    h = Histogram()
+    for _ in range(50):
+        h.observe(0.3)   # корзина (0.25, 0.5]
+    for _ in range(50):
+        h.observe(120.0)  # +Inf
+    assert 0.25 <= h.quantile(0.25) <= 0.5
+    assert h.quantile(0.99) <= 120.0
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_stats_reports_fractional_ms():
+    m = HttpMetrics()
+    for v in (0.008, 0.009, 0.010):
+        m.observe_response("GET", "/entity/product", 200, v, bytes_in=100)
+    row = m.stats()["endpoints"]["GET /entity/product"]
+    assert row["p50_ms"] == pytest.approx(9.0, abs=0.1)
+    assert row["bytes_in"] == 300
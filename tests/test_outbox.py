@@ -0,0 +1,96 @@
+import time
+
+from src.outbox import OutboxFlusher
+
+
+def test_claim_then_sent(db):
+    db.outbox_enqueue("B1", "o1", ["a", "b"])
+    items = db.outbox_claim("w1")
+    assert [(it["barcode128"], it["codes"], it["attempts"]) for it in items] == [("B1", ["a", "b"], 0)]
+    # чужой воркер claimed-запись не получит
+    assert db.outbox_claim("w2") == []
+
+    db.outbox_sent("B1", "w1", ["a", "b"])
+    assert db.outbox_counts() == {"pending": 0, "failed": 0, "sent": 1}
+    assert db.outbox_claim("w1") == []
+
+
+def test_result_from_other_worker_is_ignored(db):
+    db.outbox_enqueue("B1", "o1", ["a"])
+    db.outbox_claim("w1")
+    db.outbox_sent("B1", "w2", ["a"])
+    assert db.outbox_counts()["pending"] == 1
+
+
+def test_failed_with_retry_waits_for_backoff(db):
+    db.outbox_enqueue("B1", "o1", ["a"])
+    db.outbox_claim("w1")
+    db.outbox_failed("B1", "w1", ["a"], "timeout", retry_in_s=60)
+    assert db.outbox_counts()["pending"] == 1
+    assert db.outbox_claim("w1") == []
+
+    db.outbox_failed("B1", "w1", ["a"], "ignored: claim already released", retry_in_s=None)
+    assert db.outbox_counts()["failed"] == 0
+
+
+def test_failed_permanently_and_retry_failed(db):
+    db.outbox_enqueue("B1", "o1", ["a"])
+    db.outbox_claim("w1")
+    db.outbox_failed("B1", "w1", ["a"], "404", retry_in_s=None)
+    assert db.outbox_counts() == {"pending": 0, "failed": 1, "sent": 0}
+    assert db.outbox_list("failed")[0]["last_error"] == "404"
+
+    assert db.outbox_retry_failed() == 1
+    assert [it["attempts"] for it in db.outbox_claim("w1")] == [0]
+
+
+def test_expired_claim_is_taken_over(db):
+    db.outbox_enqueue("B1", "o1", ["a"])
+    db.outbox_claim("w1", claim_s=0.05)
+    time.sleep(0.1)
+    assert [it["barcode128"] for it in db.outbox_claim("w2")] == ["B1"]
+    # упавший w1 вернулся и отчитался — запись уже не его
+    db.outbox_sent("B1", "w1", ["a"])
+    assert db.outbox_counts()["pending"] == 1
+
+
+def test_reenqueue_during_send_keeps_new_codes_pending(db):
+    db.outbox_enqueue("B1", "o1", ["old"])
+    item = db.outbox_claim("w1")[0]
+    db.outbox_enqueue("B1", "o1", ["new"])
+
+    db.outbox_sent("B1", "w1", item["codes"])
+    assert db.outbox_counts()["pending"] == 1
+    assert [it["codes"] for it in db.outbox_claim("w2")] == [["new"]]
+    db.outbox_sent("B1", "w2", ["new"])
+    assert db.outbox_counts()["sent"] == 1
+
+
+def test_reenqueue_during_failed_send_does_not_count_attempt(db):
+    db.outbox_enqueue("B1", "o1", ["old"])
+    db.outbox_claim("w1")
+    db.outbox_enqueue("B1", "o1", ["new"])
+    db.outbox_failed("B1", "w1", ["old"], "timeout", retry_in_s=600)
+    assert [(it["codes"], it["attempts"]) for it in db.outbox_claim("w2")] == [(["new"], 0)]
+
+
+class FakeMs:
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def set_customerorders_cis_blocks(self, blocks):
+        self.calls.append(blocks)
+        return {oid: self.results.get(oid, "updated") for oid in blocks}
+
+
+def test_flusher_settles_each_item(db):
+    db.outbox_enqueue("B1", "o1", ["a"])
+    db.outbox_enqueue("B2", "o2", ["b"])
+    ms = FakeMs({"o2": RuntimeError("boom")})
+    flusher = OutboxFlusher(ms, db, worker="w1")
+
+    assert flusher.flush_once() == 2
+    assert ms.calls == [{"o1": ["a"], "o2": ["b"]}]
+    assert db.outbox_counts() == {"pending": 1, "failed": 0, "sent": 1}
+    assert flusher.stats["sent"] == 1 and flusher.stats["retried"] == 1